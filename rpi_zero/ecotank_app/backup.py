@@ -0,0 +1,69 @@
+"""
+Take, list and restore compressed snapshots of the EcoTank database, while the manager and webserver keep running.
+The manager also takes a snapshot every ECOTANK_BACKUP_INTERVAL_HOURS; see manager/boundary/db_backup.py.
+
+Examples:
+    python rpi_zero/ecotank_app/backup.py create
+    python rpi_zero/ecotank_app/backup.py list
+    python rpi_zero/ecotank_app/backup.py restore instance/backups/database-20240301-030000.db.gz
+"""
+import argparse
+import os
+import sys
+import shared_db as db
+from manager.boundary.logger import logger
+from manager.boundary.change_bus import KINDS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Online snapshots of the EcoTank database.")
+    parser.add_argument("--db", help="Database file, defaults to instance/database.db")
+    parser.add_argument("--pages", type=int, help="Pages copied per lock hold")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("create", help="Take a snapshot now")
+    commands.add_parser("list", help="List the snapshots, oldest first")
+    restore = commands.add_parser("restore", help="Replace the database contents with a snapshot")
+    restore.add_argument("snapshot", help="A snapshot from list, or its file name")
+    restore.add_argument("--yes", action="store_true", help="Don't ask for confirmation")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["ERROR"]
+    if args.db:
+        db.use_database(args.db)
+    backup = db.database_backup()
+    if args.pages:
+        backup.pages_per_step = args.pages
+
+    if args.command == "create":
+        result = backup.backup()
+        print(f"snapshot:      {result.path}")
+        print(f"size:          {result.size // 1024} KiB, {result.compressed_size // 1024} KiB compressed")
+        print(f"duration:      {result.duration:.3f} s")
+        print(f"steps:         {result.steps} of {backup.pages_per_step} pages, {result.restarts} restarts")
+        print(f"longest step:  {result.max_lock * 1000:.2f} ms")
+
+    elif args.command == "list":
+        for taken, path in backup.snapshots():
+            print(f"{taken:%Y-%m-%d %H:%M:%S}  {os.path.getsize(path) // 1024:>8} KiB  {path}")
+
+    elif args.command == "restore":
+        snapshot = args.snapshot
+        if not os.path.exists(snapshot):
+            snapshot = os.path.join(backup.directory, snapshot)
+        if not os.path.exists(snapshot):
+            parser.error(f"{args.snapshot} does not exist")
+        if not args.yes:
+            answer = input(f"Replace the contents of {db.db_path} with {snapshot}? [y/N] ")
+            if answer.strip().lower() not in ("y", "yes"):
+                sys.exit(1)
+        previous = backup.restore(snapshot)
+        # Both processes cache values until a change is announced, see change_bus.py
+        db.change_bus.publish(*KINDS)
+        print(f"restored {snapshot}")
+        print(f"the previous contents are in {previous.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Measure how much an online backup delays the control loop's commits (see manager/boundary/db_backup.py).
+
+A database is filled with readings, then a writer thread commits a reading every --write-interval seconds, like
+the manager does: first without a backup, then while a backup runs in steps of --pages pages, and while one runs
+in a single step. For each, the backup's duration, longest step and restarts are reported with the commit
+latencies seen by the writer. --journal-mode delete shows the behaviour of databases not yet switched to WAL.
+
+Examples:
+    python rpi_zero/ecotank_app/backup_bench.py
+    python rpi_zero/ecotank_app/backup_bench.py --readings 2000000 --pages 32
+    python rpi_zero/ecotank_app/backup_bench.py --journal-mode delete
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from manager.boundary.logger import logger
+import shared_db as db
+
+
+def fill(readings):
+    """
+    Bulk inserts readings every 30 s, ending now.
+    """
+    first = datetime.now() - timedelta(seconds=30 * readings)
+    with db.Session() as session:
+        for offset in range(0, readings, 10000):
+            session.execute(
+                insert(db.SensorReading),
+                [
+                    {
+                        "time": first + timedelta(seconds=30 * i),
+                        "water_temp": 40.0 + (i % 200) / 10,
+                        "water_level": 50 + i % 50,
+                        "setpoint": 55,
+                        "sys_power": True,
+                    }
+                    for i in range(offset, min(offset + 10000, readings))
+                ],
+            )
+        session.commit()
+
+
+def commit_latencies(backup, pages, write_interval):
+    """
+    Runs a backup with pages per step while a writer commits readings, or just the writer if pages is None.
+
+    Returns:
+        tuple: (BackupResult or None, sorted commit latencies in seconds)
+    """
+    latencies = []
+    done = threading.Event()
+
+    def writer():
+        with db.Session() as session:
+            while not done.is_set():
+                start = time.perf_counter()
+                session.add(db.SensorReading(time=datetime.now(), water_temp=50.0, water_level=80, setpoint=55, sys_power=True))
+                session.commit()
+                latencies.append(time.perf_counter() - start)
+                time.sleep(write_interval)
+
+    thread = threading.Thread(target=writer, name="writer")
+    thread.start()
+    result = None
+    if pages is None:
+        time.sleep(2.0)
+    else:
+        time.sleep(0.5)  # The writer is running before the backup starts
+        backup.pages_per_step = pages
+        result = backup.backup()
+        time.sleep(0.5)
+    done.set()
+    thread.join()
+    return result, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure commit latency during an online database backup.")
+    parser.add_argument("--readings", type=int, default=500000, help="Readings in the database")
+    parser.add_argument("--pages", type=int, default=64, help="Pages per backup step")
+    parser.add_argument("--write-interval", type=float, default=0.02, help="Seconds between commits")
+    parser.add_argument("--journal-mode", choices=("wal", "delete"), default="wal")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db.use_database(os.path.join(workdir, "backup_bench.db"))
+        db.create_database()
+        if args.journal_mode == "delete":
+            # Leaving WAL is stored in the file, so every connection opened after this uses the rollback journal
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        fill(args.readings)
+        backup = db.database_backup()
+        with db.engine.connect() as connection:
+            journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        print(f"database: {os.path.getsize(db.db_path) // 1024} KiB, {args.readings} readings, {journal_mode} journal")
+        print(f"{'backup':>10} {'duration':>9} {'steps':>6} {'restarts':>8} {'max step':>9} "
+              f"{'commit p50':>11} {'commit p99':>11} {'commit max':>11}")
+        for pages in (None, args.pages, -1):
+            result, latencies = commit_latencies(backup, pages, args.write_interval)
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(int(0.99 * len(latencies)), len(latencies) - 1)]
+            if result is None:
+                backup_columns = f"{'none':>10} {'':>9} {'':>6} {'':>8} {'':>9}"
+            else:
+                name = f"{pages} pages" if pages > 0 else "one step"
+                backup_columns = (
+                    f"{name:>10} {result.duration:>8.2f}s {result.steps:>6} {result.restarts:>8} "
+                    f"{result.max_lock * 1000:>7.1f}ms"
+                )
+            print(f"{backup_columns} {p50 * 1000:>9.2f}ms {p99 * 1000:>9.2f}ms {latencies[-1] * 1000:>9.2f}ms")
+        db.Session.remove()
+
+
+if __name__ == "__main__":
+    main()
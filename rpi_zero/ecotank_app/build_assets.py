@@ -0,0 +1,35 @@
+"""
+Build the fingerprinted and precompressed static assets into webserver/static/dist, see webserver/assets.py.
+The webserver also builds them at startup when they are missing or out of date; run this as part of deploying
+to keep that work off the Pi, or after editing a stylesheet or script while the server is running.
+
+Examples:
+    python rpi_zero/ecotank_app/build_assets.py
+    python rpi_zero/ecotank_app/build_assets.py --verbose
+"""
+import argparse
+import os
+from manager.boundary.logger import logger
+from webserver import assets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bundle, minify, fingerprint and precompress the static assets.")
+    parser.add_argument("--verbose", action="store_true", help="Log every file that is written")
+    args = parser.parse_args()
+    if args.verbose:
+        logger.current_level = logger.LOG_LEVELS["DEBUG"]
+
+    manifest = assets.build()
+    print(f"{'bundle':<14}{'file':<30}{'bytes':>9}{'gzip':>9}{'br':>9}")
+    for name, entry in manifest["files"].items():
+        sizes = [
+            os.path.getsize(os.path.join(assets.DIST_DIR, entry["file"] + entry["encodings"][encoding]))
+            if encoding in entry["encodings"] else "-"
+            for encoding in ("gzip", "br")
+        ]
+        print(f"{name:<14}{entry['file']:<30}{entry['size']:>9}{sizes[0]:>9}{sizes[1]:>9}")
+
+
+if __name__ == "__main__":
+    main()
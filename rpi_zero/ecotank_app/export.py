@@ -0,0 +1,51 @@
+"""
+Export stored prices, forecasts or telemetry as CSV or JSON lines, without stopping the running processes.
+The same streaming export as the webserver's /export routes, see manager/control/data_export.py.
+
+Examples:
+    python rpi_zero/ecotank_app/export.py prices --region DK1 --start 2024-01-01 --end 2024-02-01 -o prices.csv
+    python rpi_zero/ecotank_app/export.py telemetry --format jsonl --gzip -o telemetry.jsonl.gz
+"""
+import argparse
+import sys
+import shared_db as db
+from manager.boundary.logger import logger
+from manager.control.data_export import DATASETS, FORMATS, parse_time, iter_export
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream an export of the EcoTank database.")
+    parser.add_argument("dataset", choices=sorted(DATASETS))
+    parser.add_argument("--region", help="Price region, defaults to the configured region")
+    parser.add_argument("--start", help="Inclusive start, YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+    parser.add_argument("--end", help="Exclusive end, YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output")
+    parser.add_argument("--db", help="Database file, defaults to instance/database.db")
+    parser.add_argument("-o", "--output", help="Output file, defaults to stdout")
+    args = parser.parse_args()
+
+    try:
+        start = parse_time(args.start)
+        end = parse_time(args.end)
+    except ValueError:
+        parser.error("dates must be YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+
+    # Keep stdout clean for the export itself
+    logger.current_level = logger.LOG_LEVELS["ERROR"]
+    if args.db:
+        db.use_database(args.db)
+
+    with db.Session() as session:
+        region = args.region or db.get_user_settings(session).price_region
+        output = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            for chunk in iter_export(session, args.dataset, region, start, end, args.format, args.gzip):
+                output.write(chunk)
+        finally:
+            if args.output:
+                output.close()
+
+
+if __name__ == "__main__":
+    main()
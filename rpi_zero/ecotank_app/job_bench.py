@@ -0,0 +1,119 @@
+"""
+Measure how much rebuilding the dashboard's price chart holds up other requests, with the chart built in the
+request thread (ECOTANK_JOB_WORKERS=0) and in a job worker process (see manager/boundary/job_queue.py).
+
+A database is seeded with --days of hourly prices. One thread then loads /dashboard over and over, announcing new
+prices before each load so every chart is outdated, while another polls /get_system_data every --poll-interval
+seconds, like the home page does. The latencies of both are reported. --cpus 1 pins the process and its workers
+to one CPU, like a Pi Zero.
+
+Examples:
+    python rpi_zero/ecotank_app/job_bench.py
+    python rpi_zero/ecotank_app/job_bench.py --days 1095 --duration 20 --cpus 1
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from memory_check import seed_prices
+
+
+def seed(db, days):
+    """
+    Bulk inserts hourly DK1 prices for days, ending today.
+    """
+    first_hour = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=days)
+    with db.Session() as session:
+        seed_prices(db, session, first_hour, days * 24)
+        session.commit()
+
+
+def percentiles(latencies):
+    ordered = sorted(latencies)
+    if not ordered:
+        return "-"
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(int(0.99 * len(ordered)), len(ordered) - 1)]
+    return f"{len(ordered):>6} {p50 * 1000:>8.1f}ms {p99 * 1000:>8.1f}ms {ordered[-1] * 1000:>8.1f}ms"
+
+
+def run(db, workers, duration, poll_interval):
+    """
+    Returns (dashboard latencies, system data latencies) in seconds with the given number of job workers.
+    """
+    from webserver import create_app
+
+    os.environ["ECOTANK_JOB_WORKERS"] = str(workers)
+    app = create_app(background_warm_up=False)
+    dashboard, system_data = [], []
+    done = threading.Event()
+
+    def load_dashboard():
+        client = app.test_client()
+        while not done.is_set():
+            db.change_bus.publish("prices")
+            start = time.perf_counter()
+            assert client.get("/dashboard").status_code == 200
+            dashboard.append(time.perf_counter() - start)
+
+    def poll():
+        client = app.test_client()
+        while not done.is_set():
+            start = time.perf_counter()
+            assert client.get("/get_system_data").status_code == 200
+            system_data.append(time.perf_counter() - start)
+            time.sleep(poll_interval)
+
+    app.test_client().get("/dashboard")  # Loads the prices into the cache and starts the workers
+    threads = [threading.Thread(target=load_dashboard), threading.Thread(target=poll)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    done.set()
+    for thread in threads:
+        thread.join()
+    status = app.extensions["jobs"].status()
+    app.extensions["jobs"].shutdown()
+    return dashboard, system_data, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure request latency while the dashboard chart is rebuilt.")
+    parser.add_argument("--days", type=int, default=365, help="Days of hourly prices")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run")
+    parser.add_argument("--poll-interval", type=float, default=0.02, help="Seconds between /get_system_data requests")
+    parser.add_argument("--cpus", type=int, help="Pin the process and its workers to this many CPUs")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if args.cpus:
+        os.sched_setaffinity(0, range(args.cpus))  # Inherited by the spawned workers
+    import shared_db as db
+    from manager.boundary.logger import logger
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db.use_database(os.path.join(workdir, "job_bench.db"))
+        db.create_database()
+        seed(db, args.days)
+        print(f"{args.days} days of prices, {args.duration:.0f} s per run, CPUs: {len(os.sched_getaffinity(0))}")
+        print(f"{'workers':>8} {'route':<18} {'count':>6} {'p50':>10} {'p99':>10} {'max':>10}")
+        for workers in (0, 1):
+            dashboard, system_data, status = run(db, workers, args.duration, args.poll_interval)
+            print(f"{workers:>8} {'/dashboard':<18} {percentiles(dashboard)}")
+            print(f"{workers:>8} {'/get_system_data':<18} {percentiles(system_data)}")
+            counters = status["counters"]
+            print(
+                f"{'':>8} jobs: {counters['completed']} built, {counters['deduplicated']} deduplicated, "
+                f"{counters['stale']} stale answers, {status['busy_seconds']:.1f} s busy"
+            )
+        db.Session.remove()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
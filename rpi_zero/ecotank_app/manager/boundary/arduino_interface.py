@@ -1,18 +1,20 @@
 import serial
 import struct
-import select
 import atexit
 import re
 from ..boundary.logger import logger
+from ..boundary.transport import create_transport
+from ..boundary.clock import system_clock
 
 
 class ArduinoIF:
     """
     Boundary class for interfacing with the Arduino through UART.
+    The actual byte link is a Transport (serial, TCP or simulated), see transport.py.
     """
     
-    serial_port = "/dev/ttyACM0"
-    baud_rate = 250000  # Must match the baud rate of the atmega2560.
+    min_reconnect_delay = 0.5  # Seconds to wait before the first reconnect attempt
+    max_reconnect_delay = 60.0  # Upper bound for the exponential reconnect backoff
     start_id_byte = b'\x7E'
     stop_id_byte = b'\x7D'
     setpoint_id_byte = b'\x5C'
@@ -32,47 +34,77 @@ class ArduinoIF:
     # 	DUMMY_BYTE = 0xFF
     # };
 
-    def __init__(self):
-        self.ser = None
-        self._open_serial_port()
+    def __init__(self, transport=None, clock=None):
+        self.transport = transport if transport is not None else create_transport()
+        self.clock = clock if clock is not None else system_clock
+        self.reconnect_delay = self.min_reconnect_delay
+        self.next_reconnect_at = 0.0  # clock.monotonic() value before which no open attempt is made
+        self.failed_attempts = 0
+        atexit.register(self._close_transport)  # Registered once, not on every (re)open
+        self._open_transport()
 
 
-    def _open_serial_port(self):
-        log_ctx = "Open Serial Port:"
-        attempts = 3  # Number of attempts to open the serial port
+    def _open_transport(self):
+        """
+        Tries to open the transport once, unless we are still inside the backoff window.
+        Every failed attempt doubles the delay before the next attempt (up to max_reconnect_delay),
+        so a missing device costs one cheap check per backoff period instead of retries on every loop tick.
 
-        for attempt in range(attempts):
-            try:
-                self.ser = serial.Serial(self.serial_port, self.baud_rate)
-                atexit.register(self._close_serial_port)
-                logger.log(log_ctx, f"Successfully opened on attempt {attempt + 1}", "INFO")
-                break
-            except serial.SerialException as e:
-                logger.log(log_ctx, "Failed to open serial port", "ERROR", e)
-                if attempt < attempts - 1:
-                    logger.log(log_ctx, f"Retrying... ({attempt + 2}/{attempts})", "WARNING")
-                else:
-                    logger.log(log_ctx, "All attempts to open serial port failed.", "ERROR")
-
-
-    def _close_serial_port(self):
+        Returns:
+            bool: True if the transport is open afterwards.
         """
-        This simply closes the serial port if it's open.
-        The intention was to use this for handling the UART connection in a more controlled way,
-        like opening and closing the port when needed or for handling a more dynamic setup 
-        which allowed on-the-fly physical connection changes.
-        
-        Currently, it's only called when the program exits, so it's not really used.
+        log_ctx = "Open Transport:"
+
+        now = self.clock.monotonic()
+        if now < self.next_reconnect_at:
+            return False
+
+        try:
+            if not self.transport.is_available():
+                raise serial.SerialException(f"{self.transport!r} is not available")
+            self.transport.open()
+        except (serial.SerialException, OSError) as e:
+            self.failed_attempts += 1
+            self.next_reconnect_at = now + self.reconnect_delay
+            # The backoff also bounds the log volume to at most one line per max_reconnect_delay
+            logger.log(
+                log_ctx,
+                f"Failed to open {self.transport!r} (attempt {self.failed_attempts}), "
+                f"retrying in {self.reconnect_delay:.1f} s",
+                "ERROR",
+                e,
+            )
+            self.reconnect_delay = min(self.reconnect_delay * 2, self.max_reconnect_delay)
+            return False
+
+        logger.log(log_ctx, f"Successfully opened {self.transport!r} after {self.failed_attempts + 1} attempt(s)", "INFO")
+        self.reconnect_delay = self.min_reconnect_delay
+        self.failed_attempts = 0
+        return True
+
+
+    def _close_transport(self):
+        """
+        Closes the transport if it's open. Called on program exit and when the link is lost.
         """
-        log_ctx = "Close Serial Port:"
+        log_ctx = "Close Transport:"
 
-        if self.ser and self.ser.is_open:
+        if self.transport.is_open:
             try:
-                self.ser.close()
-                logger.log(log_ctx, "Serial port closed successfully", "INFO")
+                self.transport.close()
+                logger.log(log_ctx, f"{self.transport!r} closed successfully", "INFO")
             except Exception as e:
-                logger.log(log_ctx, "Failed to close serial port", "ERROR", e)
-            self.ser = None
+                logger.log(log_ctx, f"Failed to close {self.transport!r}", "ERROR", e)
+
+
+    def _handle_link_lost(self, error=None):
+        """
+        Closes the transport after an I/O error or a hot-unplug and schedules a reconnect with the minimum delay.
+        """
+        logger.log("Link Lost:", f"Lost connection to {self.transport!r}", "ERROR", error)
+        self._close_transport()
+        self.reconnect_delay = self.min_reconnect_delay
+        self.next_reconnect_at = self.clock.monotonic() + self.reconnect_delay
 
 
     def exchange_data(self, system_power, setpoint):
@@ -86,22 +118,31 @@ class ArduinoIF:
         """
         log_ctx = "Exchange Data:"
 
-        # Attempt to reopen the port if not open
-        if not self.ser or not self.ser.is_open:
-            self._open_serial_port()  
+        # Detect a device that was unplugged while the port was open
+        if self.transport.is_open and not self.transport.is_available():
+            self._handle_link_lost()
+
+        # Attempt to reopen the transport if not open (rate limited by the reconnect backoff)
+        if not self.transport.is_open:
+            self._open_transport()
 
         # If it's open, do the whole exchange process and return the water temperature and level
-        if self.ser and self.ser.is_open:
-            self._send_data_frame(system_power, setpoint)  # Send the current system data to the Arduino
+        if self.transport.is_open:
+            if not self._send_data_frame(system_power, setpoint):  # Send the current system data to the Arduino
+                return
             byte_stream = self._get_buffered_input()  # Get the bytes from the system UART input buffer
             frame = self._find_data_frame(byte_stream)  # Find a valid frame in the received bytes
             if frame is None:
                 logger.log(log_ctx, "No valid frame found", "ERROR")
                 return
-            water_temp, water_level = self._unpack_data_frame(frame)  # Unpack the frame and get the water temperature and level
+            values = self._unpack_data_frame(frame)  # Unpack the frame and get the water temperature and level
+            if values is None:
+                return  # Already logged by _unpack_data_frame
+            water_temp, water_level = values
             return water_temp, water_level
         else:
-            logger.log(log_ctx, "Cannot exchange data, serial port not open", "ERROR")
+            # Failures to open are already logged by _open_transport
+            logger.log(log_ctx, "Cannot exchange data, transport not open", "DEBUG")
             return
 
 
@@ -115,11 +156,18 @@ class ArduinoIF:
         water_level = None
         water_temp = None
 
-        for i in range(1, 9):
-            if response[i] == self.water_level_id_byte[0]:
+        # Skip over the payload after each id byte, since payload bytes can have the same value as an id byte.
+        # A payload must end before the stop byte at index 8.
+        i = 1
+        while i < 8:
+            if response[i] == self.water_level_id_byte[0] and i + 1 < 8:
                 water_level = response[i + 1]
-            elif response[i] == self.temperature_id_byte[0]:
+                i += 2
+            elif response[i] == self.temperature_id_byte[0] and i + 4 < 8:
                 water_temp = struct.unpack("<f", response[i + 1:i + 5])[0]
+                i += 5
+            else:
+                i += 1
 
         if water_level is not None and water_temp is not None:
             return water_temp, water_level
@@ -136,10 +184,7 @@ class ArduinoIF:
             setpoint (float): The setpoint value to be sent.
 
         Returns:
-            None
-
-        Raises:
-            Exception: If there is an error sending bytes to the Arduino.
+            bool: True if the bytes were written, False if the link was lost.
         """
         log_ctx = "Send Data Frame:"
 
@@ -151,10 +196,13 @@ class ArduinoIF:
 
         try:
             # Send the bytes to the Arduino
-            self.ser.write(bytes_sequence)
+            self.transport.write(bytes_sequence)
             logger.log(log_ctx, f"Sent bytes: {bytes_sequence}", "DEBUG")  # Log the sent bytes
+            return True
         except Exception as e:
             logger.log(log_ctx, "Error sending bytes to Arduino", "ERROR", e)
+            self._handle_link_lost(e)
+            return False
 
 
     def _get_buffered_input(self):
@@ -164,30 +212,32 @@ class ArduinoIF:
         Returns:
             bytes: The received bytes from the Arduino.
 
-        Raises:
-            Exception: If there is an error reading bytes from the Arduino.
-            
         Note:
             Currently, we don't actually handle waiting for the complete frame, 
             and once in a while the timing is off which results in a partial frame being returned.
         """
         log_ctx = "Get Buffered Input:"
-        # self.ser.flushInput()
         response = None
 
         # Wait for the Arduino to respond with 5 retries (arbirtary number of retries)
         for _ in range(5):
-            # Wait for data to be available on the serial port
-            # select.select() waits for the serial port to be ready for reading with a defined timeout (0.2 seconds)
-            readable, writable, exceptional = select.select([self.ser], [], [], 0.2)
+            # Wait for data to be available on the transport with a defined timeout (0.2 seconds)
+            try:
+                readable = self.transport.wait_readable(0.2)
+            except Exception as e:
+                logger.log(log_ctx, "Error waiting for bytes from Arduino", "ERROR", e)
+                self._handle_link_lost(e)
+                return
 
             if readable:
                 # Read all available data in the input buffer
                 try:
-                    response = self.ser.read(self.ser.in_waiting)
+                    response = self.transport.read_available()
                     logger.log(log_ctx, f"Received bytes: {response}", "DEBUG")  # Log the received bytes
                 except Exception as e:
                     logger.log(log_ctx, "Error reading bytes from Arduino", "ERROR", e)
+                    self._handle_link_lost(e)
+                    return
                 break  # Exit the loop once all the data has been read
             else:
                 logger.log(log_ctx, "Timeout waiting for response from Arduino", "WARNING")
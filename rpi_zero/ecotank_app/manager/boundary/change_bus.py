@@ -0,0 +1,238 @@
+"""
+Change notifications shared by the manager and webserver processes.
+
+The channel is a small memory-mapped file next to the database holding a global sequence number and, per kind of
+change, the sequence number of its last change. Publishing increments the sequence under a file lock and stamps
+it on the changed kinds, so versions increase monotonically across both processes and survive restarts.
+Reading a version is a memory read, cheap enough to do every loop iteration instead of re-querying the database.
+
+shared_db publishes after every commit that changed a model (see _collect_changes there), so writers don't have
+to do anything. Consumers either compare versions themselves, wrap a query in a CachedValue, or subscribe to
+ChangeEvents, which are delivered when they call dispatch.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from .logger import logger
+
+try:
+    import fcntl
+except ImportError:  # No inter-process lock on Windows; publishing is then only safe within one process
+    fcntl = None
+
+# Kinds of change. Only ever append to KINDS, the position is the slot in the file.
+SETTINGS = "settings"  # User settings or time intervals
+POWER = "power"  # System power toggled
+OVERRIDE = "override"  # Manual heating started or stopped
+PRICES = "prices"  # Electricity prices stored or archived
+FORECASTS = "forecasts"  # Price forecasts replaced
+SETPOINT = "setpoint"  # Setpoint changed by the manager
+READINGS = "readings"  # New water temperature or level
+ENERGY = "energy"  # Energy and cost totals written by the energy accountant
+THERMAL = "thermal"  # Thermal model of the tank recalibrated
+USAGE = "usage"  # Draw-off detected or hot water usage profile updated
+KINDS = (SETTINGS, POWER, OVERRIDE, PRICES, FORECASTS, SETPOINT, READINGS, ENERGY, THERMAL, USAGE)
+
+SLOT = struct.Struct("<Q")
+FILE_SIZE = SLOT.size * (1 + len(KINDS))
+
+ChangeEvent = namedtuple("ChangeEvent", ["kind", "version"])
+
+
+class ChangeBus(object):
+    """
+    Publishes and reads change versions through the file at path. If the file can't be opened, publish does
+    nothing and every version is None, which consumers must treat as "always changed".
+
+    Args:
+        path (str): The shared file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._map = None
+        self._failed = False
+        self._lock = threading.RLock()
+        self._subscribers = []  # [callback, kinds, {kind: version last delivered}]
+
+    def _open(self):
+        if self._map is not None:
+            return self._map
+        with self._lock:
+            if self._map is not None:  # Opened by another thread meanwhile
+                return self._map
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    with _locked(fd):
+                        if os.fstat(fd).st_size < FILE_SIZE:
+                            os.ftruncate(fd, FILE_SIZE)
+                    self._map = mmap.mmap(fd, FILE_SIZE)
+                except (OSError, ValueError):
+                    os.close(fd)
+                    raise
+                self._fd = fd
+            except (OSError, ValueError) as e:
+                if not self._failed:
+                    logger.log("Change Bus:", f"Could not open {self.path}, changes are not published", "WARNING", e)
+                    self._failed = True
+                return None
+            return self._map
+
+    def reopen(self, path):
+        """
+        Switches to another file, see shared_db.use_database.
+        """
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+            self.path = path
+            self._map = self._fd = None
+            self._failed = False
+
+    def publish(self, *kinds):
+        """
+        Stamps the kinds with the next sequence number.
+
+        Returns:
+            int or None: The new sequence number, None if the bus is unavailable.
+        """
+        with self._lock:
+            mapping = self._open()
+            if mapping is None:
+                return None
+            with _locked(self._fd):
+                sequence = SLOT.unpack_from(mapping, 0)[0] + 1
+                for kind in kinds:
+                    SLOT.pack_into(mapping, SLOT.size * (1 + KINDS.index(kind)), sequence)
+                SLOT.pack_into(mapping, 0, sequence)  # Last, so a reader never sees the sequence before the kinds
+        return sequence
+
+    def sequence(self):
+        """
+        The sequence number of the last change of any kind, or None if the bus is unavailable.
+        """
+        mapping = self._open()
+        return SLOT.unpack_from(mapping, 0)[0] if mapping is not None else None
+
+    def version(self, kind):
+        """
+        The sequence number of the last change of a kind (0 if it never changed), or None if the bus is unavailable.
+        """
+        mapping = self._open()
+        return SLOT.unpack_from(mapping, SLOT.size * (1 + KINDS.index(kind)))[0] if mapping is not None else None
+
+    def versions(self, kinds=KINDS):
+        """
+        Returns {kind: version}, or None if the bus is unavailable.
+        """
+        if self._open() is None:
+            return None
+        return {kind: self.version(kind) for kind in kinds}
+
+    def wait(self, since, timeout, poll_interval=0.1):
+        """
+        Blocks until the sequence differs from since or timeout seconds have passed.
+
+        Returns:
+            int or None: The current sequence number.
+        """
+        deadline = time.monotonic() + timeout
+        sequence = self.sequence()
+        while sequence == since and time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            sequence = self.sequence()
+        return sequence
+
+    def subscribe(self, callback, *kinds):
+        """
+        Calls callback(ChangeEvent) from dispatch for every later change of one of the kinds (all kinds if none given).
+        Several changes of a kind between two dispatch calls are delivered as one event with the latest version.
+        """
+        kinds = kinds or KINDS
+        self._subscribers.append([callback, kinds, self.versions(kinds) or {}])
+
+    def dispatch(self):
+        """
+        Delivers the changes since the last call to the subscribers, including changes made by other processes.
+        """
+        log_ctx = "Change Bus:"
+        for subscriber in self._subscribers:
+            callback, kinds, delivered = subscriber
+            for kind in kinds:
+                version = self.version(kind)
+                if version is None or version == delivered.get(kind):
+                    continue
+                delivered[kind] = version
+                try:
+                    callback(ChangeEvent(kind, version))
+                except Exception as e:
+                    logger.log(log_ctx, f"Subscriber failed on {kind} change", "ERROR", e)
+
+
+class _locked(object):
+    """
+    Exclusive flock on a file descriptor for the duration of a with block.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class CachedValue(object):
+    """
+    Caches the result of load(*key) per key until one of the kinds changes on the bus. Values of the max_keys most
+    recently used keys are kept, e.g. one per tank for a value loaded per device.
+
+    load must return plain data (see shared_db.snapshot), since ORM objects can't be used after their session is
+    closed. If the bus is unavailable, load runs on every get.
+
+    Args:
+        bus (ChangeBus): The bus to watch.
+        load (callable): Loads the value.
+        *kinds (str): Kinds of change that invalidate the value.
+        max_keys (int): Keys whose values are kept.
+    """
+
+    def __init__(self, bus, load, *kinds, max_keys=1):
+        self.bus = bus
+        self.load = load
+        self.kinds = kinds
+        self.max_keys = max_keys
+        self.cached = OrderedDict()  # Key -> (versions, value), least recently used first
+        self.lock = threading.Lock()  # Held for the dict only, not while loading
+
+    def get(self, *key):
+        # The versions are read before loading, so a change committed during the load is picked up next time
+        versions = self.bus.versions(self.kinds)
+        with self.lock:
+            cached = self.cached.get(key)
+            if cached is not None:
+                self.cached.move_to_end(key)
+        if versions is not None and cached is not None and cached[0] == versions:
+            return cached[1]
+        value = self.load(*key)
+        with self.lock:
+            self.cached[key] = (versions, value)
+            self.cached.move_to_end(key)
+            while len(self.cached) > self.max_keys:
+                self.cached.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.cached.clear()
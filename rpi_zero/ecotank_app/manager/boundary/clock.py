@@ -0,0 +1,52 @@
+import time
+from datetime import datetime, timedelta
+
+
+class SystemClock(object):
+    """
+    Wall clock used by the manager classes. Wraps datetime/time so the time source can be swapped
+    with a SimulatedClock when running the control stack against the tank simulator.
+    """
+
+    def now(self):
+        return datetime.now()
+
+    def today(self):
+        return self.now().date()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock(SystemClock):
+    """
+    Clock for simulations. Time only moves when sleep() or advance() is called,
+    so a simulated week can be run as fast as the code under test allows.
+
+    Args:
+        start (datetime): The simulated time to start at.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0  # Simulated seconds since start
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.elapsed += seconds
+
+
+# Create a global instance, used when no clock is injected
+system_clock = SystemClock()
@@ -0,0 +1,238 @@
+"""
+Online backups of the SQLite database while both processes keep using it.
+
+A snapshot is taken with SQLite's backup API, pages_per_step pages at a time, with step_pause seconds between steps.
+In WAL mode (see shared_db.create_database) the copy runs in one read transaction: it copies a consistent
+snapshot while writers carry on appending to the WAL, so commits are never blocked. In rollback journal mode each
+step holds a read lock only while it copies its pages, so a writer waiting to commit is delayed by at most one
+step, but every commit by another connection makes SQLite restart the copy. After max_restarts restarts the rest
+is copied in a single step, holding the lock for the whole copy, so a busy database is still backed up.
+
+The copy is checked with PRAGMA quick_check, then gzip compressed to <directory>/database-<YYYYmmdd-HHMMSS>.db.gz,
+and only the newest `keep` snapshots are kept.
+
+A restore goes through the backup API the other way, into the live file, in a single step: SQLite keeps the
+destination locked until the copy is complete anyway, and the running processes never see a half-written database.
+The current database is snapshotted first.
+"""
+import gzip
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from .logger import logger
+from .clock import system_clock
+
+SNAPSHOT_PREFIX = "database-"
+SNAPSHOT_SUFFIX = ".db.gz"
+SNAPSHOT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+BackupResult = namedtuple(
+    "BackupResult", ["path", "size", "compressed_size", "duration", "max_lock", "steps", "restarts"]
+)
+
+
+class DatabaseBackup(object):
+    """
+    Takes, rotates and restores compressed snapshots of a SQLite database.
+
+    Args:
+        db_path (str): The live database.
+        directory (str): Where the snapshots are kept. Created on the first backup.
+        keep (int): Number of snapshots to keep.
+        interval_hours (float): Hours between scheduled backups, see update. 0 disables them.
+        pages_per_step (int): Pages copied per backup step, i.e. per lock hold.
+        step_pause (float): Seconds between steps, in which writers get the lock.
+        max_restarts (int): Restarts after which a rollback journal database is copied in a single step.
+        clock (SystemClock, optional): Time source for the schedule and the snapshot names, defaults to the wall clock.
+    """
+
+    def __init__(
+        self, db_path, directory, keep=7, interval_hours=24.0, pages_per_step=64, step_pause=0.005, max_restarts=10, clock=None
+    ):
+        self.db_path = db_path
+        self.directory = directory
+        self.keep = keep
+        self.interval = timedelta(hours=interval_hours)
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+        self.max_restarts = max_restarts
+        self.clock = clock if clock is not None else system_clock
+        self.next_backup = None
+
+    def snapshots(self):
+        """
+        Returns (time taken, path) of the snapshots, oldest first.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+                try:
+                    taken = datetime.strptime(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)], SNAPSHOT_TIME_FORMAT)
+                except ValueError:
+                    continue
+                snapshots.append((taken, os.path.join(self.directory, name)))
+        return sorted(snapshots)
+
+    def update(self):
+        """
+        Takes a backup if interval_hours have passed since the newest snapshot. Cheap to call every loop iteration.
+        Errors are logged, never raised, so a full disk can't stop the caller.
+        """
+        log_ctx = "Database Backup:"
+        if not self.interval:
+            return
+        now = self.clock.now()
+        if self.next_backup is None:
+            snapshots = self.snapshots()
+            # Scheduled from the newest snapshot, so restarting the manager doesn't postpone the backups
+            self.next_backup = snapshots[-1][0] + self.interval if snapshots else now
+        if now < self.next_backup:
+            return
+        self.next_backup = now + self.interval
+        try:
+            self.backup()
+        except Exception as e:
+            logger.log(log_ctx, "Backup failed", "ERROR", e)
+
+    def backup(self):
+        """
+        Takes a snapshot now and removes the snapshots beyond keep.
+
+        Returns:
+            BackupResult: The snapshot path, its raw and compressed size in bytes, the duration and longest step
+            (the longest lock hold in rollback journal mode) in seconds, and the number of steps and restarts.
+
+        Raises:
+            sqlite3.Error: If the copy fails or doesn't pass the integrity check.
+            OSError: If the snapshot can't be written.
+        """
+        log_ctx = "Database Backup:"
+        os.makedirs(self.directory, exist_ok=True)
+        taken = self.clock.now().replace(microsecond=0)
+        path = os.path.join(self.directory, f"{SNAPSHOT_PREFIX}{taken.strftime(SNAPSHOT_TIME_FORMAT)}{SNAPSHOT_SUFFIX}")
+
+        fd, copy_path = tempfile.mkstemp(suffix=".db", dir=self.directory)
+        os.close(fd)
+        try:
+            start = time.perf_counter()
+            steps, restarts, max_lock = self._copy(self.db_path, copy_path, self.pages_per_step)
+            size = os.path.getsize(copy_path)
+            self._check(copy_path)
+            partial_path = path + ".partial"
+            with open(copy_path, "rb") as source, gzip.open(partial_path, "wb", compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.replace(partial_path, path)  # Never leaves a truncated snapshot under a snapshot name
+            duration = time.perf_counter() - start
+        finally:
+            os.remove(copy_path)
+
+        result = BackupResult(path, size, os.path.getsize(path), duration, max_lock, steps, restarts)
+        logger.log(
+            log_ctx,
+            f"Wrote {os.path.basename(path)}: {size // 1024} KiB, {result.compressed_size // 1024} KiB compressed, "
+            f"in {duration:.2f} s, {steps} steps, longest step {max_lock * 1000:.1f} ms, {restarts} restarts",
+        )
+        self.rotate()
+        return result
+
+    def _copy(self, source_path, target_path, pages):
+        """
+        Copies source to target with the backup API in steps of pages pages (-1 for all at once), pausing between them.
+
+        Returns:
+            tuple: (steps, restarts, longest step in seconds)
+        """
+        stats = {"steps": 0, "restarts": 0, "max_lock": 0.0, "remaining": None, "limited": True}
+
+        def progress(status, remaining, total):
+            # Called right after each step, before the next one takes the lock again
+            held = time.perf_counter() - stats["step_start"]
+            stats["max_lock"] = max(stats["max_lock"], held)
+            stats["steps"] += 1
+            if stats["remaining"] is not None and remaining > stats["remaining"]:
+                stats["restarts"] += 1  # Another connection wrote to the database, SQLite started over
+                if stats["limited"] and stats["restarts"] > self.max_restarts:
+                    raise _TooManyRestarts()
+            stats["remaining"] = remaining
+            if remaining and self.step_pause:
+                time.sleep(self.step_pause)
+            stats["step_start"] = time.perf_counter()
+
+        source = sqlite3.connect(source_path, isolation_level=None)
+        target = sqlite3.connect(target_path)
+        try:
+            if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+                # Pins a snapshot for all steps, so the copy is consistent and never restarts
+                source.execute("BEGIN")
+                source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            stats["step_start"] = time.perf_counter()
+            try:
+                source.backup(target, pages=pages, progress=progress)
+            except _TooManyRestarts:
+                stats["limited"] = False
+                stats["step_start"] = time.perf_counter()
+                source.backup(target, pages=-1, progress=progress)
+        finally:
+            target.close()
+            source.close()
+        return stats["steps"], stats["restarts"], stats["max_lock"]
+
+    @staticmethod
+    def _check(path):
+        connection = sqlite3.connect(path)
+        try:
+            result = connection.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            connection.close()
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"Snapshot failed the integrity check: {result}")
+
+    def rotate(self):
+        """
+        Removes the oldest snapshots beyond keep.
+        """
+        log_ctx = "Database Backup:"
+        snapshots = self.snapshots()
+        for _, path in snapshots[: max(len(snapshots) - self.keep, 0)]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.log(log_ctx, f"Could not remove {path}", "WARNING", e)
+
+    def restore(self, snapshot_path):
+        """
+        Replaces the contents of the live database with a snapshot, after taking a snapshot of the current contents.
+        Connections of the running processes stay valid and see the restored data from their next transaction;
+        values they cached must be invalidated by the caller, e.g. by publishing every kind on the change bus.
+
+        Args:
+            snapshot_path (str): A .db.gz snapshot, or an uncompressed database file.
+
+        Returns:
+            BackupResult: The snapshot taken of the database before the restore.
+        """
+        log_ctx = "Database Backup:"
+        fd, copy_path = tempfile.mkstemp(suffix=".db", dir=os.path.dirname(os.path.abspath(self.db_path)))
+        os.close(fd)
+        try:
+            opener = gzip.open if snapshot_path.endswith(".gz") else open
+            with opener(snapshot_path, "rb") as source, open(copy_path, "wb") as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            self._check(copy_path)
+            # Made after the check, so a bad snapshot doesn't push a good one out of the rotation
+            previous = self.backup()
+            self._copy(copy_path, self.db_path, -1)
+        finally:
+            os.remove(copy_path)
+        logger.log(log_ctx, f"Restored {snapshot_path}, the previous contents are in {previous.path}", "WARNING")
+        return previous
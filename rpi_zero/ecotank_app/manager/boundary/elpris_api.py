@@ -1,6 +1,7 @@
 import requests
-from datetime import datetime
+from datetime import date, timedelta
 from ..boundary.logger import logger
+from ..boundary.clock import system_clock
 
 
 class ElprisAPI:
@@ -10,7 +11,8 @@ class ElprisAPI:
     Has a rate limit built in to prevent spamming the API - this can be adjusted as needed.
     """
 
-    def __init__(self):
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else system_clock
         self.url = "https://www.elprisenligenu.dk/api/v1/prices/"
         self.last_fetch_at = None
         self.rate_limit = 1  # Rate limit in seconds
@@ -47,7 +49,7 @@ class ElprisAPI:
             response = requests.get(f"{self.url}{year}/{month}-{day}_{region}.json")
             response.raise_for_status()  # Raise an exception if we get an error response
 
-            self.last_fetch_at = datetime.now()  # Update the last fetch time
+            self.last_fetch_at = self.clock.now()  # Update the last fetch time
             return response.json()  # Return the JSON data
         except requests.RequestException as e:
             logger.log(log_ctx, "Error fetching data from API", "WARNING", e)
@@ -62,6 +64,39 @@ class ElprisAPI:
             bool: True if data can be fetched, False otherwise.
         """
         if self.last_fetch_at is not None:
-            time_since_last_fetch = datetime.now() - self.last_fetch_at
+            time_since_last_fetch = self.clock.now() - self.last_fetch_at
             return time_since_last_fetch.total_seconds() >= self.rate_limit
         return True
+
+
+class ReplayElprisAPI(object):
+    """
+    Stand-in for ElprisAPI that serves recorded prices instead of calling the live API.
+    Used by the simulator to replay historical prices against the control stack.
+
+    Like the real API, a day is only available once it is published: today and earlier,
+    and tomorrow after 13:00 (according to the injected clock).
+
+    Args:
+        prices (dict): Maps (region, date) to a list of price dicts in the API's JSON format.
+        clock (SystemClock, optional): Time source, defaults to the wall clock.
+    """
+
+    publish_hour = 13
+
+    def __init__(self, prices, clock=None):
+        self.prices = prices
+        self.clock = clock if clock is not None else system_clock
+        self.fetch_count = 0
+
+    def fetch_elpris(self, year, month, day, region):
+        """
+        Same signature and return value as ElprisAPI.fetch_elpris.
+        """
+        requested = date(int(year), int(month), int(day))
+        now = self.clock.now()
+        published_until = now.date() + timedelta(days=1 if now.hour >= self.publish_hour else 0)
+        if requested > published_until:
+            return None
+        self.fetch_count += 1
+        return self.prices.get((region, requested))
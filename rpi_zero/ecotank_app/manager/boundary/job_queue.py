@@ -0,0 +1,295 @@
+"""
+Runs expensive computations, like building the dashboard's Bokeh chart, in a small pool of worker processes, so they
+don't hold the webserver's GIL while other requests wait, and caches their results.
+
+A job is a module level function and its arguments, which must all be picklable. Results are cached per function
+and arguments, together with the change bus versions of the kinds of change the result depends on (see
+change_bus.py):
+    - get returns a cached result as it is while those versions are unchanged and it is younger than ttl.
+    - A result whose versions changed, or that is older than ttl, is stale. get returns it at once and recomputes it
+      in the background (stale-while-revalidate), until it is older than max_stale. Inline (see below) the new
+      result is returned, since the caller waited for it anyway.
+    - Without a usable result, get waits for the job, up to a timeout.
+At most one job runs per function and arguments: a caller asking while one is queued or running gets its future,
+even if the versions changed since it started. Its result is then stored as stale and recomputed on the next get,
+so announcing changes faster than the job runs doesn't pile up jobs. The least recently used results beyond
+max_entries are dropped.
+
+There is no broker: the pool and the cache belong to the process that created the queue. The pool is started by
+the first job and shut down again once no job ran for idle_timeout seconds, so the workers only take memory while
+pages that need them are being used. With workers=0 jobs run in the calling thread, which is how memory_check.py
+traces their allocations.
+"""
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from .logger import logger
+
+FRESH = "fresh"  # Computed for the current versions, within ttl
+STALE = "stale"  # Outdated, being recomputed
+PENDING = "pending"  # Not computed yet, still running when the timeout passed
+
+JobResult = namedtuple("JobResult", ["value", "state", "age"])
+
+
+class _Job(object):
+    __slots__ = ("key", "kinds", "versions", "future", "started")
+
+    def __init__(self, key, kinds, versions):
+        self.key = key
+        self.kinds = kinds
+        self.versions = versions
+        self.future = Future()
+        self.started = time.monotonic()
+
+
+class _Result(object):
+    __slots__ = ("value", "kinds", "versions", "started", "finished", "duration", "hits")
+
+    def __init__(self, job, value, duration):
+        self.value = value
+        self.kinds = job.kinds
+        self.versions = job.versions
+        self.started = job.started
+        self.finished = time.monotonic()
+        self.duration = duration
+        self.hits = 0
+
+
+def _timed(function, args):
+    # Runs in the worker, so the duration doesn't include the time the job was queued
+    start = time.perf_counter()
+    value = function(*args)
+    return value, time.perf_counter() - start
+
+
+def job_name(function):
+    return f"{function.__module__}.{function.__qualname__}"
+
+
+class JobQueue(object):
+    """
+    A process pool with deduplication of identical jobs and a versioned result cache.
+
+    Args:
+        bus (ChangeBus): The bus whose versions key the results.
+        workers (int): Worker processes, started with the first job. 0 runs jobs in the calling thread.
+        idle_timeout (float, optional): Seconds without jobs after which the workers are stopped, None to keep them.
+        max_entries (int): Results kept.
+        ttl (float): Seconds a result is fresh, for inputs that aren't announced on the bus.
+        max_stale (float): Seconds after which a result is no longer returned while it is recomputed.
+        initializer (callable, optional): Run in each worker process before its first job, e.g. to open the
+            same database as the caller.
+        initargs (tuple): Arguments of initializer.
+    """
+
+    def __init__(self, bus, workers=1, idle_timeout=300.0, max_entries=32, ttl=600.0, max_stale=86400.0, initializer=None, initargs=()):
+        self.bus = bus
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.initializer = initializer
+        self.initargs = initargs
+        self._pool = None
+        self._idle_timer = None  # Stops the pool, while no job is queued or running
+        self._running = {}  # Key -> _Job queued or running for the key
+        self._results = OrderedDict()  # Key -> _Result, least recently used first
+        self._counters = dict.fromkeys(
+            ("submitted", "deduplicated", "hits", "stale", "misses", "timeouts", "completed", "failed"), 0
+        )
+        self._busy_seconds = 0.0
+        self._last_error = None
+        self._lock = threading.Lock()
+
+    def _versions(self, kinds):
+        versions = self.bus.versions(kinds) if kinds else {}
+        # An unavailable bus means "always changed", like CachedValue
+        return tuple(sorted(versions.items())) if versions is not None else None
+
+    def _executor(self):
+        # Called with the lock held
+        if self._pool is None:
+            # Spawned, not forked: forking the threaded webserver could copy a lock held by another thread
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer,
+                initargs=self.initargs,
+            )
+        return self._pool
+
+    def submit(self, function, *args, kinds=()):
+        """
+        Starts function(*args) for the current versions of kinds, unless it is already queued or running.
+
+        Returns:
+            Future: The job's result.
+        """
+        return self._submit(function, args, kinds, self._versions(kinds)).future
+
+    def _submit(self, function, args, kinds, versions):
+        key = (job_name(function), args)
+        with self._lock:
+            job = self._running.get(key)
+            if job is not None:
+                self._counters["deduplicated"] += 1
+                return job
+            job = _Job(key, kinds, versions)
+            self._running[key] = job
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+            self._counters["submitted"] += 1
+            pool = self._executor() if self.workers > 0 else None
+
+        # Outside the lock, which _finished takes
+        if pool is not None:
+            try:
+                done = pool.submit(_timed, function, args)
+            except (BrokenProcessPool, RuntimeError) as e:  # RuntimeError once the pool is shut down
+                done = Future()
+                done.set_exception(e)
+            done.add_done_callback(lambda done: self._finished(job, done))
+            return job
+
+        done = Future()
+        try:
+            done.set_result(_timed(function, args))
+        except Exception as e:
+            done.set_exception(e)
+        self._finished(job, done)
+        return job
+
+    def _finished(self, job, done):
+        error = CancelledError() if done.cancelled() else done.exception()
+        with self._lock:
+            if self._running.get(job.key) is job:
+                del self._running[job.key]
+            if error is not None:
+                self._counters["failed"] += 1
+                self._last_error = f"{job.key[0]}: {error!r}"
+                if isinstance(error, BrokenProcessPool) and self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                    self._pool = None  # A new pool is started with the next job
+            else:
+                value, duration = done.result()
+                self._counters["completed"] += 1
+                self._busy_seconds += duration
+                self._results[job.key] = _Result(job, value, duration)
+                self._results.move_to_end(job.key)
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+            if not self._running and self._pool is not None and self.idle_timeout is not None:
+                self._idle_timer = threading.Timer(self.idle_timeout, self._stop_idle)
+                self._idle_timer.daemon = True
+                self._idle_timer.start()
+        if error is None:
+            job.future.set_result(value)
+        else:
+            if not isinstance(error, CancelledError):
+                logger.log("Job Queue:", f"Job {job.key[0]} failed", "ERROR", error)
+            job.future.set_exception(error)
+
+    def _stop_idle(self):
+        with self._lock:
+            if self._running or self._idle_timer is None or threading.current_thread() is not self._idle_timer:
+                return  # A job was submitted since the timer started
+            self._idle_timer = None
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def get(self, function, *args, kinds=(), timeout=30.0):
+        """
+        The result of function(*args) for the current versions of kinds, see the module docstring.
+
+        Args:
+            function (callable): A module level function.
+            *args: Its arguments.
+            kinds (tuple): Kinds of change the result depends on.
+            timeout (float): Seconds to wait if there is no usable result yet.
+
+        Returns:
+            JobResult: The value, FRESH, STALE or PENDING (value None), and the age of the value in seconds.
+
+        Raises:
+            Exception: Whatever the job raised, if there was no usable result to return instead.
+        """
+        key = (job_name(function), args)
+        versions = self._versions(kinds)
+        now = time.monotonic()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None and now - result.finished > self.max_stale:
+                del self._results[key]
+                result = None
+            if result is None:
+                self._counters["misses"] += 1
+            else:
+                self._results.move_to_end(key)
+                result.hits += 1
+                age = now - result.finished
+                if versions is not None and result.versions == versions and age < self.ttl:
+                    self._counters["hits"] += 1
+                    return JobResult(result.value, FRESH, age)
+                self._counters["stale"] += 1
+
+        job = self._submit(function, args, kinds, versions)
+        if result is not None and self.workers > 0:
+            return JobResult(result.value, STALE, age)
+        try:
+            value = job.future.result(timeout)
+        except TimeoutError:
+            with self._lock:
+                self._counters["timeouts"] += 1
+            return JobResult(None, PENDING, None)
+        # The job may have been started for older versions, see the module docstring
+        return JobResult(value, FRESH if versions is not None and job.versions == versions else STALE, 0.0)
+
+    def status(self):
+        """
+        Pool state, running jobs, cached results and counters, for the status page.
+        """
+        now = time.monotonic()
+        with self._lock:
+            running = [
+                {"job": job.key[0], "args": repr(job.key[1]), "seconds": round(now - job.started, 3)}
+                for job in self._running.values()
+            ]
+            results = [
+                {
+                    "job": key[0],
+                    "args": repr(key[1]),
+                    "age": round(now - result.finished, 3),
+                    "duration": round(result.duration, 3),
+                    "hits": result.hits,
+                    "current": result.versions is not None and result.versions == self._versions(result.kinds),
+                }
+                for key, result in reversed(self._results.items())
+            ]
+            return {
+                "workers": self.workers,
+                "pool": "inline" if self.workers == 0 else ("started" if self._pool is not None else "not started"),
+                "running": running,
+                "results": results,
+                "counters": dict(self._counters),
+                "busy_seconds": round(self._busy_seconds, 3),
+                "last_error": self._last_error,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker processes. Jobs submitted afterwards start a new pool.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+                self._idle_timer = None
+        if pool is not None:
+            pool.shutdown(wait=wait, cancel_futures=True)
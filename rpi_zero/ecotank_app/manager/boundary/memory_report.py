@@ -0,0 +1,118 @@
+import threading
+import time
+import tracemalloc
+from os import environ
+from .logger import logger
+
+
+def rss_kib():
+    """
+    Returns (current RSS, peak RSS) of this process in KiB, from /proc/self/status.
+    Falls back to getrusage (peak only) where /proc is not available.
+    """
+    current = peak = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return current, peak
+
+
+class MemoryReporter(object):
+    """
+    Periodically logs the RSS and peak RSS of the process, and with tracemalloc enabled also the traced Python
+    heap, its peak and the biggest allocation sites since the last report.
+
+    Configured through the environment:
+        ECOTANK_MEMORY_REPORT: Seconds between reports, 0 (default) disables reporting.
+        ECOTANK_TRACEMALLOC: Number of frames tracemalloc stores per allocation, 0 (default) disables it.
+            Tracing costs memory and CPU itself, so only enable it while investigating.
+
+    Args:
+        process_name (str): Name used in the log lines, e.g. "manager" or "webserver".
+        interval (float): Seconds between reports.
+        trace_frames (int): Frames per allocation for tracemalloc, 0 to leave it off.
+        top (int): Number of allocation sites to log per report.
+    """
+
+    def __init__(self, process_name, interval, trace_frames=0, top=5):
+        self.process_name = process_name
+        self.interval = interval
+        self.trace_frames = trace_frames
+        self.top = top
+        self.previous_snapshot = None
+        self.thread = None
+
+    def report(self):
+        """
+        Returns the current figures as a dict of KiB values (None where unavailable).
+        """
+        current, peak = rss_kib()
+        result = {"rss_kib": current, "peak_rss_kib": peak, "traced_kib": None, "traced_peak_kib": None}
+        if tracemalloc.is_tracing():
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            result["traced_kib"] = traced // 1024
+            result["traced_peak_kib"] = traced_peak // 1024
+        return result
+
+    def log_report(self):
+        log_ctx = "Memory Report:"
+        result = self.report()
+        message = f"{self.process_name}: RSS {result['rss_kib']} KiB, peak {result['peak_rss_kib']} KiB"
+        if result["traced_kib"] is not None:
+            message += f", traced {result['traced_kib']} KiB, traced peak {result['traced_peak_kib']} KiB"
+        logger.log(log_ctx, message)
+
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap>"))
+            )
+            if self.previous_snapshot is not None:
+                statistics = snapshot.compare_to(self.previous_snapshot, "lineno")
+            else:
+                statistics = snapshot.statistics("lineno")
+            for statistic in statistics[:self.top]:
+                logger.log(log_ctx, f"{self.process_name}: {statistic}", level="DEBUG")
+            self.previous_snapshot = snapshot
+
+    def start(self):
+        """
+        Starts tracemalloc if configured and logs a report every interval seconds from a daemon thread.
+        """
+        if self.trace_frames > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+        self.thread = threading.Thread(target=self._run, name="memory-report", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.log_report()
+
+
+def start_memory_reporter(process_name):
+    """
+    Starts a MemoryReporter configured from the environment, if ECOTANK_MEMORY_REPORT is set.
+
+    Returns:
+        MemoryReporter or None: The started reporter, or None if reporting is disabled.
+    """
+    try:
+        interval = float(environ.get("ECOTANK_MEMORY_REPORT", "0"))
+        trace_frames = int(environ.get("ECOTANK_TRACEMALLOC", "0"))
+    except ValueError:
+        logger.log("Memory Report:", "Invalid ECOTANK_MEMORY_REPORT or ECOTANK_TRACEMALLOC, reporting disabled", "WARNING")
+        return None
+    if interval <= 0:
+        return None
+    reporter = MemoryReporter(process_name, interval, trace_frames)
+    reporter.start()
+    logger.log("Memory Report:", f"Reporting {process_name} memory every {interval:g} s")
+    return reporter
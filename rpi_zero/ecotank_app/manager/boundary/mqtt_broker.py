@@ -0,0 +1,230 @@
+"""
+In-process stand-in for an MQTT broker such as mosquitto, for trying the telemetry publisher (see
+telemetry_publisher.py under "control") without one, e.g. in mqtt_bench.py.
+
+It speaks the same subset of MQTT 3.1.1 as mqtt_client.py: QoS 0 and 1, retained messages, wills, the + and #
+wildcards and pings. Every client gets a thread. Retained messages survive stop and start, as with a broker that
+persists them, so an outage can be simulated by stopping and restarting the broker on the same port.
+"""
+import socket
+import struct
+import threading
+from .mqtt_client import (
+    CONNACK,
+    CONNECT,
+    DISCONNECT,
+    PINGREQ,
+    PINGRESP,
+    PUBACK,
+    PUBLISH,
+    SUBACK,
+    SUBSCRIBE,
+    Message,
+    PacketReader,
+    decode_publish,
+    decode_string,
+    encode_packet,
+    encode_publish,
+)
+from .logger import logger
+
+
+def topic_matches(topic_filter, topic):
+    """
+    True if topic matches topic_filter, with + matching one level and # the rest.
+    """
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.client_id = None
+        self.will = None
+        self.filters = {}  # Topic filter -> granted QoS
+        self.next_id = 0
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def deliver(self, message):
+        packet_id = None
+        if message.qos:
+            self.next_id = self.next_id % 65535 + 1
+            packet_id = self.next_id
+        self.send(encode_publish(message, packet_id))
+
+
+class LocalBroker(object):
+    """
+    A broker listening on host and port (0 picks a free port, see the port attribute once started).
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on.
+        username (str, optional): If set, clients must log in with it and password.
+        password (str, optional): Password of username.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, username=None, password=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.retained = {}  # Topic -> Message
+        self.published = []  # Every Message published by a client, in order
+        self.sessions = []
+        self.server = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts listening in a background thread.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen()
+        self.port = server.getsockname()[1]
+        self.server = server
+        threading.Thread(target=self._accept, args=(server,), name="mqtt-broker", daemon=True).start()
+        return self
+
+    def stop(self):
+        """
+        Closes the listening socket and drops every client, like a broker going down.
+        """
+        with self.lock:
+            server, self.server = self.server, None
+            sessions, self.sessions = self.sessions, []
+        if server is not None:
+            server.close()
+        for session in sessions:
+            session.will = None  # The broker is gone, so nobody would receive it
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            session.sock.close()
+
+    def clients(self):
+        """
+        Client identifiers of the connected clients.
+        """
+        with self.lock:
+            return [session.client_id for session in self.sessions]
+
+    def _accept(self, server):
+        while True:
+            try:
+                sock, _ = server.accept()
+            except OSError:
+                return  # Stopped
+            session = _Session(sock)
+            with self.lock:
+                if self.server is not server:
+                    sock.close()
+                    return
+                self.sessions.append(session)
+            threading.Thread(target=self._serve, args=(session,), name="mqtt-broker-client", daemon=True).start()
+
+    def _serve(self, session):
+        reader = PacketReader()
+        clean = False
+        try:
+            while True:
+                data = session.sock.recv(65536)
+                if not data:
+                    break
+                for packet_type, flags, body in reader.feed(data):
+                    if packet_type == DISCONNECT:
+                        clean = True
+                        return
+                    if not self._handle(session, packet_type, flags, body):
+                        return
+        except (OSError, ValueError, struct.error) as e:
+            if self.server is not None:
+                logger.log("Local Broker:", f"Dropping client {session.client_id}", "DEBUG", e)
+        finally:
+            with self.lock:
+                if session in self.sessions:
+                    self.sessions.remove(session)
+            session.sock.close()
+            if not clean and session.will is not None:
+                self._route(session.will)
+
+    def _handle(self, session, packet_type, flags, body):
+        if packet_type == CONNECT:
+            _, offset = decode_string(body, 0)
+            connect_flags = body[offset + 1]
+            session.client_id, offset = decode_string(body, offset + 4)
+            if connect_flags & 0x04:
+                topic, offset = decode_string(body, offset)
+                (length,) = struct.unpack_from("!H", body, offset)
+                payload = body[offset + 2:offset + 2 + length]
+                offset += 2 + length
+                session.will = Message(topic, payload, (connect_flags >> 3) & 0x03, bool(connect_flags & 0x20))
+            username = password = None
+            if connect_flags & 0x80:
+                username, offset = decode_string(body, offset)
+            if connect_flags & 0x40:
+                password, offset = decode_string(body, offset)
+            if self.username is not None and (username, password) != (self.username, self.password):
+                session.send(encode_packet(CONNACK, 0, bytes([0, 4])))
+                return False
+            session.send(encode_packet(CONNACK, 0, bytes([0, 0])))
+        elif packet_type == PUBLISH:
+            message, packet_id = decode_publish(flags, body)
+            if message.qos:
+                session.send(encode_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+            self._route(message)
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            granted = bytearray()
+            retained = []
+            while offset < len(body):
+                topic_filter, offset = decode_string(body, offset)
+                qos = min(body[offset], 1)
+                offset += 1
+                session.filters[topic_filter] = qos
+                granted.append(qos)
+                with self.lock:
+                    retained += [
+                        message._replace(qos=min(message.qos, qos))
+                        for topic, message in self.retained.items()
+                        if topic_matches(topic_filter, topic)
+                    ]
+            session.send(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+            for message in retained:
+                session.deliver(message)
+        elif packet_type == PINGREQ:
+            session.send(encode_packet(PINGRESP, 0, b""))
+        return True  # PUBACKs from clients need no answer
+
+    def _route(self, message):
+        with self.lock:
+            self.published.append(message)
+            if message.retain:
+                if message.payload:
+                    self.retained[message.topic] = message
+                else:
+                    self.retained.pop(message.topic, None)
+            sessions = list(self.sessions)
+        for session in sessions:
+            qos = max((qos for topic_filter, qos in session.filters.items() if topic_matches(topic_filter, message.topic)), default=None)
+            if qos is None:
+                continue
+            try:
+                # Retain is only set on messages sent because of a new subscription
+                session.deliver(message._replace(qos=min(message.qos, qos), retain=False))
+            except OSError:
+                pass  # Its own thread drops the session
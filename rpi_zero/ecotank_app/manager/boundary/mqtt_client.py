@@ -0,0 +1,313 @@
+"""
+A small MQTT 3.1.1 client, enough to publish telemetry and receive commands: QoS 0 and 1, retained messages, a
+last will, subscriptions and keepalive pings. QoS 2 is not supported.
+
+The client does no threading of its own. The owner calls poll regularly, which reads incoming packets, answers
+them and sends the keepalive pings, and returns the messages received on the subscriptions. publish writes a whole
+batch of messages with a single send. A lost connection raises ConnectionError (an OSError) from poll or publish;
+the owner then closes the client, connects again, and can resend the QoS 1 messages that weren't acknowledged
+(see unacknowledged).
+
+The packet encoding is shared with the stand-in broker in mqtt_broker.py.
+"""
+import select
+import socket
+import struct
+import time
+from collections import OrderedDict, namedtuple
+
+# Control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+Message = namedtuple("Message", ["topic", "payload", "qos", "retain"])
+
+CONNACK_CODES = {
+    1: "unacceptable protocol version",
+    2: "client identifier rejected",
+    3: "server unavailable",
+    4: "bad user name or password",
+    5: "not authorized",
+}
+
+
+def encode_packet(packet_type, flags, body):
+    """
+    Fixed header (type, flags and the variable length encoded remaining length) followed by body.
+    """
+    header = bytearray([packet_type << 4 | flags])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def encode_string(value):
+    data = value.encode("utf-8") if isinstance(value, str) else value
+    return struct.pack("!H", len(data)) + data
+
+
+def decode_string(body, offset):
+    """
+    Returns (string, offset after it).
+    """
+    (length,) = struct.unpack_from("!H", body, offset)
+    return body[offset + 2:offset + 2 + length].decode("utf-8"), offset + 2 + length
+
+
+def encode_publish(message, packet_id=None, dup=False):
+    flags = (dup << 3) | (message.qos << 1) | bool(message.retain)
+    payload = message.payload.encode("utf-8") if isinstance(message.payload, str) else message.payload
+    body = encode_string(message.topic)
+    if message.qos:
+        body += struct.pack("!H", packet_id)
+    return encode_packet(PUBLISH, flags, body + payload)
+
+
+def decode_publish(flags, body):
+    """
+    Returns (Message with the payload as bytes, packet id or None).
+    """
+    qos = (flags >> 1) & 0x03
+    topic, offset = decode_string(body, 0)
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from("!H", body, offset)
+        offset += 2
+    return Message(topic, bytes(body[offset:]), qos, bool(flags & 0x01)), packet_id
+
+
+class PacketReader(object):
+    """
+    Splits a byte stream into (packet type, flags, body) tuples.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received bytes and returns the packets that are now complete.
+        """
+        self.buffer += data
+        packets = []
+        while len(self.buffer) >= 2:
+            length, multiplier, position = 0, 1, 1
+            while True:
+                if position >= len(self.buffer):
+                    return packets  # The length itself isn't complete yet
+                byte = self.buffer[position]
+                length += (byte & 0x7F) * multiplier
+                multiplier *= 128
+                position += 1
+                if not byte & 0x80:
+                    break
+                if position > 4:
+                    raise ConnectionError("Malformed MQTT packet length")
+            if len(self.buffer) < position + length:
+                return packets
+            packets.append((self.buffer[0] >> 4, self.buffer[0] & 0x0F, bytes(self.buffer[position:position + length])))
+            del self.buffer[:position + length]
+        return packets
+
+
+class MqttClient(object):
+    """
+    Connection to an MQTT broker, see the module docstring.
+
+    Args:
+        host (str): Broker address.
+        port (int): Broker port.
+        client_id (str): Client identifier, unique per broker.
+        username (str, optional): User name, if the broker requires one.
+        password (str, optional): Password of username.
+        keepalive (int): Seconds; a ping is sent when nothing was sent for half of this.
+        will (Message, optional): Published by the broker if the connection is lost without disconnect.
+        timeout (float): Seconds to wait for the connection and for a send to complete.
+    """
+
+    def __init__(self, host, port=1883, client_id="ecotank", username=None, password=None, keepalive=60, will=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.will = will
+        self.timeout = timeout
+        self.sock = None
+        self.reader = PacketReader()
+        self.inflight = OrderedDict()  # Packet id -> QoS 1 Message not acknowledged yet
+        self.next_id = 0
+        self.last_sent = 0.0
+        self.ping_sent = None  # When the unanswered ping was sent
+        self.refused_subscriptions = 0
+
+    def __repr__(self):
+        return f"MqttClient({self.host}:{self.port})"
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    def connect(self):
+        """
+        Opens the connection and waits for the broker to accept it.
+
+        Raises:
+            OSError: If the broker can't be reached, or ConnectionRefusedError if it refuses the connection.
+        """
+        flags = 0x02  # Clean session: the publisher republishes its state on every connect
+        payload = encode_string(self.client_id)
+        if self.will is not None:
+            flags |= 0x04 | (self.will.qos << 3) | (bool(self.will.retain) << 5)
+            payload += encode_string(self.will.topic) + encode_string(self.will.payload)
+        if self.username is not None:
+            flags |= 0x80
+            payload += encode_string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+        body = encode_string("MQTT") + bytes([4, flags]) + struct.pack("!H", self.keepalive) + payload
+
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.sendall(encode_packet(CONNECT, 0, body))
+            reader = PacketReader()
+            deadline = time.monotonic() + self.timeout
+            packets = []
+            while not packets:
+                sock.settimeout(max(deadline - time.monotonic(), 0.001))
+                data = sock.recv(4096)
+                if not data:
+                    raise ConnectionError("Connection closed by the broker")
+                packets = reader.feed(data)
+            packet_type, _, body = packets[0]
+            if packet_type != CONNACK or len(body) < 2:
+                raise ConnectionError(f"Expected CONNACK, got packet type {packet_type}")
+            if body[1]:
+                raise ConnectionRefusedError(f"Broker refused the connection: {CONNACK_CODES.get(body[1], body[1])}")
+            sock.settimeout(self.timeout)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        self.reader = reader
+        self.last_sent = time.monotonic()
+        self.ping_sent = None
+
+    def close(self):
+        """
+        Drops the connection without DISCONNECT, so the broker publishes the will.
+        """
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    def disconnect(self):
+        """
+        Closes the connection cleanly; the broker discards the will.
+        """
+        if self.sock is not None:
+            try:
+                self._send(encode_packet(DISCONNECT, 0, b""))
+            except OSError:
+                pass
+            self.close()
+
+    def _send(self, data):
+        if self.sock is None:
+            raise ConnectionError("Not connected")
+        self.sock.sendall(data)
+        self.last_sent = time.monotonic()
+
+    def _packet_id(self, reserved=()):
+        for _ in range(65535):
+            self.next_id = self.next_id % 65535 + 1
+            if self.next_id not in self.inflight and self.next_id not in reserved:
+                return self.next_id
+        raise ConnectionError("No free MQTT packet identifiers")
+
+    def publish(self, messages, dup=False):
+        """
+        Sends the messages in a single write. QoS 1 messages are kept until the broker acknowledges them; if the
+        write fails, none of them are, and the caller decides what to send again.
+        """
+        data = []
+        sent = {}
+        for message in messages:
+            packet_id = None
+            if message.qos:
+                packet_id = self._packet_id(sent)
+                sent[packet_id] = message
+            data.append(encode_publish(message, packet_id, dup))
+        if data:
+            self._send(b"".join(data))
+        self.inflight.update(sent)
+
+    def subscribe(self, filters, qos=0):
+        """
+        Subscribes to the topic filters; the broker's answer is handled by poll.
+        """
+        body = struct.pack("!H", self._packet_id())
+        for topic_filter in filters:
+            body += encode_string(topic_filter) + bytes([qos])
+        self._send(encode_packet(SUBSCRIBE, 0x02, body))
+
+    def unacknowledged(self):
+        """
+        Removes and returns the QoS 1 messages the broker hasn't acknowledged, to resend after a reconnect.
+        """
+        messages = list(self.inflight.values())
+        self.inflight.clear()
+        return messages
+
+    def poll(self, timeout=0.0):
+        """
+        Handles the packets that arrive within timeout seconds, and sends a ping if it is due.
+
+        Returns:
+            list: The Messages received on the subscriptions, payloads as bytes.
+
+        Raises:
+            ConnectionError: If the connection was lost or the broker stopped answering pings.
+        """
+        if self.sock is None:
+            raise ConnectionError("Not connected")
+        received = []
+        readable, _, _ = select.select([self.sock], [], [], max(timeout, 0.0))
+        if readable:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed by the broker")
+            for packet_type, flags, body in self.reader.feed(data):
+                if packet_type == PUBLISH:
+                    message, packet_id = decode_publish(flags, body)
+                    if message.qos:
+                        self._send(encode_packet(PUBACK, 0, struct.pack("!H", packet_id)))
+                    received.append(message)
+                elif packet_type == PUBACK:
+                    self.inflight.pop(struct.unpack("!H", body[:2])[0], None)
+                elif packet_type == SUBACK:
+                    self.refused_subscriptions += body[2:].count(0x80)
+                elif packet_type == PINGRESP:
+                    self.ping_sent = None
+
+        now = time.monotonic()
+        if self.ping_sent is not None and now - self.ping_sent > self.keepalive:
+            raise ConnectionError("The broker stopped answering pings")
+        if self.keepalive and self.ping_sent is None and now - self.last_sent >= self.keepalive / 2:
+            self._send(encode_packet(PINGREQ, 0, b""))
+            self.ping_sent = now
+        return received
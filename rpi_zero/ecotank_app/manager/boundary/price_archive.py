@@ -0,0 +1,133 @@
+"""
+Archive format: one compressed numpy .npz file per region and day, <directory>/<region>/<YYYY-MM-DD>.npz, holding
+the day's prices as columns:
+    start (int16): minutes after midnight the price starts
+    end (int16): minutes after midnight the price ends (1440 for midnight the next day)
+    dkk, eur, exr (float64): DKK_per_kWh, EUR_per_kWh and EXR
+
+A day of hourly prices takes about 1.5 kB, mostly zip overhead; time_end and EXR compress to almost nothing.
+"""
+import os
+from datetime import date, datetime, timedelta
+from .logger import logger
+
+
+class PriceArchive(object):
+    """
+    Day-partitioned storage for electricity prices that have been moved out of the database (see shared_db.archive_prices).
+
+    Rows are plain tuples (time_start, time_end, DKK_per_kWh, EUR_per_kWh, EXR), so this module doesn't depend on the models.
+
+    Args:
+        directory (str): Root directory of the archive. Created on the first write.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _day_path(self, region, day):
+        return os.path.join(self.directory, region, f"{day.isoformat()}.npz")
+
+    def days(self, region):
+        """
+        Returns the archived days for a region, sorted.
+        """
+        region_dir = os.path.join(self.directory, region)
+        if not os.path.isdir(region_dir):
+            return []
+        days = []
+        for name in os.listdir(region_dir):
+            if name.endswith(".npz"):
+                try:
+                    days.append(date.fromisoformat(name[:-4]))
+                except ValueError:
+                    continue
+        return sorted(days)
+
+    def version(self, region):
+        """
+        Returns a value that changes whenever the archive of a region changes, for cache validators.
+        """
+        days = self.days(region)
+        if not days:
+            return (0, 0)
+        return (len(days), max(os.path.getmtime(self._day_path(region, day)) for day in days))
+
+    def read_day(self, region, day):
+        """
+        Returns the archived rows of a day, sorted by time_start, or an empty list if the day isn't archived.
+        """
+        day_path = self._day_path(region, day)
+        if not os.path.exists(day_path):
+            return []
+        import numpy as np  # Imported on first use, shared_db is imported by the webserver at startup
+
+        log_ctx = "Price Archive:"
+        try:
+            with np.load(day_path) as data:
+                start, end, dkk, eur, exr = data["start"], data["end"], data["dkk"], data["eur"], data["exr"]
+        except Exception as e:
+            logger.log(log_ctx, f"Could not read {day_path}", "ERROR", e)
+            return []
+        midnight = datetime.combine(day, datetime.min.time())
+        return [
+            (
+                midnight + timedelta(minutes=int(start[i])),
+                midnight + timedelta(minutes=int(end[i])),
+                float(dkk[i]),
+                float(eur[i]),
+                float(exr[i]),
+            )
+            for i in range(len(start))
+        ]
+
+    def write_day(self, region, day, rows):
+        """
+        Stores rows for a day, merged with what is already archived for it (new rows win on the same time_start).
+        The file is written to a temporary name and renamed, so a crash never leaves a half-written day.
+
+        Args:
+            region (str): The price region.
+            day (date): The day the rows start on.
+            rows (list): (time_start, time_end, DKK_per_kWh, EUR_per_kWh, EXR) tuples.
+        """
+        import numpy as np
+
+        merged = {row[0]: row for row in self.read_day(region, day)}
+        merged.update((row[0], row) for row in rows)
+        ordered = [merged[time_start] for time_start in sorted(merged)]
+        midnight = datetime.combine(day, datetime.min.time())
+
+        def minutes(moment):
+            return (moment - midnight) // timedelta(minutes=1)
+
+        day_path = self._day_path(region, day)
+        os.makedirs(os.path.dirname(day_path), exist_ok=True)
+        temp_path = day_path + ".tmp.npz"
+        np.savez_compressed(
+            temp_path,
+            start=np.array([minutes(row[0]) for row in ordered], dtype=np.int16),
+            end=np.array([minutes(row[1]) for row in ordered], dtype=np.int16),
+            dkk=np.array([row[2] for row in ordered], dtype=np.float64),
+            eur=np.array([row[3] for row in ordered], dtype=np.float64),
+            exr=np.array([row[4] for row in ordered], dtype=np.float64),
+        )
+        os.replace(temp_path, day_path)
+
+    def read_range(self, region, start=None, end=None):
+        """
+        Yields archived rows for a region with start <= time_start < end, oldest first.
+
+        Args:
+            region (str): The price region.
+            start (datetime, optional): Inclusive start, defaults to the first archived day.
+            end (datetime, optional): Exclusive end, defaults to the last archived day.
+        """
+        for day in self.days(region):
+            if start is not None and day < start.date():
+                continue
+            if end is not None and datetime.combine(day, datetime.min.time()) >= end:
+                break
+            for row in self.read_day(region, day):
+                if (start is None or row[0] >= start) and (end is None or row[0] < end):
+                    yield row
@@ -0,0 +1,228 @@
+"""
+Electricity prices held in memory as one array('d') per region and day, shared by every consumer in a process:
+the setpoint and energy accounting of every tank, the missing data check and the dashboard.
+
+A day holds 24 slots of an hour, or 96 of a quarter of an hour once the region publishes quarter-hour prices,
+with NaN where the price isn't known. Days are loaded in bulk, a whole range in one query, and days without any
+price are cached too, so the missing data check doesn't probe the database day by day.
+
+Charts need the whole history, which can be more days than the cache holds. series therefore uses a second,
+compact form per region: the known prices of the whole history in two flat arrays, built from one bulk load
+without passing the days through the cache.
+
+Any change of kind PRICES on the change bus (prices stored or archived, by either process) drops the whole cache.
+That happens a few times a day, so reloading is cheaper than working out which days changed.
+"""
+import math
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
+from . import change_bus as changes
+
+DAY_MINUTES = 24 * 60
+DAY_MS = DAY_MINUTES * 60 * 1000
+EPOCH_DAY = date(1970, 1, 1)
+
+
+class DayPrices(namedtuple("DayPrices", ["day", "slot_minutes", "prices"])):
+    """
+    The prices of a region on one day.
+
+    Attributes:
+        day (date): The day.
+        slot_minutes (int): Minutes per slot, 60 or 15.
+        prices (array): DKK per kWh per slot, NaN where unknown.
+    """
+
+    __slots__ = ()
+
+    def at(self, moment):
+        """
+        The price of the slot containing moment, or None if it isn't known.
+        """
+        price = self.prices[(moment.hour * 60 + moment.minute) // self.slot_minutes]
+        return None if math.isnan(price) else price
+
+    def hourly(self):
+        """
+        The price per hour, as the mean of its known slots. NaN for hours without any.
+        """
+        per_hour = 60 // self.slot_minutes
+        if per_hour == 1:
+            return self.prices
+        hourly = array("d")
+        for hour in range(24):
+            known = [price for price in self.prices[hour * per_hour : (hour + 1) * per_hour] if not math.isnan(price)]
+            hourly.append(sum(known) / len(known) if known else math.nan)
+        return hourly
+
+
+class PriceCache(object):
+    """
+    LRU cache of DayPrices per (region, day), invalidated through the change bus.
+
+    Args:
+        bus (ChangeBus): The bus announcing price changes.
+        load (callable): load(region, first, last) returns the (time_start, DKK_per_kWh) rows of the region on
+            days first to last inclusive, in any order. first and last may be None for an open end.
+        max_days (int): Days kept, over all regions.
+    """
+
+    def __init__(self, bus, load, max_days=1000):
+        self.bus = bus
+        self.load = load
+        self.max_days = max_days
+        self._days = OrderedDict()  # (region, day) -> DayPrices, or None for a day without prices
+        self._histories = {}  # Region -> (times, prices) of the whole history. See series
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _validate(self):
+        # Called with the lock held. An unavailable bus means "always changed", like CachedValue
+        version = self.bus.version(changes.PRICES)
+        if version is None or version != self._version:
+            self._days.clear()
+            self._histories.clear()
+            self._version = version
+
+    def days(self, region, first, last):
+        """
+        The DayPrices of each day from first to last inclusive, None for days without any price.
+        Days that aren't cached are loaded with a single query.
+        """
+        count = (last - first).days + 1
+        with self._lock:
+            self._validate()
+            version = self._version
+            result = [self._days.get((region, first + timedelta(days=i)), False) for i in range(count)]
+            for i, day_prices in enumerate(result):
+                if day_prices is not False:
+                    self._days.move_to_end((region, first + timedelta(days=i)))
+        missing = [i for i, day_prices in enumerate(result) if day_prices is False]
+        if not missing:
+            return result
+
+        # Loaded outside the lock, so a slow query doesn't hold up the other tanks' lookups
+        load_first, load_last = first + timedelta(days=missing[0]), first + timedelta(days=missing[-1])
+        loaded = self._group(region, self.load(region, load_first, load_last))
+        for i in missing:
+            day = first + timedelta(days=i)
+            result[i] = loaded.get(day)
+        self._store(version, region, ((first + timedelta(days=i), result[i]) for i in missing))
+        return result
+
+    def day(self, region, day):
+        """
+        The DayPrices of a day, or None if no price of the day is known.
+        """
+        return self.days(region, day, day)[0]
+
+    def price_at(self, region, moment):
+        """
+        The price in DKK per kWh of the slot containing moment, or None if it isn't known.
+        """
+        day_prices = self.day(region, moment.date())
+        return day_prices.at(moment) if day_prices is not None else None
+
+    def hour_price(self, region, hour_start):
+        """
+        The price in DKK per kWh of an hour, the mean of its quarters on quarter-hour days. None if it isn't known.
+        """
+        day_prices = self.day(region, hour_start.date())
+        if day_prices is None:
+            return None
+        price = day_prices.hourly()[hour_start.hour]
+        return None if math.isnan(price) else price
+
+    def cheapest_hours(self, region, day, count):
+        """
+        The count cheapest hours of a day with a known price, in time order.
+
+        Returns:
+            list: (hour start datetime, DKK per kWh) tuples.
+        """
+        day_prices = self.day(region, day)
+        if day_prices is None:
+            return []
+        hourly = day_prices.hourly()
+        known = [hour for hour in range(24) if not math.isnan(hourly[hour])]
+        cheapest = sorted(sorted(known, key=hourly.__getitem__)[:count])
+        midnight = datetime.combine(day, datetime.min.time())
+        return [(midnight + timedelta(hours=hour), hourly[hour]) for hour in cheapest]
+
+    def missing_days(self, region, first, last):
+        """
+        The days from first to last inclusive without any known price.
+        """
+        return [first + timedelta(days=i) for i, day_prices in enumerate(self.days(region, first, last)) if day_prices is None]
+
+    def series(self, region, first=None, last=None):
+        """
+        The known prices from first to last inclusive, for charts. Without first, from the first day with prices;
+        without last, to the last day with prices. Days outside the history cost nothing, however far out.
+
+        Returns:
+            tuple: (array of slot starts in milliseconds since 1970-01-01, in the naive local time of the prices,
+            which is how chart axes count datetimes; array of DKK per kWh)
+        """
+        times, prices = self._history_of(region)
+        lo = bisect_left(times, (first - EPOCH_DAY).days * DAY_MS) if first is not None else 0
+        hi = bisect_left(times, ((last - EPOCH_DAY).days + 1) * DAY_MS) if last is not None else len(times)
+        return times[lo:hi], prices[lo:hi]
+
+    def _history_of(self, region):
+        """
+        (times, prices) of all known prices of a region, see series. Built from one load of the whole history,
+        kept apart from the days, so a history longer than max_days doesn't evict itself on every load.
+        """
+        with self._lock:
+            self._validate()
+            version = self._version
+            history = self._histories.get(region)
+        if history is not None:
+            return history
+        loaded = self._group(region, self.load(region, None, None))
+        times, prices = array("d"), array("d")
+        for day in sorted(loaded):
+            day_prices = loaded[day]
+            day_ms = (day - EPOCH_DAY).days * DAY_MS
+            slot_ms = day_prices.slot_minutes * 60 * 1000
+            known = [index for index, price in enumerate(day_prices.prices) if not math.isnan(price)]
+            times.extend([day_ms + index * slot_ms for index in known])
+            prices.extend([day_prices.prices[index] for index in known])
+        history = (times, prices)
+        with self._lock:
+            self._validate()
+            if version is not None and version == self._version:
+                self._histories[region] = history  # Unless prices changed during the load
+        return history
+
+    @staticmethod
+    def _group(region, rows):
+        """
+        Returns {day: DayPrices} of the rows.
+        """
+        by_day = {}
+        for time_start, price in rows:
+            by_day.setdefault(time_start.date(), []).append((time_start, price))
+        grouped = {}
+        for day, day_rows in by_day.items():
+            slot_minutes = 15 if any(time_start.minute for time_start, _ in day_rows) else 60
+            prices = array("d", [math.nan]) * (DAY_MINUTES // slot_minutes)
+            for time_start, price in day_rows:
+                prices[(time_start.hour * 60 + time_start.minute) // slot_minutes] = price
+            grouped[day] = DayPrices(day, slot_minutes, prices)
+        return grouped
+
+    def _store(self, version, region, days):
+        with self._lock:
+            self._validate()
+            if version is None or version != self._version:
+                return  # Prices changed during the load, so what was loaded may be stale
+            for day, day_prices in days:
+                self._days[(region, day)] = day_prices
+                self._days.move_to_end((region, day))
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
@@ -0,0 +1,337 @@
+"""
+Opt-in wall-clock sampling profiler, used by both processes.
+
+A daemon thread snapshots the stacks of all other threads with sys._current_frames() and counts them as folded
+stacks ("thread;outer (file:line);...;inner (file:line) count"), the input format of flamegraph.pl, which is also
+converted to a speedscope file. Waiting threads are sampled too, so time spent in serial waits or SQLite locks
+shows up next to time spent computing.
+
+Profiles are requested and collected through files in a shared directory, so the webserver can start a profile
+in the manager process and serve the result:
+    <name>.request   Written by request_profile, contains the duration in seconds. Picked up by ProfileController.poll.
+    <name>.running   JSON with the start time and duration while the process profiles, see profile_running.
+    <name>.folded    The last finished profile of the process.
+SIGUSR1 toggles profiling in a process that called ProfileController.install_signal_handler.
+"""
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from .logger import logger
+
+RUNNING_GRACE = 10.0  # Seconds after its duration that a profile may take to stop and be written
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of all threads until stopped or until duration has passed.
+
+    Overhead is bounded: after every sample the profiler sleeps at least long enough to keep the time spent
+    sampling below max_overhead of the wall time, so the effective interval grows on a slow CPU instead of
+    the profiler eating the process. The number of distinct stacks is capped at max_stacks.
+
+    Args:
+        interval (float): Target seconds between samples.
+        duration (float): Seconds after which profiling stops by itself.
+        max_overhead (float): Max fraction of wall time spent sampling.
+        max_depth (int): Frames kept per stack, counted from the innermost frame.
+        max_stacks (int): Distinct stacks kept; further new stacks are counted as "[truncated]".
+    """
+
+    ignored_threads = ("profile-writer",)  # Only waits for the profiler to finish
+
+    def __init__(self, interval=0.01, duration=30.0, max_overhead=0.02, max_depth=64, max_stacks=5000):
+        self.interval = interval
+        self.duration = duration
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.stacks = Counter()
+        self.samples = 0
+        self.sampling_time = 0.0
+        self.started_at = None
+        self.stopped_at = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.stopped_at or time.monotonic()) - self.started_at
+
+    def start(self):
+        self._stop.clear()
+        self.started_at = time.monotonic()
+        self.stopped_at = None
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        deadline = self.started_at + self.duration
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            start = time.perf_counter()
+            self._sample(own_id)
+            cost = time.perf_counter() - start
+            self.sampling_time += cost
+            self._stop.wait(max(self.interval, cost / self.max_overhead - cost))
+        self.stopped_at = time.monotonic()
+
+    def _sample(self, own_id):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or names.get(thread_id) in self.ignored_threads:
+                continue
+            frames = []
+            while frame is not None and len(frames) < self.max_depth:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            frames.append(names.get(thread_id, str(thread_id)))
+            stack = ";".join(reversed(frames))
+            if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                stack = "[truncated]"
+            self.stacks[stack] += 1
+        self.samples += 1
+
+    def folded(self):
+        """
+        Returns the profile as folded stacks, one "stack count" line per distinct stack.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    @property
+    def overhead(self):
+        return self.sampling_time / self.elapsed if self.elapsed else 0.0
+
+
+def folded_to_speedscope(folded, name, duration=None):
+    """
+    Converts folded stacks to a speedscope file (https://www.speedscope.app/file-format-schema.json).
+    Each thread becomes its own profile. Weights are in samples, or in seconds if the profile duration is given.
+
+    Args:
+        folded (str): Folded stacks as produced by SamplingProfiler.folded.
+        name (str): Name of the profile.
+        duration (float, optional): Wall time the profile covered.
+
+    Returns:
+        dict: The speedscope document, ready for json.dumps.
+    """
+    frames = []
+    frame_index = {}
+    profiles = {}
+    for line in folded.splitlines():
+        stack, _, count = line.rpartition(" ")
+        if not stack:
+            continue
+        count = int(count)
+        thread, *stack_frames = stack.split(";")
+        indices = []
+        for frame in stack_frames:
+            if frame not in frame_index:
+                frame_index[frame] = len(frames)
+                function, _, location = frame.partition(" (")
+                file, _, line_number = location.rstrip(")").rpartition(":")
+                entry = {"name": function, "file": file}
+                if line_number.isdigit():
+                    entry["line"] = int(line_number)
+                frames.append(entry)
+            indices.append(frame_index[frame])
+        profiles.setdefault(thread, []).append((indices, count))
+
+    # Every thread is sampled in every round, so samples per thread * seconds per sample gives wall time per thread
+    rounds = max((sum(count for _, count in samples) for samples in profiles.values()), default=0)
+    seconds_per_sample = duration / rounds if duration and rounds else None
+    document_profiles = []
+    for thread, samples in profiles.items():
+        weights = [count * seconds_per_sample if seconds_per_sample else count for _, count in samples]
+        document_profiles.append(
+            {
+                "type": "sampled",
+                "name": thread,
+                "unit": "seconds" if seconds_per_sample else "none",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": [indices for indices, _ in samples],
+                "weights": weights,
+            }
+        )
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "ecotank sampling_profiler",
+        "activeProfileIndex": 0,
+        "shared": {"frames": frames},
+        "profiles": document_profiles,
+    }
+
+
+def request_profile(directory, process_name, duration):
+    """
+    Asks the process to start profiling for duration seconds, see ProfileController.poll.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{process_name}.request"), "w") as f:
+        f.write(str(float(duration)))
+
+
+def profile_running(directory, process_name):
+    """
+    Whether the process is profiling, from the marker ProfileController writes while it does, or is about to,
+    from a request it hasn't picked up yet. A marker left by a process that was killed while profiling counts
+    until its duration has passed.
+    """
+    if os.path.exists(os.path.join(directory, f"{process_name}.request")):
+        return True
+    try:
+        with open(os.path.join(directory, f"{process_name}.running")) as f:
+            marker = json.load(f)
+        return time.time() < marker["started"] + marker["duration"] + RUNNING_GRACE
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def read_profile(directory, process_name):
+    """
+    Returns (folded stacks, metadata dict) of the last finished profile of a process, or None.
+    """
+    try:
+        with open(os.path.join(directory, f"{process_name}.folded")) as f:
+            folded = f.read()
+        with open(os.path.join(directory, f"{process_name}.json")) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return folded, metadata
+
+
+class ProfileController(object):
+    """
+    Owns the profiler of one process: starts it on request files and signals, and writes the result to
+    the shared directory when it finishes.
+
+    Args:
+        process_name (str): "manager" or "webserver".
+        directory (str): Directory shared by both processes.
+        default_duration (float): Profile length when started by a signal.
+        poll_interval (float): Min seconds between checks for a request file.
+    """
+
+    def __init__(self, process_name, directory, default_duration=30.0, poll_interval=1.0):
+        self.process_name = process_name
+        self.directory = directory
+        self.default_duration = default_duration
+        self.poll_interval = poll_interval
+        self.profiler = None
+        self.next_poll = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.profiler is not None and self.profiler.running
+
+    def start(self, duration=None):
+        log_ctx = "Sampling Profiler:"
+        with self.lock:
+            if self.running:
+                return
+            duration = duration if duration is not None else self.default_duration
+            # Read by the other process's debug page, see profile_running
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self._running_path(), "w") as f:
+                    json.dump({"started": time.time(), "duration": duration}, f)
+            except OSError as e:
+                logger.log(log_ctx, f"Could not write the {self.process_name} running marker", "WARNING", e)
+            self.profiler = SamplingProfiler(duration=duration)
+            self.profiler.start()
+            threading.Thread(target=self._save_when_done, args=(self.profiler,), name="profile-writer", daemon=True).start()
+        logger.log(log_ctx, f"Profiling {self.process_name} for up to {duration:g} s")
+
+    def stop(self):
+        with self.lock:
+            profiler = self.profiler
+        if profiler is not None:
+            profiler.stop()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def poll(self):
+        """
+        Starts profiling if a request file for this process exists. Cheap enough to call every loop iteration.
+        """
+        now = time.monotonic()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + self.poll_interval
+        request_path = os.path.join(self.directory, f"{self.process_name}.request")
+        try:
+            with open(request_path) as f:
+                content = f.read().strip()
+            os.remove(request_path)
+        except OSError:
+            return
+        try:
+            duration = float(content)
+        except ValueError:
+            duration = self.default_duration
+        self.start(duration)
+
+    def install_signal_handler(self, signal_number=getattr(signal, "SIGUSR1", None)):
+        """
+        Makes the signal toggle profiling. Must be called from the main thread. Does nothing on platforms without SIGUSR1.
+        """
+        if signal_number is not None:
+            signal.signal(signal_number, lambda signum, frame: threading.Thread(target=self.toggle, daemon=True).start())
+
+    def _running_path(self):
+        return os.path.join(self.directory, f"{self.process_name}.running")
+
+    def _save_when_done(self, profiler):
+        log_ctx = "Sampling Profiler:"
+        profiler.thread.join()
+        try:
+            os.remove(self._running_path())
+        except OSError:
+            pass
+        metadata = {
+            "process": self.process_name,
+            "finished": time.time(),
+            "duration": profiler.elapsed,
+            "samples": profiler.samples,
+            "stacks": len(profiler.stacks),
+            "overhead": profiler.overhead,
+        }
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, self.process_name)
+            for extension, content in ((".folded", profiler.folded()), (".json", json.dumps(metadata))):
+                with open(base + extension + ".tmp", "w") as f:
+                    f.write(content)
+                os.replace(base + extension + ".tmp", base + extension)
+        except OSError as e:
+            logger.log(log_ctx, f"Could not write the {self.process_name} profile", "ERROR", e)
+            return
+        logger.log(
+            log_ctx,
+            f"Profiled {self.process_name} for {profiler.elapsed:.1f} s: {profiler.samples} samples, "
+            f"{len(profiler.stacks)} stacks, {profiler.overhead:.1%} overhead",
+        )
@@ -0,0 +1,287 @@
+"""
+Binary trace format:
+    File header: b"ECOTRACE" + version (1 byte) + start time as unix epoch seconds (float64, little-endian).
+    Records: direction (1 byte, 0 = written by the RPi, 1 = read from the Arduino),
+             time since the previous record in microseconds (uint32), payload length (uint16), payload.
+
+Records are 7 bytes + payload, so an exchange at 5 Hz costs roughly 120 bytes per second.
+"""
+import os
+import struct
+import time
+from .transport import Transport
+from .logger import logger
+from .clock import system_clock
+
+
+TRACE_MAGIC = b"ECOTRACE"
+TRACE_VERSION = 1
+HEADER = struct.Struct("<8sBd")
+RECORD = struct.Struct("<BIH")
+TX = 0
+RX = 1
+
+
+class TraceRecorder(object):
+    """
+    Writes raw byte chunks with monotonic timestamps to a trace file.
+    The file is rotated like logging.handlers.RotatingFileHandler: trace.bin -> trace.bin.1 -> ... -> trace.bin.<backup_count>.
+    A trace left by the previous run is rotated too, so a restart keeps the capture that led up to it.
+
+    Args:
+        path (str): Path of the active trace file.
+        max_bytes (int): Size at which the file is rotated.
+        backup_count (int): Number of rotated files to keep.
+        clock (SystemClock, optional): Time source, defaults to the wall clock.
+    """
+
+    def __init__(self, path, max_bytes=1_000_000, backup_count=5, clock=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.clock = clock if clock is not None else system_clock
+        self.file = None
+        self.last_time = None
+        if os.path.exists(self.path):
+            self._shift_files()
+        self._open_file()
+
+    def _open_file(self):
+        self.file = open(self.path, "wb")
+        self.file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time()))
+        self.last_time = self.clock.monotonic()
+
+    def _shift_files(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+
+    def _rotate(self):
+        self.file.close()
+        self._shift_files()
+        self._open_file()
+
+    def record(self, direction, data):
+        """
+        Appends a chunk to the trace. If the trace can't be written (e.g. the SD card is full), the error is logged
+        and recording stops, since recording must never stop the control loop.
+
+        Args:
+            direction (int): TX for bytes written to the Arduino, RX for bytes read from it.
+            data (bytes): The raw chunk.
+        """
+        if self.file is None:
+            return  # Closed, or stopped after an error
+        now = self.clock.monotonic()
+        delta_us = min(int((now - self.last_time) * 1_000_000), 0xFFFFFFFF)
+        self.last_time = now
+        try:
+            # Chunks longer than the length field allows are split; this never happens with the 9-byte frames in practice
+            for offset in range(0, max(len(data), 1), 0xFFFF):
+                chunk = data[offset:offset + 0xFFFF]
+                self.file.write(RECORD.pack(direction, delta_us, len(chunk)) + chunk)
+                delta_us = 0
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self._rotate()
+        except OSError as e:
+            logger.log("Serial Trace:", f"Could not write trace file {self.path}, recording stopped", "ERROR", e)
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass  # Buffered records that can't be written, after a write error
+            finally:
+                self.file = None
+
+
+def read_trace(path):
+    """
+    Reads a trace file.
+
+    Args:
+        path (str): Path of the trace file.
+
+    Yields:
+        tuple: (seconds since the start of the trace, direction, data) for every record.
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError(f"{path} is not a trace file")
+        magic, version, _ = HEADER.unpack(header)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION:
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} trace file")
+
+        t = 0.0
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return  # A truncated last record is expected if the process was killed while writing
+            direction, delta_us, length = RECORD.unpack(record)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            t += delta_us / 1_000_000
+            yield t, direction, data
+
+
+def trace_files(path):
+    """
+    Returns the active trace file and its rotated backups, oldest first, for replaying a whole capture.
+    """
+    backups = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        backups.append(f"{path}.{i}")
+        i += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+class RecordingTransport(Transport):
+    """
+    Wraps another transport and records every chunk written and read with a TraceRecorder.
+    """
+
+    def __init__(self, inner, recorder):
+        self.inner = inner
+        self.recorder = recorder
+        self.name = inner.name
+
+    def __repr__(self):
+        return f"Recording({self.inner!r} -> {self.recorder.path})"
+
+    def open(self):
+        self.inner.open()
+
+    def close(self):
+        self.inner.close()
+
+    @property
+    def is_open(self):
+        return self.inner.is_open
+
+    def is_available(self):
+        return self.inner.is_available()
+
+    def write(self, data):
+        # Recorded once written, so a failed write isn't traced as sent
+        self.inner.write(data)
+        self.recorder.record(TX, data)
+
+    def wait_readable(self, timeout):
+        return self.inner.wait_readable(timeout)
+
+    def read_available(self):
+        data = self.inner.read_available()
+        if data:
+            self.recorder.record(RX, data)
+        return data
+
+
+class ReplayTransport(Transport):
+    """
+    Feeds recorded traces back to ArduinoIF. What the RPi writes is ignored; every write moves the replay
+    to the next recorded write, and the chunks recorded after it are delivered with their original timing
+    relative to it. Chunks that arrived late in the capture (after a select timeout) therefore arrive late
+    in the replay too, so partial frames and other timing glitches are reproduced.
+
+    Timing is tracked on a virtual timeline. With realtime=False nothing sleeps and waits only move the
+    virtual time, which makes the replay deterministic and as fast as the parser allows.
+
+    Args:
+        paths (list): Trace files to replay, in order. See trace_files.
+        realtime (bool): Sleep for the recorded delays instead of skipping them.
+    """
+
+    name = "replay"
+
+    def __init__(self, paths, realtime=False):
+        self.paths = paths
+        self.realtime = realtime
+        self.tx_times = []
+        self.rx_chunks = []  # (time, data), sorted by time
+        offset = 0.0
+        for path in paths:
+            last = 0.0
+            for t, direction, data in read_trace(path):
+                last = t
+                if direction == TX:
+                    self.tx_times.append(offset + t)
+                else:
+                    self.rx_chunks.append((offset + t, data))
+            offset += last
+        self._open = False
+        self.now = 0.0  # Virtual time
+        self.next_tx = 0
+        self.next_rx = 0
+
+    def __repr__(self):
+        return f"ReplayTransport({len(self.paths)} file(s), {len(self.tx_times)} exchanges)"
+
+    @property
+    def exhausted(self):
+        return self.next_tx >= len(self.tx_times)
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def write(self, data):
+        if self.exhausted:
+            return
+        self._advance_to(self.tx_times[self.next_tx])
+        self.next_tx += 1
+
+    def wait_readable(self, timeout):
+        if self.next_rx < len(self.rx_chunks):
+            arrival = self.rx_chunks[self.next_rx][0]
+            if arrival <= self.now + timeout:
+                self._advance_to(arrival)
+                return True
+        self._advance_to(self.now + timeout)
+        return False
+
+    def read_available(self):
+        data = bytearray()
+        while self.next_rx < len(self.rx_chunks) and self.rx_chunks[self.next_rx][0] <= self.now:
+            data += self.rx_chunks[self.next_rx][1]
+            self.next_rx += 1
+        return bytes(data)
+
+    def _advance_to(self, t):
+        if t <= self.now:
+            return
+        if self.realtime:
+            time.sleep(t - self.now)
+        self.now = t
+
+
+def wrap_with_recorder(transport, path, max_bytes=1_000_000, backup_count=5):
+    """
+    Wraps a transport in a RecordingTransport writing to path. Falls back to the plain transport if the
+    trace file can't be opened, since recording must never stop the control loop.
+    """
+    log_ctx = "Serial Trace:"
+    try:
+        recorder = TraceRecorder(path, max_bytes=max_bytes, backup_count=backup_count)
+    except OSError as e:
+        logger.log(log_ctx, f"Could not open trace file {path}, recording disabled", "ERROR", e)
+        return transport
+    logger.log(log_ctx, f"Recording {transport!r} to {path}")
+    return RecordingTransport(transport, recorder)
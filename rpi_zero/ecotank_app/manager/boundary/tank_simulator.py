@@ -0,0 +1,188 @@
+import random
+from datetime import datetime, timedelta
+from .transport import SimulatedArduino
+
+
+class TankSimulator(SimulatedArduino):
+    """
+    Physics based stand-in for the atmega2560 and the tank it controls. Plugs into SimulatedTransport,
+    so the rest of the stack talks to it through ArduinoIF exactly like it talks to the real hardware.
+
+    The model mirrors the firmware:
+        - RegulateTemp: heater on while the water is below the setpoint (and the system is powered).
+        - BrugVarmtVand: water drawn off lowers the level; once the level has been stable for refill_delay seconds,
+          or the level is at minimum, the pump refills the tank with cold water up to max level.
+        - DataManager: the water level is reported as a percentage of the calibrated ultrasonic distance range.
+
+    Temperature follows dT/dt = (P_heater - UA * (T - T_ambient)) / (m * c), with m given by the current water volume.
+    Refilling mixes inlet water into the tank. Time is taken from the injected clock on every received frame.
+
+    Args:
+        clock (SystemClock): Time source, normally the SimulatedClock shared with the managers.
+        capacity_l (float): Water volume at max level in litres.
+        heater_power_w (float): Heating element power in watts.
+        loss_w_per_k (float): Heat loss coefficient (UA) of the tank in W/K.
+        draw_events (list, optional): List of (datetime, litres) draw-off events. See random_draw_events.
+        seed (int, optional): Seed for the ultrasonic sensor noise.
+    """
+
+    specific_heat = 4186.0  # J/(kg*K), water
+    max_distance = 133  # cm, sensor distance at min level (kMaxDistance in main.cpp)
+    min_distance = 33  # cm, sensor distance at max level (kMinDistance in main.cpp)
+    max_step = 1.0  # Seconds per integration sub-step
+
+    def __init__(
+        self,
+        clock,
+        capacity_l=200.0,
+        heater_power_w=3000.0,
+        loss_w_per_k=2.0,
+        ambient_temp=20.0,
+        inlet_temp=10.0,
+        start_temp=40.0,
+        draw_rate_l_per_min=8.0,
+        refill_rate_l_per_min=12.0,
+        refill_delay=300.0,
+        level_noise_cm=1.0,
+        draw_events=None,
+        seed=None,
+    ):
+        super().__init__(water_temp=start_temp, water_level=100)
+        self.clock = clock
+        self.capacity_l = capacity_l
+        self.heater_power_w = heater_power_w
+        self.loss_w_per_k = loss_w_per_k
+        self.ambient_temp = ambient_temp
+        self.inlet_temp = inlet_temp
+        self.draw_rate = draw_rate_l_per_min / 60.0
+        self.refill_rate = refill_rate_l_per_min / 60.0
+        self.refill_delay = refill_delay
+        self.level_noise_cm = level_noise_cm
+        self.draw_events = sorted(draw_events or [])
+        self.rng = random.Random(seed)
+
+        self.volume_l = capacity_l
+        self.heater_on = False
+        self.pump_on = False
+        self.draw_remaining_l = 0.0
+        self.stable_for = 0.0  # Seconds the level has been stable without draw-off (BrugVarmtVand timer)
+        self.next_event = 0  # Index into draw_events
+        self.last_update = clock.monotonic()
+
+        # Running totals, read by the simulation harness
+        self.heater_energy_wh = 0.0
+        self.heater_on_seconds = 0.0
+        self.drawn_l = 0.0
+
+    def handle_frame(self, system_power, setpoint):
+        now = self.clock.monotonic()
+        self.step(now - self.last_update)
+        self.last_update = now
+        self.system_power = system_power
+        self.setpoint = setpoint
+        return self.water_temp, self._measure_level()
+
+    def step(self, dt):
+        """
+        Advances the model by dt seconds, split into sub-steps of at most max_step seconds.
+        """
+        while dt > 0:
+            h = min(dt, self.max_step)
+            self._sub_step(h)
+            dt -= h
+
+    def _sub_step(self, h):
+        self._start_due_draw_events()
+
+        mass = max(self.volume_l, 1.0)  # 1 l of water ~ 1 kg
+        heat_w = -self.loss_w_per_k * (self.water_temp - self.ambient_temp)
+
+        if self.system_power:
+            # RegulateTemp::regulateTemp
+            self.heater_on = self.water_temp < self.setpoint
+            self._brug_varmt_vand(h)
+        else:
+            self.heater_on = False
+            self.pump_on = False
+
+        if self.heater_on:
+            heat_w += self.heater_power_w
+            self.heater_energy_wh += self.heater_power_w * h / 3600.0
+            self.heater_on_seconds += h
+
+        self.water_temp += heat_w * h / (mass * self.specific_heat)
+
+        # Hot water drawn off leaves at tank temperature, so it only changes the volume
+        if self.draw_remaining_l > 0:
+            drawn = min(self.draw_rate * h, self.draw_remaining_l, self.volume_l)
+            self.volume_l -= drawn
+            self.draw_remaining_l -= drawn
+            self.drawn_l += drawn
+
+        if self.pump_on:
+            added = min(self.refill_rate * h, self.capacity_l - self.volume_l)
+            if added > 0:
+                self.water_temp = (self.water_temp * self.volume_l + self.inlet_temp * added) / (self.volume_l + added)
+                self.volume_l += added
+
+    def _brug_varmt_vand(self, h):
+        """
+        Simplified BrugVarmtVand::checkDistance state machine, working on the true volume.
+        """
+        if self.volume_l >= self.capacity_l:
+            self.pump_on = False
+            self.stable_for = 0.0
+        elif self.draw_remaining_l > 0:
+            # Distance increasing; somebody is using hot water
+            self.pump_on = False
+            self.stable_for = 0.0
+        elif self.volume_l <= 0.0:
+            self.pump_on = True
+        elif not self.pump_on:
+            self.stable_for += h
+            if self.stable_for >= self.refill_delay:
+                self.pump_on = True
+
+    def _start_due_draw_events(self):
+        now = self.clock.now()
+        while self.next_event < len(self.draw_events) and self.draw_events[self.next_event][0] <= now:
+            self.draw_remaining_l += self.draw_events[self.next_event][1]
+            self.next_event += 1
+
+    def _measure_level(self):
+        """
+        Simulates the ultrasonic sensor: a noisy, whole-centimetre distance converted to a percentage
+        the same way DataManager.cpp does it.
+        """
+        span = self.max_distance - self.min_distance
+        distance = self.max_distance - (self.volume_l / self.capacity_l) * span
+        if self.level_noise_cm:
+            distance += self.rng.gauss(0.0, self.level_noise_cm)
+        distance = int(round(distance))
+        percentage = round((self.max_distance - distance) / span * 100)
+        return max(0, min(255, percentage))
+
+
+def random_draw_events(start, days, seed=None):
+    """
+    Generates a plausible household draw-off pattern: a morning and an evening shower plus a few small draws per day.
+
+    Args:
+        start (datetime): First day of the pattern.
+        days (int): Number of days to generate.
+        seed (int, optional): Seed for the random generator.
+
+    Returns:
+        list: Sorted list of (datetime, litres) tuples.
+    """
+    rng = random.Random(seed)
+    day_start = datetime(start.year, start.month, start.day)
+    events = []
+    for day in range(days):
+        midnight = day_start + timedelta(days=day)
+        events.append((midnight + timedelta(hours=rng.gauss(7.0, 0.5)), max(10.0, rng.gauss(40.0, 10.0))))
+        if rng.random() < 0.7:
+            events.append((midnight + timedelta(hours=rng.gauss(19.5, 1.0)), max(10.0, rng.gauss(30.0, 8.0))))
+        for _ in range(rng.randint(2, 6)):
+            events.append((midnight + timedelta(hours=rng.uniform(6.0, 23.0)), rng.uniform(1.0, 6.0)))
+    return sorted(events)
@@ -0,0 +1,363 @@
+import os
+import select
+import socket
+import struct
+import serial
+from abc import ABC, abstractmethod
+from os import environ
+from .logger import logger
+
+
+class Transport(ABC):
+    """
+    Base class for the byte links ArduinoIF can talk through.
+
+    A transport only moves raw bytes; framing and unpacking stays in ArduinoIF.
+    Subclasses must implement open, close, is_open, write, wait_readable and read_available.
+    """
+
+    name = "transport"
+
+    @abstractmethod
+    def open(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+    @property
+    @abstractmethod
+    def is_open(self):
+        raise NotImplementedError
+
+    def is_available(self):
+        """
+        Cheap check whether the underlying device is present at all (hot-plug detection).
+        Used to skip open attempts and to detect a device that disappeared while open.
+
+        Returns:
+            bool: True if an open attempt could succeed.
+        """
+        return True
+
+    @abstractmethod
+    def write(self, data):
+        raise NotImplementedError
+
+    @abstractmethod
+    def wait_readable(self, timeout):
+        """
+        Waits until there is data to read or the timeout expires.
+
+        Args:
+            timeout (float): Max time to wait in seconds.
+
+        Returns:
+            bool: True if data is ready to be read.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_available(self):
+        """
+        Reads all bytes that are currently available without blocking.
+
+        Returns:
+            bytes: The received bytes (may be empty).
+        """
+        raise NotImplementedError
+
+
+class SerialTransport(Transport):
+    """
+    Transport for the USB/UART link to the atmega2560 (pyserial).
+    """
+
+    name = "serial"
+
+    def __init__(self, port="/dev/ttyACM0", baud_rate=250000):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.ser = None
+
+    def __repr__(self):
+        return f"SerialTransport({self.port} @ {self.baud_rate})"
+
+    def open(self):
+        self.ser = serial.Serial(self.port, self.baud_rate)
+
+    def close(self):
+        if self.ser is not None:
+            try:
+                self.ser.close()
+            finally:
+                self.ser = None
+
+    @property
+    def is_open(self):
+        return self.ser is not None and self.ser.is_open
+
+    def is_available(self):
+        # The device node disappears when the Arduino is unplugged, so this is enough to detect hot-plug events.
+        return os.path.exists(self.port)
+
+    def write(self, data):
+        self.ser.write(data)
+
+    def wait_readable(self, timeout):
+        # select.select() waits for the serial port to be ready for reading with a defined timeout
+        readable, _, _ = select.select([self.ser], [], [], timeout)
+        return bool(readable)
+
+    def read_available(self):
+        return self.ser.read(self.ser.in_waiting)
+
+
+class TcpTransport(Transport):
+    """
+    Transport for a serial port exposed over TCP, e.g. by ser2net running on another machine.
+    """
+
+    name = "tcp"
+
+    def __init__(self, host="localhost", port=2000, connect_timeout=2.0):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.sock = None
+
+    def __repr__(self):
+        return f"TcpTransport({self.host}:{self.port})"
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+    @property
+    def is_open(self):
+        return self.sock is not None
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def wait_readable(self, timeout):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def read_available(self):
+        try:
+            data = self.sock.recv(4096)
+        except BlockingIOError:
+            return b""
+        if not data:
+            raise ConnectionError("Connection closed by remote end")
+        return data
+
+
+class SimulatedArduino(object):
+    """
+    Minimal in-process stand-in for the atmega2560 firmware.
+    Answers every received RPi frame with a data frame containing a fixed temperature and water level.
+    """
+
+    # Byte values from the firmware's RPiIF::Byte enum
+    START_BYTE = 0x7E
+    STOP_BYTE = 0x7D
+    SETPOINT = 0x5C
+    SYSTEM_POWER = 0x88
+    TEMPERATURE = 0x3A
+    DISTANCE = 0x2F
+    rpi_frame_size = 9  # START, SYSTEM_POWER, power, SETPOINT, 4 x setpoint, STOP
+
+    def __init__(self, water_temp=40.0, water_level=80):
+        self.water_temp = water_temp
+        self.water_level = water_level
+        self.system_power = False
+        self.setpoint = 0.0
+
+    def handle_frame(self, system_power, setpoint):
+        """
+        Called for every valid frame received from the RPi.
+
+        Returns:
+            tuple: (water_temp, water_level) to send back.
+        """
+        self.system_power = system_power
+        self.setpoint = setpoint
+        return self.water_temp, self.water_level
+
+    def receive(self, data):
+        """
+        Parses the bytes written by the RPi and returns the bytes the firmware would answer with.
+
+        Args:
+            data (bytes): Bytes written by ArduinoIF.
+
+        Returns:
+            bytes: The response bytes (empty if no valid frame was found).
+        """
+        response = b""
+        start = data.find(self.START_BYTE)
+        while start != -1:
+            frame = data[start:start + self.rpi_frame_size]
+            if len(frame) < self.rpi_frame_size:
+                break
+            if frame[1] == self.SYSTEM_POWER and frame[3] == self.SETPOINT and frame[-1] == self.STOP_BYTE:
+                setpoint = struct.unpack("<f", frame[4:8])[0]
+                water_temp, water_level = self.handle_frame(bool(frame[2]), setpoint)
+                response += self.build_data_frame(water_temp, water_level)
+                start = data.find(self.START_BYTE, start + self.rpi_frame_size)
+            else:
+                start = data.find(self.START_BYTE, start + 1)
+        return response
+
+    def build_data_frame(self, water_temp, water_level):
+        """
+        Builds a data frame in the same byte layout as DataManager.cpp on the firmware side.
+        """
+        level = max(0, min(255, int(round(water_level))))
+        return (
+            bytes([self.START_BYTE, self.DISTANCE, level, self.TEMPERATURE])
+            + struct.pack("<f", water_temp)
+            + bytes([self.STOP_BYTE])
+        )
+
+
+class SimulatedTransport(Transport):
+    """
+    In-process transport backed by a simulated Arduino. Responses are available immediately,
+    so the whole stack can run on a development machine without hardware and without waiting on select timeouts.
+    """
+
+    name = "sim"
+
+    def __init__(self, device=None):
+        self.device = device if device is not None else SimulatedArduino()
+        self._open = False
+        self._rx_buffer = bytearray()
+
+    def __repr__(self):
+        return f"SimulatedTransport({type(self.device).__name__})"
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+        self._rx_buffer.clear()
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def write(self, data):
+        self._rx_buffer += self.device.receive(bytes(data))
+
+    def wait_readable(self, timeout):
+        return bool(self._rx_buffer)
+
+    def read_available(self):
+        data = bytes(self._rx_buffer)
+        self._rx_buffer.clear()
+        return data
+
+
+def configured_devices(default_name):
+    """
+    The tanks to control, from ECOTANK_DEVICES: comma separated name=spec pairs, where spec is
+    "serial:<port>", "tcp:<host>:<port>" or "sim", e.g. "kitchen=serial:/dev/ttyACM0,garage=tcp:10.0.0.5:2000".
+    Without ECOTANK_DEVICES there is a single tank called default_name, using the transport configured by
+    ECOTANK_TRANSPORT (see create_transport).
+
+    Returns:
+        list: (name, spec) tuples, spec None for the ECOTANK_TRANSPORT configuration.
+    """
+    log_ctx = "Configured Devices:"
+    devices = []
+    for entry in environ.get("ECOTANK_DEVICES", "").split(","):
+        name, _, spec = entry.strip().partition("=")
+        name = name.strip()
+        if not name:
+            continue
+        if not spec.strip() or name in (existing for existing, _ in devices):
+            logger.log(log_ctx, f"Ignoring device entry '{entry.strip()}'", "WARNING")
+            continue
+        devices.append((name, spec.strip()))
+    return devices or [(default_name, None)]
+
+
+def create_transport(spec=None, device=None):
+    """
+    Creates the transport selected by spec (see configured_devices), or by the environment configuration.
+
+    Environment variables:
+        ECOTANK_TRANSPORT: "serial" (default), "tcp" or "sim".
+        ECOTANK_SERIAL_PORT: Serial device for the serial transport (default "/dev/ttyACM0").
+        ECOTANK_BAUD_RATE: Baud rate for the serial transport (default 250000, must match the atmega2560).
+        ECOTANK_TCP_HOST / ECOTANK_TCP_PORT: Address of the ser2net server for the tcp transport.
+        ECOTANK_TRACE_FILE: If set, every chunk written and read is recorded to this file. See serial_trace.py.
+            With a device name, the name is added to the file name, so several links are recorded separately.
+        ECOTANK_TRACE_MAX_BYTES / ECOTANK_TRACE_BACKUPS: Rotation size and number of rotated trace files to keep.
+
+    Args:
+        spec (str, optional): "serial:<port>", "tcp:<host>:<port>" or "sim". Overrides ECOTANK_TRANSPORT and
+            the port or address variables; ECOTANK_BAUD_RATE still applies.
+        device (str, optional): Name of the tank the transport is for.
+
+    Returns:
+        Transport: The configured transport, not yet opened.
+    """
+    log_ctx = "Create Transport:"
+    if spec is not None:
+        kind, _, address = spec.partition(":")
+        kind = kind.lower()
+    else:
+        kind = environ.get("ECOTANK_TRANSPORT", "serial").lower()
+        address = None
+
+    if kind == "tcp":
+        if address:
+            host, _, port = address.rpartition(":")
+        else:
+            host, port = environ.get("ECOTANK_TCP_HOST", "localhost"), environ.get("ECOTANK_TCP_PORT", "2000")
+        try:
+            port = int(port)
+        except ValueError:
+            port = 2000
+        transport = TcpTransport(host or "localhost", port)
+    elif kind == "sim":
+        transport = SimulatedTransport()
+    else:
+        if kind != "serial":
+            logger.log(log_ctx, f"Unknown transport '{kind}', falling back to serial", "WARNING")
+        try:
+            baud_rate = int(environ.get("ECOTANK_BAUD_RATE", "250000"))
+        except ValueError:
+            baud_rate = 250000
+        transport = SerialTransport(address or environ.get("ECOTANK_SERIAL_PORT", "/dev/ttyACM0"), baud_rate)
+
+    trace_file = environ.get("ECOTANK_TRACE_FILE")
+    if trace_file and device is not None:
+        root, extension = os.path.splitext(trace_file)
+        trace_file = f"{root}-{device}{extension}"
+    if trace_file:
+        from .serial_trace import wrap_with_recorder
+
+        try:
+            max_bytes = int(environ.get("ECOTANK_TRACE_MAX_BYTES", "1000000"))
+            backup_count = int(environ.get("ECOTANK_TRACE_BACKUPS", "5"))
+        except ValueError:
+            max_bytes, backup_count = 1_000_000, 5
+        transport = wrap_with_recorder(transport, trace_file, max_bytes, backup_count)
+
+    logger.log(log_ctx, f"Using {transport!r}" + (f" for {device}" if device is not None else ""))
+    return transport
@@ -0,0 +1,174 @@
+"""
+Streaming export of stored data as CSV or JSON lines, shared by the /export routes and export.py.
+
+Rows are read with yield_per, so SQLite hands them over in batches through a single cursor, and the output is
+produced as a generator of byte chunks. Memory use is therefore constant, whatever the size of the date range.
+"""
+import csv
+import hashlib
+import io
+import json
+import zlib
+from datetime import datetime
+from sqlalchemy import select, func
+import shared_db as db
+
+
+# Dataset name -> (model, time column name, exported column names, filtered by region)
+DATASETS = {
+    "prices": (db.ElectricityPrice, "time_start", ["time_start", "time_end", "region", "DKK_per_kWh", "EUR_per_kWh", "EXR"], True),
+    "forecasts": (db.PriceForecast, "time_start", ["time_start", "region", "DKK_per_kWh", "DKK_lower", "DKK_upper", "created_at"], True),
+    "telemetry": (db.SensorReading, "time", ["time", "water_temp", "water_level", "setpoint", "sys_power", "device"], False),
+}
+FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+# Bytes per yielded chunk and rows per database fetch. Together they set the peak memory of an export, which
+# memory_check.py holds to its budget: the fetched batch is held twice (raw and processed rows), and the chunk is
+# buffered as text and as bytes
+CHUNK_SIZE = 32 * 1024
+BATCH_SIZE = 500
+
+
+def parse_time(value):
+    """
+    Parses an ISO date or datetime from a query string or command line. Returns None for an empty value.
+
+    Raises:
+        ValueError: If the value is not an ISO date or datetime.
+    """
+    if not value:
+        return None
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def _filters(dataset, region, start, end):
+    model, time_name, _, by_region = DATASETS[dataset]
+    time_column = getattr(model, time_name)
+    filters = []
+    if by_region and region:
+        filters.append(model.region == region)
+    if start is not None:
+        filters.append(time_column >= start)
+    if end is not None:
+        filters.append(time_column < end)
+    return filters
+
+
+def iter_rows(session, dataset, region=None, start=None, end=None, batch_size=BATCH_SIZE):
+    """
+    Yields the rows of a dataset as tuples, oldest first. Prices include the price archive.
+
+    Args:
+        session (Session): The SQLAlchemy session to read with.
+        dataset (str): A key of DATASETS.
+        region (str, optional): Only rows for this region (ignored for datasets without a region).
+        start (datetime, optional): Inclusive start of the range.
+        end (datetime, optional): Exclusive end of the range.
+    """
+    model, time_name, columns, _ = DATASETS[dataset]
+    archived_days = set()
+    if dataset == "prices" and region:
+        # Archived days come first and are served from the archive only, like in shared_db
+        archived_days = set(db.price_archive.days(region))
+        for time_start, time_end, dkk, eur, exr in db.price_archive.read_range(region, start, end):
+            yield time_start, time_end, region, dkk, eur, exr
+
+    query = (
+        select(*(getattr(model, name) for name in columns))
+        .where(*_filters(dataset, region, start, end))
+        .order_by(getattr(model, time_name), model.id)
+        .execution_options(yield_per=batch_size)
+    )
+    for row in session.execute(query):
+        if archived_days and row[0].date() in archived_days:
+            continue
+        yield tuple(row)
+
+
+def export_version(session, dataset, region=None, start=None, end=None, fmt="csv", compress=False):
+    """
+    Returns a strong ETag for an export: the parameters plus the row count and highest id in the range.
+    Rows are only ever inserted or deleted, so the output bytes are the same as long as this value is.
+    For prices, the state of the region's archive is included.
+    """
+    model = DATASETS[dataset][0]
+    count, max_id = session.execute(
+        select(func.count(), func.max(model.id)).where(*_filters(dataset, region, start, end))
+    ).one()
+    archive_version = db.price_archive.version(region) if dataset == "prices" and region else None
+    key = f"{dataset}|{region}|{start}|{end}|{fmt}|{compress}|{count}|{max_id}|{archive_version}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _format_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def iter_export(session, dataset, region=None, start=None, end=None, fmt="csv", compress=False):
+    """
+    Yields the export as byte chunks of roughly CHUNK_SIZE.
+
+    Args:
+        fmt (str): "csv" (with a header row) or "jsonl" (one JSON object per line).
+        compress (bool): Gzip the output on the fly. The gzip header has no timestamp,
+            so the same data always gives the same bytes, which makes range requests possible.
+    """
+    columns = DATASETS[dataset][2]
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n") if fmt == "csv" else None
+    if writer is not None:
+        writer.writerow(columns)
+
+    def drain():
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor is not None else data
+
+    for row in iter_rows(session, dataset, region, start, end):
+        values = [_format_value(value) for value in row]
+        if writer is not None:
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values))))
+            buffer.write("\n")
+        if buffer.tell() >= CHUNK_SIZE:
+            chunk = drain()
+            if chunk:
+                yield chunk
+
+    chunk = drain()
+    if compressor is not None:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def slice_chunks(chunks, first, stop):
+    """
+    Yields the bytes [first, stop) of a chunk stream, for serving a byte range of a generated export.
+    """
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > first:
+            yield chunk[max(first - position, 0):stop - position]
+        position = end
+        if position >= stop:
+            return
+
+
+def export_filename(dataset, region=None, start=None, end=None, fmt="csv", compress=False):
+    parts = [dataset]
+    if region and DATASETS[dataset][3]:
+        parts.append(region)
+    if start is not None:
+        parts.append(start.date().isoformat())
+    if end is not None:
+        parts.append(end.date().isoformat())
+    return "_".join(parts) + f".{fmt}" + (".gz" if compress else "")
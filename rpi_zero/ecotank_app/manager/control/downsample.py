@@ -0,0 +1,110 @@
+"""
+Downsampling of long time series for charts, so the browser gets about one point per pixel of the plot however
+much history there is (see the price chart on /dashboard).
+
+The points kept are chosen with Largest-Triangle-Three-Buckets (Steinarsson, 2013): the series is split into
+equally sized buckets, and from each bucket the point forming the largest triangle with the point kept from the
+previous bucket and the mean of the next bucket is kept. That keeps the peaks and dips that make a price chart
+readable, which averaging or taking every n-th point would flatten.
+
+LTTB is sequential, each bucket depends on the point kept before it, so long series are first reduced with a
+vectorized min/max preselection to the minimum and maximum of minmax_ratio buckets per output point
+(MinMaxLTTB, Van Der Donckt et al., 2023). The LTTB loop then runs over a few points per bucket only.
+
+The min/max envelope of each bucket is returned too, so the chart can show the range the line was drawn from.
+"""
+from collections import namedtuple
+import numpy as np
+
+Downsampled = namedtuple("Downsampled", ["x", "y", "band_x", "lower", "upper"])
+
+
+def minmax_indices(y, buckets):
+    """
+    Indices of the minimum and maximum of y in each of buckets equally sized buckets, plus the first and last
+    point, in order. Points that don't fill a whole bucket at the end form one more bucket.
+    """
+    n = len(y)
+    if n <= 2 * buckets + 2:
+        return np.arange(n)
+    size = (n - 2) // buckets
+    middle = y[1 : 1 + buckets * size].reshape(buckets, size)
+    offsets = 1 + np.arange(buckets) * size
+    indices = [[0], offsets + middle.argmin(axis=1), offsets + middle.argmax(axis=1)]
+    rest = y[1 + buckets * size : n - 1]
+    if len(rest):
+        start = 1 + buckets * size
+        indices += [[start + rest.argmin(), start + rest.argmax()]]
+    indices.append([n - 1])
+    return np.unique(np.concatenate(indices))
+
+
+def lttb(x, y, n_out):
+    """
+    Indices of the n_out points of (x, y) that Largest-Triangle-Three-Buckets keeps. The first and last point are
+    always kept. Returns every index if there are no more than n_out points.
+    """
+    n = len(x)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    # n_out - 2 buckets between the fixed first and last point, and the mean of each from cumulative sums
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    x_sums = np.concatenate(([0.0], np.cumsum(x)))
+    y_sums = np.concatenate(([0.0], np.cumsum(y)))
+    counts = np.diff(edges)
+    x_means = np.append((x_sums[edges[1:]] - x_sums[edges[:-1]]) / counts, x[-1])
+    y_means = np.append((y_sums[edges[1:]] - y_sums[edges[:-1]]) / counts, y[-1])
+
+    kept = np.empty(n_out, dtype=np.intp)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        ax, ay = x[a], y[a]
+        cx, cy = x_means[bucket + 1], y_means[bucket + 1]
+        # Twice the triangle area; the constant factor doesn't change which point is largest
+        areas = np.abs((ax - cx) * (y[start:stop] - ay) - (ax - x[start:stop]) * (cy - ay))
+        a = start + int(areas.argmax())
+        kept[bucket + 1] = a
+    return kept
+
+
+def envelope(x, y, buckets):
+    """
+    The minimum and maximum of y in buckets equally sized buckets, at the x of the first point of each.
+
+    Returns:
+        tuple: (x, lower, upper) arrays.
+    """
+    edges = np.linspace(0, len(x), buckets + 1).astype(np.intp)[:-1]
+    edges = np.unique(edges)
+    return x[edges], np.minimum.reduceat(y, edges), np.maximum.reduceat(y, edges)
+
+
+def downsample(x, y, n_out, minmax_ratio=4):
+    """
+    Reduces a series to about n_out points for a chart n_out pixels wide.
+
+    Args:
+        x (np.ndarray): Increasing x values, e.g. milliseconds since the epoch.
+        y (np.ndarray): The values.
+        n_out (int): Points to keep.
+        minmax_ratio (int): Min/max buckets per output point in the preselection. 0 runs LTTB on every point.
+
+    Returns:
+        Downsampled: The kept points, and the min/max envelope in buckets of two output points. The envelope is
+        empty if the series was short enough to keep every point.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if len(x) <= n_out:
+        empty = np.empty(0)
+        return Downsampled(x, y, empty, empty, empty)
+    if minmax_ratio and len(x) > 2 * minmax_ratio * n_out:
+        preselected = minmax_indices(y, minmax_ratio * n_out // 2)
+        kept = preselected[lttb(x[preselected], y[preselected], n_out)]
+    else:
+        kept = lttb(x, y, n_out)
+    band_x, lower, upper = envelope(x, y, max(n_out // 2, 1))
+    return Downsampled(x[kept], y[kept], band_x, lower, upper)
@@ -0,0 +1,120 @@
+"""
+Finds hot water draw-offs in the stream of water level readings as they arrive.
+
+The firmware's BrugVarmtVand stops the pump while the level falls and refills with cold water once it has been
+stable for a while, so a draw-off is a stretch of falling level, ended by a stable level or a refill. The start is
+found with a one-sided CUSUM on the level drops: drops below drift per second are taken as sensor noise and
+leak away, while a steady fall accumulates until it passes threshold. The draw-off is then dated back to the last
+moment the sum was zero, before the fall began. The end is found on a ring buffer of the last settle seconds of
+readings: once the level across the whole buffer has moved by less than half the threshold the level is stable,
+and a rise of threshold above the lowest level means a refill started. The litres drawn come from the mean level of
+the buffer before the fall and once stable, kept as a running sum, as single readings are off by the sensor
+noise. Each reading takes constant time.
+
+The levels fed in should be filtered (see sensor_conditioner.py), as the raw ultrasonic readings jump by a few
+percent. The filter delays the start and end by a few readings, which doesn't matter for the usage profile.
+"""
+from collections import deque, namedtuple
+
+DrawOff = namedtuple("DrawOff", ["start", "end", "litres", "water_temp"])
+
+
+class DrawOffDetector(object):
+    """
+    Streaming draw-off detection on the water level.
+
+    Args:
+        capacity_l (float): Litres at 100 % water level.
+        drift (float): Fall in % per second allowed as noise, well below the fall of a running tap.
+        threshold (float): Fall in % that makes a draw-off, and the rise that ends one as a refill.
+        settle (float): Seconds of stable level that end a draw-off.
+        max_gap (float): Seconds between readings after which the detector starts over, e.g. after a lost link.
+    """
+
+    def __init__(self, capacity_l=200.0, drift=0.01, threshold=2.5, settle=60.0, max_gap=120.0):
+        self.capacity_l = capacity_l
+        self.drift = drift
+        self.threshold = threshold
+        self.settle = settle
+        self.max_gap = max_gap
+        self.recent = deque()  # (time, level) of the last settle seconds
+        self.recent_sum = 0.0  # Sum of the levels in recent
+        self.previous = None  # (time, level) of the last reading
+        self.cusum = 0.0
+        self.anchor = None  # (time, level, temperature) where the cusum was last zero
+        self.lowest = None  # Lowest level of the open draw-off, None while there is none
+        self.lowest_at = None
+
+    def reset(self):
+        """
+        Forgets the readings so far, dropping an open draw-off.
+        """
+        self.recent.clear()
+        self.recent_sum = 0.0
+        self.previous = self.anchor = self.lowest = self.lowest_at = None
+        self.cusum = 0.0
+
+    @property
+    def drawing(self):
+        """
+        True while a draw-off is in progress.
+        """
+        return self.lowest is not None
+
+    def update(self, moment, level, water_temp):
+        """
+        Adds a reading.
+
+        Args:
+            moment (datetime): Time of the reading.
+            level (float): Water level in percent.
+            water_temp (float): Water temperature, recorded as the temperature of the water drawn.
+
+        Returns:
+            DrawOff or None: The draw-off that the reading ended, if any.
+        """
+        if self.previous is not None:
+            elapsed = (moment - self.previous[0]).total_seconds()
+            if elapsed <= 0:
+                return None
+            if elapsed > self.max_gap:
+                self.reset()
+        self.recent.append((moment, level))
+        self.recent_sum += level
+        while (moment - self.recent[0][0]).total_seconds() > self.settle:
+            self.recent_sum -= self.recent.popleft()[1]
+        if self.previous is None:
+            self.previous = (moment, level)
+            self.anchor = (moment, level, water_temp)
+            return None
+
+        self.cusum = max(0.0, self.cusum + (self.previous[1] - level) - self.drift * elapsed)
+        self.previous = (moment, level)
+
+        if self.lowest is None:
+            if self.cusum == 0.0:
+                self.anchor = (moment, self.recent_sum / len(self.recent), water_temp)
+            elif self.cusum >= self.threshold:
+                self.lowest, self.lowest_at = level, moment
+            return None
+
+        if level < self.lowest:
+            self.lowest, self.lowest_at = level, moment
+        # The buffer is full once its oldest reading is about settle seconds old
+        stable = (
+            (moment - self.recent[0][0]).total_seconds() >= self.settle * 0.9
+            and abs(self.recent[0][1] - level) < self.threshold / 2
+        )
+        if stable:
+            end_level = self.recent_sum / len(self.recent)
+        elif level >= self.lowest + self.threshold:
+            end_level = self.lowest  # Refilling already, the buffer holds the rise
+        else:
+            return None
+
+        start, start_level, start_temp = self.anchor
+        draw_off = DrawOff(start, self.lowest_at, max(start_level - end_level, 0.0) * self.capacity_l / 100.0, start_temp)
+        self.lowest = self.lowest_at = None
+        self.cusum = 0.0
+        self.anchor = (moment, end_level, water_temp)
+        return draw_off
@@ -1,8 +1,10 @@
 from datetime import datetime, date, timedelta
-import time
+from os import environ
 import shared_db as db
 from ..boundary.elpris_api import ElprisAPI
 from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from .price_forecaster import PriceForecaster
 
 
 class ElprisDataManager(object):
@@ -11,97 +13,202 @@ class ElprisDataManager(object):
     
     Checks for missing data in the database based on the amount of days specified in the user settings.
     The days specified represents the days back in time to fetch data for.
+    With several tanks, every price region in use is fetched, as far back as the longest days_to_fetch.
     Only fetches data from the API if there is missing data in the database. Uses the ElprisAPI class.
+
+    Hours past the published horizon are covered by provisional prices from a PriceForecaster per region,
+    refreshed hourly and whenever new prices are stored. Stored prices replace the forecasts for their hours.
+
+    Once a day, prices older than ECOTANK_PRICE_RETENTION_DAYS (default 60, at least days_to_fetch + 1) are moved
+    to the price archive, which keeps the live table small (see price_archive.py).
+
+    Args:
+        api (ElprisAPI, optional): Price source, defaults to the live API. Any object with a fetch_elpris method works.
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
     """
 
-    def __init__(self):
-        self.api = ElprisAPI()
-        self.next_check_time = datetime.now()
+    def __init__(self, api=None, clock=None):
+        self.clock = clock if clock is not None else system_clock
+        self.api = api if api is not None else ElprisAPI(clock=self.clock)
+        self.next_check_time = self.clock.now()
+        self.next_forecast_time = self.clock.now()
+        self.forecast_hours = 48
+        self.forecasters = {}  # Region -> PriceForecaster
+        self.next_archive_time = self.clock.now()
+        try:
+            self.retention_days = int(environ.get("ECOTANK_PRICE_RETENTION_DAYS", "60"))
+        except ValueError:
+            self.retention_days = 60
 
     def fetch_missing_data(self) -> None:
         """
         Fetches missing electricity price data from the API and stores it in the database.
         """
         log_ctx = "Fetch Missing Data:"
-        if datetime.now() < self.next_check_time:
+        now = self.clock.now()
+        if now < self.next_check_time:
             return
 
         with db.Session() as session:
             try:
-                user_settings = db.get_user_settings(session)
-                region = user_settings.price_region
+                all_settings = [db.get_user_settings(session, device) for device in db.get_devices(session)]
+                regions = sorted({user_settings.price_region for user_settings in all_settings})
+                days_to_fetch = max(user_settings.days_to_fetch for user_settings in all_settings)
             except Exception as e:
                 logger.log(log_ctx, "Error querying database", "ERROR", e)
                 return
 
-            start_date: date = date.today() - timedelta(days=user_settings.days_to_fetch)
-            end_date: date = date.today()
-            if datetime.now().hour > 15:
+            start_date: date = now.date() - timedelta(days=days_to_fetch)
+            end_date: date = now.date()
+            if now.hour > 15:
                 end_date += timedelta(days=1)
 
-        missing_dates = sorted(self._check_for_missing_data(start_date, end_date, region))
+        forecast_due = now >= self.next_forecast_time
+        complete = True
+        for region in regions:
+            missing_dates = self._check_for_missing_data(start_date, end_date, region)
+            if missing_dates is None:  # Already logged
+                complete = False
+                continue
+            missing_dates = sorted(missing_dates)
+            complete = complete and not missing_dates
+
+            committed = False
+            for missing_date in missing_dates:
+                year = missing_date.year
+                month = f"{missing_date.month:02d}"
+                day = f"{missing_date.day:02d}"
+
+                json_data = self.api.fetch_elpris(year, month, day, region)
+
+                if json_data is not None:
+                    committed = self._convert_json_and_commit(json_data, region) or committed
+                else:
+                    logger.log(log_ctx, f"Failed to fetch data for {region} on {missing_date}", level="WARNING")
+                    break
+                self.clock.sleep(2)
+
+            if committed or forecast_due:
+                self.update_forecast(region)
+
+        if complete:
+            self.next_check_time = now + timedelta(hours=1)
+
+        if now >= self.next_archive_time:
+            self.archive_old_prices(days_to_fetch)
+
+    def archive_old_prices(self, days_to_fetch) -> None:
+        """
+        Moves prices older than the retention horizon to the price archive. Never archives days within
+        days_to_fetch, so the missing data check keeps finding them in the database.
 
-        if not missing_dates:
-            self.next_check_time = datetime.now() + timedelta(hours=1)
-            return
+        Args:
+            days_to_fetch (int): The user's days_to_fetch setting.
+        """
+        log_ctx = "Archive Old Prices:"
+        now = self.clock.now()
+        self.next_archive_time = now + timedelta(days=1)
+        retention_days = max(self.retention_days, days_to_fetch + 1)
+        cutoff = datetime.combine(now.date() - timedelta(days=retention_days), datetime.min.time())
 
-        for missing_date in missing_dates:
-            year = missing_date.year
-            month = f"{missing_date.month:02d}"
-            day = f"{missing_date.day:02d}"
+        with db.Session() as session:
+            try:
+                moved = db.archive_prices(session, cutoff)
+            except Exception as e:
+                logger.log(log_ctx, "Error archiving electricity prices", "ERROR", e)
+                return
+        if moved:
+            logger.log(log_ctx, f"Archived {moved} electricity prices from before {cutoff.date()}")
+
+    def update_forecast(self, region) -> None:
+        """
+        Trains the region's forecaster on the days stored since the last update and replaces the stored forecasts
+        for the hours between the last stored price and forecast_hours from now.
+
+        Args:
+            region (str): The price region to forecast.
+        """
+        log_ctx = "Update Forecast:"
+        now = self.clock.now()
+        self.next_forecast_time = now + timedelta(hours=1)
+        forecaster = self.forecasters.get(region)
+        if forecaster is None:
+            forecaster = self.forecasters[region] = PriceForecaster(region)
 
-            json_data = self.api.fetch_elpris(year, month, day, region)
+        with db.Session() as session:
+            try:
+                since = None
+                if forecaster.last_day is not None:
+                    since = datetime.combine(forecaster.last_day + timedelta(days=1), datetime.min.time())
+                forecaster.train(db.get_price_history(session, region, since))
+                last_price_time = db.get_last_price_time(session, region)
+            except Exception as e:
+                logger.log(log_ctx, "Error querying database", "ERROR", e)
+                return
 
-            if json_data is not None:
-                self._convert_json_and_commit(json_data, region)
-            else:
-                logger.log(log_ctx, f"Failed to fetch data for date {missing_date}", level="WARNING")
-                break
-            time.sleep(2)
+            current_hour = now.replace(minute=0, second=0, microsecond=0)
+            start = current_hour
+            if last_price_time is not None:
+                start = max(start, last_price_time + timedelta(hours=1))
+            hours = (current_hour + timedelta(hours=self.forecast_hours) - start) // timedelta(hours=1)
+            forecast = forecaster.forecast(start, hours)
+            entries = []
+            if forecast is not None:
+                times, prices, lower, upper = forecast
+                entries = [
+                    db.PriceForecast(
+                        region=region,
+                        time_start=time_start,
+                        DKK_per_kWh=float(prices[i]),
+                        DKK_lower=float(lower[i]),
+                        DKK_upper=float(upper[i]),
+                        created_at=now,
+                    )
+                    for i, time_start in enumerate(times)
+                ]
+
+            try:
+                db.replace_price_forecasts(session, region, entries)
+            except Exception as e:
+                logger.log(log_ctx, "Error committing to database", "ERROR", e)
+                return
+        if forecast is not None:
+            logger.log(log_ctx, f"Forecasted {len(forecast[0])} hours for {region} from {start}")
 
     def _check_for_missing_data(self, start_date, end_date, region):
         """
-        Checks for missing electricity price data in the specified date range.
+        Checks for missing electricity price data in the specified date range, with one bulk load into the
+        shared price cache instead of a query per day (see price_cache.py).
 
         Args:
             start_date (date): The start date of the range.
             end_date (date): The end date of the range.
 
         Returns:
-            list: A list of missing dates.
+            list: A list of missing dates, or None if the database couldn't be read.
         """
         log_ctx = "Check For Missing Data:"
         logger.log(log_ctx, f"Checking for missing data from {start_date} to {end_date}")
 
-        hour_to_check = 0
-        missing_dates: list = []
-
-        with db.Session() as session:
-            current_date: date = start_date
-            while current_date <= end_date:
-                try:
-                    if not db.get_electricity_price(
-                        session=session,
-                        year=current_date.year,
-                        month=current_date.month,
-                        day=current_date.day,
-                        hour=hour_to_check,
-                        region=region,
-                    ):
-                        missing_dates.append(current_date)
-                        logger.log(log_ctx, f"Missing data for dates: {current_date}")
-                except Exception as e:
-                    logger.log(log_ctx, "Error querying database", "ERROR", e)
-                    return None
-                current_date += timedelta(days=1)
+        try:
+            missing_dates = db.price_cache.missing_days(region, start_date, end_date)
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
+            return None
+        for missing_date in missing_dates:
+            logger.log(log_ctx, f"Missing data for dates: {missing_date}")
         return missing_dates
 
-    def _convert_json_and_commit(self, json_data, region) -> None:
+    def _convert_json_and_commit(self, json_data, region) -> bool:
         """
         Converts JSON data to ElectricityPrice objects and commits them to the database.
+        Forecasts for the same hours are deleted in the same transaction.
 
         Args:
             json_data: The JSON data to convert and commit.
+
+        Returns:
+            bool: True if the entries were committed.
         """
         log_ctx = "Convert JSON and Commit:"
         entries: list = []
@@ -121,7 +228,10 @@ class ElprisDataManager(object):
         with db.Session() as session:
             try:
                 session.add_all(entries)
+                db.delete_price_forecasts(session, region, max(entry.time_start for entry in entries))
                 session.commit()
                 logger.log(log_ctx, "Successfully committed electricity price entries to database")
+                return True
             except Exception as e:
                 logger.log(log_ctx, "Error committing to database", "ERROR", e)
+                return False
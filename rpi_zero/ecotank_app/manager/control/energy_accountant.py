@@ -0,0 +1,188 @@
+from datetime import timedelta
+from os import environ
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from ..boundary import change_bus as changes
+from ..boundary.change_bus import CachedValue
+import shared_db as db
+
+
+class EnergyAccountant(object):
+    """
+    Estimates the heater's on-time, energy and cost from the readings of each control tick, and keeps running
+    totals per hour and per day (EnergyHour and EnergyDay in shared_db).
+
+    The tank has no power meter, but the Arduino's RegulateTemp heats exactly while the system is powered and
+    the water is below the setpoint. Between two exchanges the setpoint and power sent at the first one apply,
+    so the heater was on for the part of the interval the temperature trajectory spent below the setpoint:
+    all of it if both readings are below, none if both are above, and the linearly interpolated share before
+    or after the crossing otherwise. Energy is on-time times the element's rated power, and cost is energy
+    times the price of the hour the interval started in.
+
+    While the water is held at the setpoint the heater switches many times between two readings, so the
+    readings alone can't show it. The heater then just replaces the standing loss, and its duty cycle is
+    cooling / (heating + cooling), with the rates (K/s) learned from the trajectory: heating from intervals
+    with the heater on all the time, cooling from intervals with it off. That needs neither the tank volume
+    nor its insulation.
+
+    Every update adds to the open hour and day, so the cost is constant per tick however much history there is.
+    The totals are written when the hour changes and every flush_interval seconds, and reloaded after a restart.
+    The day also sums its hourly prices, so the dashboard can compare with what the energy would have cost at
+    the day's flat average price.
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+        heater_power_w (float, optional): Rated heater power, defaults to ECOTANK_HEATER_POWER_W or 3000 W.
+        max_tick (float): Longest interval in seconds credited to one update, so a gap in the readings
+            (a lost link, a restart) isn't counted as hours of heating.
+        flush_interval (float): Seconds between writes of the open totals.
+        hold_band (float): Readings within this many degrees of the setpoint count as holding it.
+        device (str, optional): The tank the totals are kept for, defaults to shared_db.DEFAULT_DEVICE.
+    """
+
+    # Starting points for the learned rates: a 3 kW element in 200 l, and a tank losing 1 °C an hour
+    DEFAULT_HEATING_RATE = 3000.0 / (200 * 4186.0)
+    DEFAULT_COOLING_RATE = 1.0 / 3600
+    RATE_ALPHA = 0.01  # EMA weight of one interval
+
+    def __init__(self, clock=None, heater_power_w=None, max_tick=60.0, flush_interval=300.0, hold_band=0.5, device=None):
+        self.clock = clock if clock is not None else system_clock
+        self.device = device if device is not None else db.DEFAULT_DEVICE
+        if heater_power_w is None:
+            try:
+                heater_power_w = float(environ.get("ECOTANK_HEATER_POWER_W", "3000"))
+            except ValueError:
+                heater_power_w = 3000.0
+        self.heater_power_w = heater_power_w
+        self.max_tick = max_tick
+        self.flush_interval = flush_interval
+        self.hold_band = hold_band
+        self.heating_rate = self.DEFAULT_HEATING_RATE
+        self.cooling_rate = self.DEFAULT_COOLING_RATE
+        self.settings = CachedValue(db.change_bus, self._load_settings, changes.SETTINGS)
+        self.previous = None  # (time, system power, setpoint, water temperature) of the last update
+        self.power_w = 0.0  # Estimated heater power over the last interval
+        self.hour = None  # Open EnergyHour values
+        self.day = None  # Open EnergyDay values
+        self.next_flush = None
+
+    def _load_settings(self):
+        with db.Session() as session:
+            return db.snapshot(db.get_user_settings(session, self.device))
+
+    def heating_fraction(self, start_temp, end_temp, setpoint, powered, seconds):
+        """
+        Share of an interval the heater was on, given the temperatures at its ends and the power and setpoint
+        it ran with. Also updates the learned heating and cooling rates.
+        """
+        rate = (end_temp - start_temp) / seconds
+        if not powered or setpoint is None:
+            fraction = 0.0
+        elif start_temp < setpoint and end_temp < setpoint:
+            fraction = 1.0
+        elif abs(start_temp - setpoint) <= self.hold_band and abs(end_temp - setpoint) <= self.hold_band:
+            fraction = self.cooling_rate / (self.heating_rate + self.cooling_rate)
+        elif start_temp >= setpoint and end_temp >= setpoint:
+            fraction = 0.0
+        elif start_temp < setpoint:  # Heated up to the setpoint, then off
+            fraction = (setpoint - start_temp) / (end_temp - start_temp)
+        else:  # Cooled below the setpoint, then on
+            fraction = (setpoint - end_temp) / (start_temp - end_temp)
+
+        # A refill with cold water cools faster than any heat loss, and can pull the temperature down while
+        # the heater is on, so only plausible rates are learned
+        if fraction == 1.0 and rate > 0:
+            self.heating_rate += self.RATE_ALPHA * (rate - self.heating_rate)
+        elif fraction == 0.0 and 0 <= -rate < self.heating_rate:
+            self.cooling_rate += self.RATE_ALPHA * (-rate - self.cooling_rate)
+        return fraction
+
+    def update(self, system_power, setpoint, water_temp):
+        """
+        Accounts for the interval since the previous update. Call after every successful exchange with the values
+        that were sent and the temperature that came back.
+        """
+        log_ctx = "Energy Accountant:"
+        now = self.clock.now()
+        previous, self.previous = self.previous, (now, system_power, setpoint, water_temp)
+        if previous is None:
+            return
+        then, was_powered, previous_setpoint, previous_temp = previous
+        elapsed = (now - then).total_seconds()
+        if elapsed <= 0:
+            return
+
+        try:
+            self._open(then)
+            self._update_price()
+        except Exception as e:
+            logger.log(log_ctx, "Error reading energy totals or prices from database", "ERROR", e)
+            self.hour = self.day = None  # Reloaded next time, so nothing is written from a half-loaded state
+            return
+
+        fraction = self.heating_fraction(previous_temp, water_temp, previous_setpoint, was_powered, elapsed)
+        self.power_w = self.heater_power_w * fraction
+        heating_seconds = min(elapsed, self.max_tick) * fraction
+        if heating_seconds > 0:
+            energy_wh = self.heater_power_w * heating_seconds / 3600.0
+            price = self.hour["price_dkk"]
+            for totals in (self.hour, self.day):
+                totals["heating_seconds"] += heating_seconds
+                totals["energy_wh"] += energy_wh
+                if price is not None:
+                    totals["priced_wh"] += energy_wh
+                    totals["cost_dkk"] += energy_wh / 1000.0 * price
+
+        if now >= self.next_flush:
+            self.flush()
+
+    def _open(self, moment):
+        """
+        Makes the hour containing moment the open one, writing the previous hour and loading any stored totals.
+        """
+        hour_start = moment.replace(minute=0, second=0, microsecond=0)
+        if self.hour is not None and self.hour["hour_start"] == hour_start:
+            return
+        if self.hour is not None:
+            self.flush()
+
+        with db.Session() as session:
+            hour_entry = db.get_energy_hour(session, hour_start, self.device)
+            day_entry = db.get_energy_day(session, hour_start.date(), self.device)
+            self.hour = self._values(hour_entry, device=self.device, hour_start=hour_start, price_dkk=None)
+            self.day = self._values(day_entry, device=self.device, day=hour_start.date(), price_sum=0.0, price_hours=0)
+        self.next_flush = self.clock.now() + timedelta(seconds=self.flush_interval)
+
+    @staticmethod
+    def _values(entry, **defaults):
+        values = dict(heating_seconds=0.0, energy_wh=0.0, priced_wh=0.0, cost_dkk=0.0, **defaults)
+        if entry is not None:
+            values = {name: getattr(entry, name) for name in values}
+        return values
+
+    def _update_price(self):
+        """
+        Records the open hour's price once it is known, and adds it to the day's sum for the flat average.
+        """
+        if self.hour["price_dkk"] is not None:
+            return
+        user_settings = self.settings.get()
+        price = db.price_cache.hour_price(user_settings.price_region, self.hour["hour_start"])
+        if price is not None:
+            self.hour["price_dkk"] = price
+            self.day["price_sum"] += price
+            self.day["price_hours"] += 1
+
+    def flush(self):
+        """
+        Writes the open hour and day. Publishes an ENERGY change, see change_bus.py.
+        """
+        log_ctx = "Energy Accountant:"
+        if self.hour is None:
+            return
+        self.next_flush = self.clock.now() + timedelta(seconds=self.flush_interval)
+        with db.Session() as session:
+            try:
+                db.save_energy(session, dict(self.hour), dict(self.day))
+            except Exception as e:
+                logger.log(log_ctx, "Error saving energy totals to database", "ERROR", e)
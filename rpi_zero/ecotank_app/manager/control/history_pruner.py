@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+from os import environ
+import shared_db as db
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+
+MIN_RETENTION_DAYS = 8  # The thermal calibration is fitted on the last 7 days of readings, see thermal_calibrator.py
+
+
+class HistoryPruner(object):
+    """
+    Keeps the recorded history from growing without bound on the SD card. Once a day, sensor readings and draw-off
+    events older than ECOTANK_READING_RETENTION_DAYS (default 90, at least MIN_RETENTION_DAYS) are deleted, like
+    ElprisDataManager archives old prices. The usage profile and the energy totals are kept; they are aggregates and
+    don't need the rows they were built from.
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else system_clock
+        self.next_prune_time = self.clock.now()
+        try:
+            self.retention_days = int(environ.get("ECOTANK_READING_RETENTION_DAYS", "90"))
+        except ValueError:
+            self.retention_days = 90
+        self.retention_days = max(self.retention_days, MIN_RETENTION_DAYS)
+
+    def update(self) -> None:
+        """
+        Prunes the history if a day has passed since the last time. Cheap to call every loop iteration.
+        """
+        log_ctx = "Prune History:"
+        now = self.clock.now()
+        if now < self.next_prune_time:
+            return
+        self.next_prune_time = now + timedelta(days=1)
+        cutoff = datetime.combine(now.date() - timedelta(days=self.retention_days), datetime.min.time())
+
+        with db.Session() as session:
+            try:
+                readings, draw_offs = db.prune_history(session, cutoff)
+            except Exception as e:
+                logger.log(log_ctx, "Error deleting old sensor readings and draw-offs", "ERROR", e)
+                return
+        if readings or draw_offs:
+            logger.log(log_ctx, f"Deleted {readings} sensor readings and {draw_offs} draw-offs from before {cutoff.date()}")
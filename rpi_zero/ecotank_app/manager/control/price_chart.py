@@ -0,0 +1,149 @@
+"""
+The price chart on /dashboard: the prices of a region downsampled to the plot width (see downsample.py), and the
+price forecast with its band.
+
+price_chart builds the Bokeh figure, which takes seconds on a Pi Zero, so the webserver runs it as a job in a worker
+process (see job_queue.py). Nothing here may depend on Flask; the worker opens the database through shared_db.
+Bokeh and NumPy are imported on first use, so importing this module is cheap.
+"""
+from datetime import datetime, timedelta
+from math import ceil, floor
+from itertools import chain
+import shared_db
+
+PLOT_WIDTH = 800  # Width of the price chart in pixels, until the browser reports the real width
+PLOT_HEIGHT = 500
+EPOCH = datetime(1970, 1, 1)  # Bokeh's datetime axes count milliseconds from here, in the naive times the prices use
+# The range of datetime in milliseconds since EPOCH, with room for the day added at each end
+MIN_MS = (datetime.min - EPOCH + timedelta(days=2)) / timedelta(milliseconds=1)
+MAX_MS = (datetime.max - EPOCH - timedelta(days=2)) / timedelta(milliseconds=1)
+
+
+def price_chart_data(region, width, start=None, end=None):
+    """
+    The prices of a region between start and end, downsampled to width points (see downsample.py), with the point
+    just outside each end so the line reaches the edges of the plot.
+
+    Args:
+        region (str): The price region.
+        width (int): Plot width in pixels.
+        start, end (float, optional): Visible range in milliseconds since EPOCH, defaults to all prices. Finite;
+            clamped to the range of datetime.
+
+    Returns:
+        Downsampled: x in milliseconds since EPOCH.
+    """
+    import numpy as np
+    from .downsample import downsample
+
+    start = min(max(start, MIN_MS), MAX_MS) if start is not None else None
+    end = min(max(end, MIN_MS), MAX_MS) if end is not None else None
+    first = (EPOCH + timedelta(milliseconds=start)).date() - timedelta(days=1) if start is not None else None
+    last = (EPOCH + timedelta(milliseconds=end)).date() + timedelta(days=1) if end is not None else None
+    # From the shared day arrays (see price_cache.py), so only the first request after new prices hits the database
+    times, prices = shared_db.price_cache.series(region, first, last)
+    x, y = np.frombuffer(times), np.frombuffer(prices)
+    lo = max(int(np.searchsorted(x, start, "right")) - 1, 0) if start is not None else 0
+    hi = int(np.searchsorted(x, end, "left")) + 1 if end is not None else len(x)
+    return downsample(x[lo:hi], y[lo:hi], width)
+
+
+def price_chart(region):
+    """
+    Builds the price chart of a region. Zooming fetches the visible window again in more detail, see dashboard.js.
+
+    Returns:
+        tuple: (script, div) to embed in the page.
+    """
+    from bokeh.plotting import figure
+    from bokeh.embed import components
+    from bokeh.models import (
+        DatetimeTickFormatter,
+        WheelZoomTool,
+        FixedTicker,
+        Range1d,
+        DataRange1d,
+        NumeralTickFormatter,
+        DatetimeTicker,
+        ColumnDataSource,
+        CustomJS,
+    )
+    from bokeh.events import RangesUpdate
+
+    # About a point per pixel
+    chart = price_chart_data(region, PLOT_WIDTH)
+    with shared_db.Session() as session:
+        forecasts = shared_db.get_price_forecasts(session, region)
+        forecast_datetimes = [forecast.time_start for forecast in forecasts]
+        forecast_prices = [forecast.DKK_per_kWh for forecast in forecasts]
+        forecast_lower = [forecast.DKK_lower for forecast in forecasts]
+        forecast_upper = [forecast.DKK_upper for forecast in forecasts]
+
+    # Determining the y-axis range with padding. The envelope holds the extremes the downsampled line may skip
+    min_price = min(chain(chart.y, chart.lower, forecast_lower), default=0.0)
+    max_price = max(chain(chart.y, chart.upper, forecast_upper), default=1.0)
+
+    # Adjust the start and end for ticks
+    tick_start = floor(min_price * 10) / 10
+    tick_end = ceil(max_price * 10) / 10
+
+    # Generating ticks every 0.1 within the range
+    y_ticks = [tick_start + i * 0.1 for i in range(int((tick_end - tick_start) / 0.1) + 1)]
+
+    y_range = Range1d(start=tick_start, end=tick_end)
+    # A fixed x range, since auto-ranging would follow the data of each refined window
+    x_ends = [chart.x[0], chart.x[-1]] if len(chart.x) else []
+    if forecasts:
+        x_ends += [(forecast_datetimes[i] - EPOCH) / timedelta(milliseconds=1) for i in (0, -1)]
+    x_range = Range1d(start=min(x_ends), end=max(x_ends), bounds="auto") if x_ends else DataRange1d()
+
+    # Creating the figure
+    p = figure(
+        title="Elpriser i DKK pr. kWh",
+        x_axis_label="Tidspunkt",
+        y_axis_label="DKK pr. kWh",
+        x_axis_type="datetime",
+        sizing_mode="scale_width",
+        width=PLOT_WIDTH,
+        height=PLOT_HEIGHT,
+        y_range=y_range,
+        x_range=x_range,
+        tools="pan",  # Include basic tools, excluding WheelZoomTool to customize it next
+    )
+
+    # Adding line renderer, with the min/max of the prices each stretch of the line stands for
+    line_source = ColumnDataSource(data={"x": chart.x, "y": chart.y})
+    band_source = ColumnDataSource(data={"x": chart.band_x, "lower": chart.lower, "upper": chart.upper})
+    p.varea(x="x", y1="lower", y2="upper", source=band_source, fill_alpha=0.15, legend_label="Min/maks")
+    p.line(x="x", y="y", source=line_source, legend_label="DKK per kWh", line_width=2)
+    p.js_on_event(
+        RangesUpdate,
+        CustomJS(
+            args={"plot": p, "line": line_source, "band": band_source},
+            code="refinePrices(plot, line, band, cb_obj.x0, cb_obj.x1);",
+        ),
+    )
+    if forecasts:
+        p.varea(x=forecast_datetimes, y1=forecast_lower, y2=forecast_upper, fill_alpha=0.2, legend_label="Usikkerhed")
+        p.line(forecast_datetimes, forecast_prices, legend_label="Prognose", line_width=2, line_dash="dashed")
+
+    p.xaxis.ticker = DatetimeTicker()
+    # Formatting the datetime ticks on the x-axis
+    p.xaxis.formatter = DatetimeTickFormatter(
+        minutes="%H:%M",
+        hours="%d/%m %H:%M",
+        days="%d/%m",
+        months="%B %Y",
+        years="%Y",
+    )
+
+    p.yaxis[0].ticker = FixedTicker(ticks=y_ticks)
+    p.yaxis[0].formatter = NumeralTickFormatter(format="0.0")
+
+    # Add customized WheelZoomTool
+    wheel_zoom = WheelZoomTool(dimensions="width")  # Enable zooming only on x-axis
+    p.add_tools(wheel_zoom)
+    p.toolbar.active_scroll = wheel_zoom  # Set the custom WheelZoomTool as the active scroll tool
+
+    # Components for embedding the plot in the webpage
+    return components(p)
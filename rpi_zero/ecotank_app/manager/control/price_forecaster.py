@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+import numpy as np
+
+
+class PriceForecaster(object):
+    """
+    Forecasts electricity prices for hours that are not published yet, for a single region.
+
+    The model is price(day, hour) = level + season[weekday, hour]:
+        - season is the exponentially weighted mean deviation from the daily mean, per weekday and hour.
+        - level is an exponential moving average of the daily means (recent-level adjustment).
+    Confidence bands use the exponentially weighted RMS of the one-day-ahead residuals per hour,
+    widened with the forecast horizon.
+
+    Training is incremental: every new day updates the 7x24 accumulators in O(1), so nothing is re-read.
+
+    Args:
+        region (str): The price region the model is trained for.
+    """
+
+    season_decay = 0.5 ** (1 / 28)  # Weight of a day halves after four weeks
+    level_alpha = 0.4  # EMA weight of a new daily mean
+    z = 1.645  # 90 % band, assuming normal residuals
+    min_hours_per_day = 20  # Days with fewer known hours are skipped
+
+    def __init__(self, region):
+        self.region = region
+        self.season_sum = np.zeros((7, 24))
+        self.season_weight = np.zeros((7, 24))
+        self.residual_sq_sum = np.zeros(24)
+        self.residual_weight = np.zeros(24)
+        self.level = None
+        self.last_day = None  # Last day the model was trained on
+
+    @property
+    def is_trained(self):
+        return self.level is not None
+
+    def seasonal(self):
+        return np.divide(self.season_sum, self.season_weight, out=np.zeros((7, 24)), where=self.season_weight > 0)
+
+    def sigma(self):
+        """
+        Per-hour residual standard deviation. Hours without residuals yet use the mean over the other hours,
+        or 25 % of the level before any residual is known.
+        """
+        known = self.residual_weight > 0
+        sigma = np.zeros(24)
+        sigma[known] = np.sqrt(self.residual_sq_sum[known] / self.residual_weight[known])
+        if known.any():
+            sigma[~known] = sigma[known].mean()
+        else:
+            sigma[:] = abs(self.level or 0.0) * 0.25
+        return sigma
+
+    def train_day(self, day, prices):
+        """
+        Updates the model with one day of prices.
+
+        Args:
+            day (date): The day the prices are for. Must be later than last_day.
+            prices (np.ndarray): 24 prices indexed by hour, NaN where unknown.
+        """
+        known = ~np.isnan(prices)
+        if known.sum() < self.min_hours_per_day:
+            return
+        weekday = day.weekday()
+        daily_mean = prices[known].mean()
+
+        # Score yesterday's model on this day before learning from it, for the confidence bands
+        if self.is_trained:
+            residual = prices - (self.level + self.seasonal()[weekday])
+            self.residual_sq_sum *= self.season_decay
+            self.residual_weight *= self.season_decay
+            self.residual_sq_sum[known] += residual[known] ** 2
+            self.residual_weight[known] += 1.0
+
+        self.season_sum *= self.season_decay
+        self.season_weight *= self.season_decay
+        self.season_sum[weekday, known] += prices[known] - daily_mean
+        self.season_weight[weekday, known] += 1.0
+
+        if self.level is None:
+            self.level = daily_mean
+        else:
+            self.level += self.level_alpha * (daily_mean - self.level)
+        self.last_day = day
+
+    def train(self, rows):
+        """
+        Trains on (time_start, price) rows, skipping days the model has already seen.
+
+        Args:
+            rows (iterable): (datetime, float) tuples, in any order.
+        """
+        days = {}
+        for time_start, price in rows:
+            day = time_start.date()
+            if self.last_day is not None and day <= self.last_day:
+                continue
+            days.setdefault(day, np.full(24, np.nan))[time_start.hour] = price
+        for day in sorted(days):
+            self.train_day(day, days[day])
+
+    def forecast(self, start, hours):
+        """
+        Forecasts consecutive hours.
+
+        Args:
+            start (datetime): The first hour to forecast (minutes and seconds are ignored).
+            hours (int): Number of hours to forecast.
+
+        Returns:
+            tuple: (list of datetimes, price array, lower band array, upper band array), or None if untrained.
+        """
+        if not self.is_trained or hours <= 0:
+            return None
+        start = start.replace(minute=0, second=0, microsecond=0)
+        times = [start + timedelta(hours=k) for k in range(hours)]
+        offsets = np.arange(hours)
+        hour_index = (start.hour + offsets) % 24
+        weekday_index = (start.weekday() + (start.hour + offsets) // 24) % 7
+
+        price = self.level + self.seasonal()[weekday_index, hour_index]
+        # The band widens with the number of days since the last trained day, like a random walk on the level
+        first_unknown = datetime.combine(self.last_day + timedelta(days=1), datetime.min.time())
+        hours_ahead = (start - first_unknown) // timedelta(hours=1) + offsets
+        days_ahead = np.maximum(hours_ahead // 24 + 1, 1)
+        band = self.z * self.sigma()[hour_index] * np.sqrt(days_ahead)
+        return times, price, price - band, price + band
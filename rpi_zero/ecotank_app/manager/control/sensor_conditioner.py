@@ -0,0 +1,157 @@
+from collections import deque
+from os import environ
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+
+
+class SignalFilter(object):
+    """
+    Streaming filter for a single sensor signal: a ring-buffered median removes spikes,
+    and an exponential moving average on the median smooths the remaining jitter.
+
+    Samples that are further than outlier_limit from the current median are rejected, once the window is full.
+    A step change is still accepted as soon as it has lasted long enough to move the median.
+
+    Args:
+        window (int): Number of samples in the median window.
+        alpha (float): EMA weight of a new median value (1.0 disables smoothing).
+        outlier_limit (float, optional): Max distance from the median before a sample is rejected.
+    """
+
+    def __init__(self, window=5, alpha=0.3, outlier_limit=None):
+        self.samples = deque(maxlen=window)
+        self.alpha = alpha
+        self.outlier_limit = outlier_limit
+        self.value = None
+        self.rejected = 0
+        self.pending_outliers = 0  # Consecutive rejected samples
+
+    def update(self, sample):
+        """
+        Adds a sample and returns the filtered value.
+        """
+        if self.outlier_limit is not None and len(self.samples) == self.samples.maxlen:
+            median = self._median()
+            # Accept a persistent step after half a window of consecutive "outliers"
+            if abs(sample - median) > self.outlier_limit and self.pending_outliers < self.samples.maxlen // 2:
+                self.rejected += 1
+                self.pending_outliers += 1
+                return self.value
+        self.pending_outliers = 0
+
+        self.samples.append(sample)
+        median = self._median()
+        if self.value is None:
+            self.value = median
+        else:
+            self.value += self.alpha * (median - self.value)
+        return self.value
+
+    def _median(self):
+        ordered = sorted(self.samples)
+        middle = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[middle]
+        return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class SensorConditioner(object):
+    """
+    Filter stage between ArduinoIF and the database. Decides which readings are worth persisting:
+    a new value is only written when it moved more than the deadband since the last write,
+    or when max_interval seconds have passed (so the UI can see that readings are still coming in).
+
+    Temperatures at or above critical_temp bypass the filter and are persisted immediately,
+    so the 90 °C safety cutoff never waits on smoothing.
+
+    Configured through the environment:
+        ECOTANK_TEMP_DEADBAND (°C, default 0.3), ECOTANK_LEVEL_DEADBAND (%, default 2),
+        ECOTANK_PERSIST_MAX_INTERVAL (seconds, default 60).
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock.
+    """
+
+    critical_temp = 90.0
+    stats_interval = 600.0  # Seconds between statistics log lines
+
+    def __init__(self, clock=None, temp_deadband=None, level_deadband=None, max_interval=None):
+        self.clock = clock if clock is not None else system_clock
+        self.temp_deadband = temp_deadband if temp_deadband is not None else self._env_float("ECOTANK_TEMP_DEADBAND", 0.3)
+        self.level_deadband = level_deadband if level_deadband is not None else self._env_float("ECOTANK_LEVEL_DEADBAND", 2.0)
+        self.max_interval = max_interval if max_interval is not None else self._env_float("ECOTANK_PERSIST_MAX_INTERVAL", 60.0)
+
+        self.temp_filter = SignalFilter(window=5, alpha=0.5, outlier_limit=10.0)
+        self.level_filter = SignalFilter(window=9, alpha=0.2, outlier_limit=20.0)
+
+        self.persisted_temp = None
+        self.persisted_level = None
+        self.persisted_at = None
+        self.samples = 0
+        self.writes = 0
+        self.next_stats_at = self.clock.monotonic() + self.stats_interval
+
+    @staticmethod
+    def _env_float(name, default):
+        try:
+            return float(environ.get(name, default))
+        except ValueError:
+            return default
+
+    @property
+    def suppressed(self):
+        return self.samples - self.writes
+
+    @property
+    def rejected(self):
+        return self.temp_filter.rejected + self.level_filter.rejected
+
+    @property
+    def filtered(self):
+        """
+        (water_temp, water_level) after the filters, whether or not the last reading was persisted.
+        """
+        return self.temp_filter.value, self.level_filter.value
+
+    def update(self, temp, level):
+        """
+        Feeds a raw reading through the filters.
+
+        Args:
+            temp (float): Raw water temperature.
+            level (int): Raw water level in percent.
+
+        Returns:
+            tuple: (water_temp, water_level) to persist, or None if the change isn't meaningful.
+        """
+        now = self.clock.monotonic()
+        self.samples += 1
+        self._log_stats(now)
+
+        filtered_temp = self.temp_filter.update(temp)
+        filtered_level = self.level_filter.update(level)
+        if temp >= self.critical_temp:
+            filtered_temp = temp
+
+        if self.persisted_at is not None:
+            temp_changed = abs(filtered_temp - self.persisted_temp) >= self.temp_deadband
+            level_changed = abs(filtered_level - self.persisted_level) >= self.level_deadband
+            critical = temp >= self.critical_temp and filtered_temp != self.persisted_temp
+            if not (temp_changed or level_changed or critical or now - self.persisted_at >= self.max_interval):
+                return None
+
+        self.persisted_temp = filtered_temp
+        self.persisted_level = filtered_level
+        self.persisted_at = now
+        self.writes += 1
+        return round(filtered_temp, 1), int(round(filtered_level))
+
+    def _log_stats(self, now):
+        if now < self.next_stats_at:
+            return
+        self.next_stats_at = now + self.stats_interval
+        logger.log(
+            "Sensor Conditioner:",
+            f"Persisted {self.writes} of {self.samples} readings "
+            f"({self.suppressed} writes suppressed, {self.rejected} outliers rejected)",
+        )
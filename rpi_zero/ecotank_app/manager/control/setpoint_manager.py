@@ -1,6 +1,10 @@
-from datetime import datetime
-from typing import List
+from datetime import timedelta
+from os import environ
 from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from ..boundary import change_bus as changes
+from ..boundary.change_bus import CachedValue
+from .time_interval_index import TimeIntervalIndex
 import shared_db as db
 
 
@@ -9,117 +13,241 @@ class SetpointManager(object):
     The SetpointManager class is responsible for managing the setpoint temperature based on various conditions.
 
     Methods:
-        - check_time_intervals: Checks if the current time is within any defined time intervals in the database.
+        - check_time_intervals: Checks if the current time is within any defined time intervals (see time_interval_index.py).
         - check_manual_override: Checks if manual override is enabled and within the specified time interval.
         - check_elpris_threshold: Checks if the current electricity price is below the user-defined threshold.
+          Past the published prices, the upper bound of the price forecast is used instead (see price_forecaster.py).
+        - check_expected_usage: Checks if the tank's usage profile (see usage_profile.py) expects at least
+          ECOTANK_PREHEAT_LITRES of hot water in the next ECOTANK_PREHEAT_HOURS hours (default 2). Treated like a
+          time interval. Off unless ECOTANK_PREHEAT_LITRES is set.
         - update_setpoint: Sets the setpoint temperature based on the conditions checked by the above methods.
+        - next_change: When the rules will pick another setpoint, for showing on the home page.
+
+    Settings, override, forecasts and the setpoint are cached until the change bus reports a change (see change_bus.py),
+    and prices come from the shared price cache (see price_cache.py), so a tick where nothing changed doesn't query
+    the database.
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+        device (str, optional): The tank whose setpoint is managed, defaults to shared_db.DEFAULT_DEVICE.
+        usage_profile (UsageProfile, optional): The tank's hot water usage, kept up to date by its UsageTracker.
     """
 
-    def _check_time_intervals(self) -> bool:
-        log_ctx = "Check Time Intervals:"
+    def __init__(self, clock=None, device=None, usage_profile=None):
+        self.clock = clock if clock is not None else system_clock
+        self.device = device if device is not None else db.DEFAULT_DEVICE
+        self.usage_profile = usage_profile
+        try:
+            self.preheat_litres = float(environ.get("ECOTANK_PREHEAT_LITRES", "0"))
+            self.preheat_hours = float(environ.get("ECOTANK_PREHEAT_HOURS", "2"))
+        except ValueError:
+            self.preheat_litres, self.preheat_hours = 0.0, 2.0
+        self.settings = CachedValue(db.change_bus, self._load_settings, changes.SETTINGS)
+        self.override = CachedValue(db.change_bus, self._load_override, changes.OVERRIDE)
+        self.forecast = CachedValue(db.change_bus, self._load_forecast, changes.FORECASTS)
+        self.setpoint = CachedValue(db.change_bus, self._load_setpoint, changes.SETPOINT)
+
+    def _load_settings(self):
+        """
+        Returns (user settings snapshot, TimeIntervalIndex of the time intervals).
+        """
         with db.Session() as session:
-            try:
-                time_intervals: List[db.TimeInterval] = db.get_time_intervals(session)
-            except Exception as e:
-                logger.log(log_ctx, "Error querying database", "ERROR", e)
-                return False
+            user_settings = db.get_user_settings(session, self.device)
+            interval_index = TimeIntervalIndex(
+                (interval.start_time, interval.end_time, interval.weekdays) for interval in user_settings.time_intervals
+            )
+            return db.snapshot(user_settings), interval_index
 
-        if time_intervals is None:
+    def _load_override(self):
+        with db.Session() as session:
+            return db.snapshot(db.get_override_settings(session, self.device))
+
+    @staticmethod
+    def _load_forecast(region, hour):
+        with db.Session() as session:
+            forecast = db.get_price_forecast(session, region, now=hour)
+            return db.snapshot(forecast) if forecast is not None else None
+
+    def _load_setpoint(self):
+        with db.Session() as session:
+            return db.get_system_data(session, self.device).setpoint
+
+    def _check_time_intervals(self) -> bool:
+        log_ctx = "Check Time Intervals:"
+        try:
+            _, interval_index = self.settings.get()
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
             return False
 
-        for interval in time_intervals:
-            if interval.start_time <= datetime.now().time() <= interval.end_time:
-                return True
-        return False
+        return interval_index.contains(self.clock.now())
 
     def _check_manual_override(self) -> bool:
         log_ctx = "Check Manual Override:"
-        with db.Session() as session:
-            try:
-                override: db.OverrideSettings = db.get_override_settings(session)
-            except Exception as e:
-                logger.log(log_ctx, "Error querying database", "ERROR", e)
-                return False
-
-            if override.toggled_on:
-                if override.start_time <= datetime.now() <= override.end_time:
-                    return True
-                else:
-                    override.toggled_on = False
-                    logger.log(log_ctx, "Manuel opvarmning turned off: outside of time interval")
-                    try:
-                        session.commit()
-                    except Exception as e:
-                        logger.log(log_ctx, "Error committing to database", "ERROR", e)
+        try:
+            override = self.override.get()
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
             return False
 
+        if override.toggled_on:
+            if override.start_time <= self.clock.now() <= override.end_time:
+                return True
+            logger.log(log_ctx, "Manuel opvarmning turned off: outside of time interval")
+            with db.Session() as session:
+                try:
+                    db.get_override_settings(session, self.device).toggled_on = False
+                    session.commit()  # Publishes the change, so the cached override is reloaded
+                except Exception as e:
+                    logger.log(log_ctx, "Error committing to database", "ERROR", e)
+        return False
+
     def _check_elpris_threshold(self) -> bool:
         log_ctx = "Check Elpris Threshold:"
-        with db.Session() as session:
-            try:
-                user_settings: db.UserSettings = db.get_user_settings(session)
-                current_price: db.ElectricityPrice | None = db.get_current_price(session, user_settings.price_region)
-            except Exception as e:
-                logger.log(log_ctx, "Error getting data from database", "ERROR", e)
-                return False
+        try:
+            user_settings, _ = self.settings.get()
+            now = self.clock.now()
+            current_price = db.price_cache.price_at(user_settings.price_region, now)
+            forecast = None
+            if current_price is None:
+                hour = now.replace(minute=0, second=0, microsecond=0)
+                forecast = self.forecast.get(user_settings.price_region, hour)
+        except Exception as e:
+            logger.log(log_ctx, "Error getting data from database", "ERROR", e)
+            return False
 
         if current_price is None:
-            logger.log(log_ctx, "No price entry in database for the current hour", level="WARNING")
-            return False
+            if forecast is None:
+                logger.log(log_ctx, "No price entry in database for the current hour", level="WARNING")
+                return False
+            # Only heat on a forecast if even the pessimistic end of the band is below the threshold
+            logger.log(log_ctx, f"No published price, using forecast upper bound {forecast.DKK_upper:.2f}", level="DEBUG")
+            return forecast.DKK_upper < user_settings.price_threshold
 
-        if current_price.DKK_per_kWh < user_settings.price_threshold:
+        if current_price < user_settings.price_threshold:
             return True
         else:
             return False
 
+    def _check_expected_usage(self, moment=None) -> bool:
+        if self.usage_profile is None or self.preheat_litres <= 0:
+            return False
+        moment = moment if moment is not None else self.clock.now()
+        # Constant time per hour ahead, see usage_profile.py
+        return self.usage_profile.expected_litres(moment, self.preheat_hours) >= self.preheat_litres
+
+    @staticmethod
+    def _choose(user_settings, override_allow_high_temp, price_under_threshold, manual_override, in_time_interval, expected_usage):
+        """
+        The rules, in order of precedence.
+
+        Returns:
+            tuple: (setpoint, name of the temperature, reason for the log)
+        """
+        if price_under_threshold:
+            if manual_override and not override_allow_high_temp:
+                return (
+                    user_settings.std_temp,
+                    "standard temperature",
+                    "Electricity price below configured threshold, manual heating enabled but high temp not allowed",
+                )
+            return user_settings.high_temp, "high temperature", "Electricity price below configured threshold"
+        if manual_override:
+            return user_settings.std_temp, "standard temperature", "Manual heating enabled"
+        if in_time_interval:
+            return user_settings.std_temp, "standard temperature", "Within configured time interval"
+        if expected_usage:
+            return user_settings.std_temp, "standard temperature", "Hot water use expected from the usage profile"
+        return user_settings.min_temp, "minimum temperature", "No rules matched for the current moment"
+
     def update_setpoint(self):
         log_ctx = "Set Setpoint:"
 
         in_time_interval: bool = self._check_time_intervals()
+        expected_usage: bool = self._check_expected_usage()
         manual_override: bool = self._check_manual_override()
         price_under_threshold: bool = self._check_elpris_threshold()
 
+        try:
+            user_settings, _ = self.settings.get()
+            override_allow_high_temp: bool = self.override.get().allow_high_temp
+            current_setpoint = self.setpoint.get()
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
+            return
+
+        setpoint, temperature_name, log_msg = self._choose(
+            user_settings, override_allow_high_temp, price_under_threshold, manual_override, in_time_interval, expected_usage
+        )
+        if setpoint == current_setpoint:
+            return
+
+        logger.log(log_ctx, f"{self.device}: {log_msg} - setpoint set to {temperature_name}: {setpoint} °C")
         with db.Session() as session:
             try:
-                system_data: db.SystemData = db.get_system_data(session)
-                user_settings: db.UserSettings = db.get_user_settings(session)
-                override_settings: db.OverrideSettings = db.get_override_settings(session)
-                override_allow_high_temp: db.Column[bool] = override_settings.allow_high_temp
-            except Exception as e:
-                logger.log(log_ctx, "Error querying database", "ERROR", e)
-                return
-
-            if price_under_threshold:
-                if manual_override and not override_allow_high_temp:
-                    setpoint = user_settings.std_temp
-                    temperature_name = "standard temperature"
-                    log_msg = (
-                        "Electricity price below configured threshold, manual heating enabled but high temp not allowed"
-                    )
-                else:
-                    setpoint = user_settings.high_temp
-                    temperature_name = "high temperature"
-                    log_msg = "Electricity price below configured threshold"
-            elif manual_override:
-                setpoint = user_settings.std_temp
-                temperature_name = "standard temperature"
-                log_msg = "Manual heating enabled"
-            elif in_time_interval:
-                setpoint = user_settings.std_temp
-                temperature_name = "standard temperature"
-                log_msg = "Within configured time interval"
-            else:
-                setpoint = user_settings.min_temp
-                temperature_name = "minimum temperature"
-                log_msg = "No rules matched for the current moment"
-
-            if setpoint == system_data.setpoint:
-                return
-
-            logger.log(log_ctx, f"{log_msg} - setpoint set to {temperature_name}: {setpoint} °C")
-            system_data.setpoint = setpoint
-
-            try:
+                db.get_system_data(session, self.device).setpoint = setpoint
                 session.commit()
             except Exception as e:
                 logger.log(log_ctx, "Error committing to database", "ERROR", e)
+
+    def next_change(self, horizon=timedelta(hours=24), step=timedelta(minutes=15)):
+        """
+        When the rules will pick another setpoint than they pick now, if the settings, prices, forecasts and
+        manual heating stay as they are. The rules are evaluated at every step (prices change per hour or quarter,
+        the usage profile per hour), at the boundaries of the time intervals and when manual heating ends. Doesn't
+        change anything, unlike update_setpoint.
+
+        Args:
+            horizon (timedelta): How far ahead to look.
+            step (timedelta): Granularity of the price slots, a divisor of an hour.
+
+        Returns:
+            tuple or None: (moment, setpoint) of the first change within horizon, None if there is none.
+        """
+        now = self.clock.now()
+        user_settings, interval_index = self.settings.get()
+        override = self.override.get()
+        region = user_settings.price_region
+        end = now + horizon
+
+        moments = set()
+        moment = now.replace(minute=0, second=0, microsecond=0) + step
+        while moment <= end:
+            if moment > now:
+                moments.add(moment)
+            moment += step
+        moment = now
+        while True:
+            moment = interval_index.next_change(moment)
+            if moment is None or moment > end:
+                break
+            moments.add(moment)
+        if override.toggled_on and now <= override.end_time < end:
+            moments.add(override.end_time + timedelta(seconds=1))  # Manual heating includes its end
+
+        forecasts = None  # Upper bound per hour, loaded once the published prices run out
+
+        def setpoint_at(moment):
+            nonlocal forecasts
+            price = db.price_cache.price_at(region, moment)
+            if price is None:
+                if forecasts is None:
+                    with db.Session() as session:
+                        forecasts = {f.time_start: f.DKK_upper for f in db.get_price_forecasts(session, region)}
+                price = forecasts.get(moment.replace(minute=0, second=0, microsecond=0))
+            manual_override = override.toggled_on and override.start_time <= moment <= override.end_time
+            return self._choose(
+                user_settings,
+                override.allow_high_temp,
+                price is not None and price < user_settings.price_threshold,
+                manual_override,
+                interval_index.contains(moment),
+                self._check_expected_usage(moment),
+            )[0]
+
+        current = setpoint_at(now)
+        for moment in sorted(moments):
+            setpoint = setpoint_at(moment)
+            if setpoint != current:
+                return moment, setpoint
+        return None
@@ -0,0 +1,193 @@
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from ..boundary import change_bus as changes
+from ..boundary.change_bus import CachedValue
+from .setpoint_manager import SetpointManager
+from .sensor_conditioner import SensorConditioner
+from .energy_accountant import EnergyAccountant
+from .thermal_calibrator import ThermalCalibrator
+from .usage_tracker import UsageTracker
+import shared_db as db
+
+
+class TankController(object):
+    """
+    The control loop of one tank: setpoint rules, the exchange with its Arduino, sensor conditioning, energy
+    accounting, draw-off detection, the thermal calibration and the safety cutoff. All state is per device, so SystemManager can
+    run one controller per Arduino, each in its own thread, without a slow or disconnected link holding up
+    the others.
+
+    The database must exist before a controller is created, since the stored calibration and usage profile are
+    loaded then.
+
+    Args:
+        device (str): Name of the tank, the key of its rows in the database.
+        arduino_interface (ArduinoIF): The link to the tank's Arduino.
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+        publisher (TelemetryPublisher, optional): Gets the tank's state every tick, see telemetry_publisher.py.
+    """
+
+    TEMPERATURE_LIMIT = 90  # °C, the system power is turned off above this
+
+    def __init__(self, device, arduino_interface, clock=None, publisher=None):
+        self.device = device
+        self.clock = clock if clock is not None else system_clock
+        self.arduino_interface = arduino_interface
+        self.publisher = publisher
+        self.log_ctx = f"Tank Controller {device}:"
+        self.usage_tracker = UsageTracker(clock=self.clock, device=device)
+        self.setpoint_manager = SetpointManager(clock=self.clock, device=device, usage_profile=self.usage_tracker.profile)
+        self.sensor_conditioner = SensorConditioner(clock=self.clock)
+        self.energy_accountant = EnergyAccountant(clock=self.clock, device=device)
+        self.thermal_calibrator = ThermalCalibrator(clock=self.clock, device=device)
+        self.exchange_ok = True  # Used to only log changes in the link state, not every failed tick
+        # Re-read only after a change was published, see change_bus.py
+        self.system_data = CachedValue(db.change_bus, self._load_system_data, changes.POWER, changes.SETPOINT, changes.READINGS)
+
+    def _load_system_data(self):
+        with db.Session() as session:
+            return db.snapshot(db.get_system_data(session, self.device))
+
+    def _get_pwr_and_setpoint(self):
+        """
+        Get the current power status and setpoint from the database.
+        Redundant function, but used to simplify main loop/not add redundant functions to shared_db.
+
+        """
+        log_ctx = "Get Power and Setpoint:"
+
+        try:
+            system_data = self.system_data.get()
+        except Exception as e:
+            logger.log(log_ctx, f"Error getting system data of {self.device} from database", "ERROR", e)
+            raise
+        return system_data.sys_power, system_data.setpoint
+
+    def _set_temp_and_lvl(self, temp, lvl):
+        """
+        Set the water temperature and level in the database, and append the reading to the telemetry history.
+        Redundant function, but used to simplify main loop/not add redundant functions to shared_db.
+
+        """
+        log_ctx = "Set Temp and Lvl:"
+
+        with db.Session() as session:
+            try:
+                system_data = db.get_system_data(session, self.device)
+            except Exception as e:
+                logger.log(log_ctx, f"Error getting system data of {self.device} from database", "ERROR", e)
+                return
+
+            try:
+                system_data.water_temp = temp
+                system_data.water_level = lvl
+                session.add(
+                    db.SensorReading(
+                        device=self.device,
+                        time=self.clock.now(),
+                        water_temp=temp,
+                        water_level=lvl,
+                        setpoint=system_data.setpoint,
+                        sys_power=system_data.sys_power,
+                    )
+                )
+                session.commit()
+            except Exception as e:
+                logger.log(log_ctx, f"Error setting system data of {self.device} in database", "ERROR", e)
+                return
+
+    def _check_temperature_limit(self):
+        """
+        Check if the water temperature has reached TEMPERATURE_LIMIT.
+        If above the limit, flip the system power of this tank to 0 and log the event.
+
+        """
+        log_ctx = "Check Temperature:"
+
+        try:
+            system_data = self.system_data.get()
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
+            return
+
+        if system_data.water_temp > self.TEMPERATURE_LIMIT and system_data.sys_power == 1:
+            logger.log(
+                log_ctx,
+                f"Temperature limit reached in {self.device}! Current temperature: {system_data.water_temp} °C. "
+                "Shutting down system..",
+                "CRITICAL",
+            )
+            with db.Session() as session:
+                db.get_system_data(session, self.device).sys_power = 0
+                session.commit()
+
+    def _publish_state(self):
+        """
+        Hands the persisted readings, power, setpoint and manual heating state to the publisher, which only sends
+        what changed. See telemetry_publisher.py.
+        """
+        log_ctx = "Publish State:"
+
+        try:
+            system_data = self.system_data.get()
+            override = self.setpoint_manager.override.get()
+        except Exception as e:
+            logger.log(log_ctx, "Error querying database", "ERROR", e)
+            return
+
+        self.publisher.update(
+            self.device,
+            water_temp=system_data.water_temp,
+            water_level=system_data.water_level,
+            setpoint=system_data.setpoint,
+            power=bool(system_data.sys_power),
+            override=bool(override.toggled_on),
+            # In steps of 10 W, as the estimate while holding the setpoint moves a little every tick
+            heater_power=int(round(self.energy_accountant.power_w, -1)),
+        )
+
+    def run_once(self):
+        """
+        A single iteration of the tank's loop, without the sleep.
+        """
+        # Evaluate and set the setpoint temperature. See setpoint_manager.py
+        self.setpoint_manager.update_setpoint()
+
+        system_power, setpoint = self._get_pwr_and_setpoint()
+        result = self.arduino_interface.exchange_data(system_power, setpoint)
+        if result is None:
+            if self.exchange_ok:
+                logger.log(self.log_ctx, "Failed to exchange data with Arduino interface.", "ERROR")
+            self.exchange_ok = False
+        else:
+            if not self.exchange_ok:
+                logger.log(self.log_ctx, "Data exchange with Arduino interface restored.")
+            self.exchange_ok = True
+            # Heater on-time, energy and cost from the raw reading. See energy_accountant.py
+            self.energy_accountant.update(system_power, setpoint, result[0])
+            # Only readings that changed meaningfully are written. See sensor_conditioner.py
+            conditioned = self.sensor_conditioner.update(*result)
+            if conditioned is not None:
+                water_temp, water_level = conditioned
+                self._set_temp_and_lvl(water_temp, water_level)
+            # Draw-offs and the usage profile, from every filtered reading. See usage_tracker.py
+            draw_off = self.usage_tracker.update(*self.sensor_conditioner.filtered)
+            if draw_off is not None and self.publisher is not None:
+                self.publisher.event(
+                    self.device,
+                    "draw_off",
+                    {
+                        "start": draw_off.start.isoformat(),
+                        "end": draw_off.end.isoformat(),
+                        "litres": round(draw_off.litres, 1),
+                        "water_temp": round(draw_off.water_temp, 1),
+                    },
+                )
+
+        self._check_temperature_limit()
+
+        if self.publisher is not None:
+            self._publish_state()
+
+        # Refit the heating and heat loss rates of the tank now and then. See thermal_calibrator.py
+        self.thermal_calibrator.update()
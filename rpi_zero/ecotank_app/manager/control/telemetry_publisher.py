@@ -0,0 +1,340 @@
+"""
+Publishes the state of the tanks to an MQTT broker for home automation, e.g. Home Assistant, and takes system power
+and manual heating commands from it, so nothing has to poll the webserver.
+
+The tank controllers hand their state to update on every tick, which only compares it with the last state under a
+lock. A topic whose value changed is queued; changes of the same topic before the next batch replace the queued
+value, so a value that changes every tick is still sent at most once per interval, and all changes of an interval
+go out in a single write. State is retained on the broker and republished in full after every connect. Events that
+aren't state (draw-offs) are kept in a bounded buffer while the broker is unreachable, dropping the oldest.
+
+Topics, with the default prefix "ecotank":
+    ecotank/status                       "online" or "offline" (retained, the latter as last will)
+    ecotank/<device>/<field>             water_temp, water_level, setpoint, heater_power, power, override
+    ecotank/<device>/draw_off            JSON of each draw-off, see usage_tracker.py
+    ecotank/<device>/power/set           "ON" or "OFF" turns the system power on or off
+    ecotank/<device>/override/set        "ON" starts manual heating for OVERRIDE_MINUTES, "OFF" stops it
+Commands are written to the database like the web pages do, so the controllers pick them up through the change
+bus. Retained commands are ignored: the broker replays them on every connect, which would undo a later switch off
+from the web page or the temperature cutoff. Home Assistant discovery configs are published under the discovery prefix on connect.
+"""
+import json
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import timedelta
+from os import environ
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from ..boundary.mqtt_client import Message, MqttClient
+import shared_db as db
+
+OVERRIDE_MINUTES = 20  # Like the manual heating button on the home page
+
+# Field -> (Home Assistant component, name, discovery settings)
+FIELDS = {
+    "water_temp": ("sensor", "Vandtemperatur", {"device_class": "temperature", "unit_of_measurement": "°C", "state_class": "measurement"}),
+    "water_level": ("sensor", "Vandstand", {"unit_of_measurement": "%", "state_class": "measurement"}),
+    "setpoint": ("sensor", "Setpunkt", {"device_class": "temperature", "unit_of_measurement": "°C"}),
+    "heater_power": ("sensor", "Varmelegeme", {"device_class": "power", "unit_of_measurement": "W", "state_class": "measurement"}),
+    "power": ("switch", "System", {}),
+    "override": ("switch", "Manuel opvarmning", {}),
+}
+COMMANDS = ("power", "override")
+SWITCH_PAYLOADS = {"ON": True, "OFF": False, "1": True, "0": False, "TRUE": True, "FALSE": False}
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "ON" if value else "OFF"
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+
+class TelemetryPublisher(object):
+    """
+    Publishes the tanks' state and applies commands, see the module docstring. run is the loop of the publisher's
+    thread; update and event may be called from any thread.
+
+    Args:
+        client (MqttClient): The broker connection, not yet connected. Its will is set to the status topic.
+        devices (list): Names of the tanks commands are accepted for.
+        prefix (str): First level(s) of the topics.
+        qos (int): 0 or 1, for the state, events and command subscriptions.
+        interval (float): Seconds between batches.
+        buffer_size (int): Events kept while the broker is unreachable.
+        discovery_prefix (str): Home Assistant's discovery prefix, empty to not publish discovery configs.
+        clock (SystemClock, optional): Time source for the manual heating period, defaults to the wall clock.
+    """
+
+    def __init__(self, client, devices, prefix="ecotank", qos=0, interval=2.0, buffer_size=1000, discovery_prefix="homeassistant", clock=None):
+        self.client = client
+        self.devices = list(devices)
+        self.prefix = prefix
+        self.qos = qos
+        self.interval = interval
+        self.discovery_prefix = discovery_prefix
+        self.clock = clock if clock is not None else system_clock
+        self.status_topic = f"{prefix}/status"
+        client.will = Message(self.status_topic, "offline", 1, True)
+        self.topics = {}  # (device, field) -> topic
+        self.latest = {}  # Topic -> payload, the current state
+        self.pending = OrderedDict()  # Topic -> payload changed since the last batch
+        self.events = deque(maxlen=buffer_size)
+        self.counters = dict.fromkeys(("updates", "coalesced", "sent", "batches", "dropped", "commands", "connects"), 0)
+        self.next_flush = 0.0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def _topic(self, device, field):
+        topic = self.topics.get((device, field))
+        if topic is None:
+            topic = self.topics[(device, field)] = f"{self.prefix}/{device}/{field}"
+        return topic
+
+    def update(self, device, **values):
+        """
+        Queues the values of a tank's fields that changed. Cheap enough to call every tick.
+        """
+        with self.lock:
+            for field, value in values.items():
+                topic = self._topic(device, field)
+                payload = format_value(value)
+                if self.latest.get(topic) == payload:
+                    continue
+                self.latest[topic] = payload
+                self.counters["updates"] += 1
+                if topic in self.pending:
+                    self.counters["coalesced"] += 1
+                self.pending[topic] = payload
+
+    def event(self, device, name, data):
+        """
+        Queues a JSON event of a tank, dropping the oldest queued event if the buffer is full.
+        """
+        message = Message(self._topic(device, name), json.dumps(data), self.qos, False)
+        with self.lock:
+            if len(self.events) == self.events.maxlen:
+                self.counters["dropped"] += 1
+            self.events.append(message)
+
+    def status(self):
+        """
+        Connection state, queue sizes and counters.
+        """
+        with self.lock:
+            return {
+                "connected": self.client.connected,
+                "pending": len(self.pending),
+                "buffered": len(self.events),
+                **self.counters,
+            }
+
+    def run(self):
+        """
+        Connects, reconnects with backoff, sends the batches and applies the commands, until stop is called.
+        """
+        log_ctx = "Telemetry Publisher:"
+        backoff = 1.0
+        while not self.stopping.is_set():
+            if not self.client.connected:
+                try:
+                    self._connect()
+                except OSError as e:
+                    if backoff == 1.0:  # Only the first failure of an outage is logged
+                        logger.log(log_ctx, f"Could not connect to {self.client!r}, retrying", "WARNING", e)
+                    self.stopping.wait(backoff)
+                    backoff = min(backoff * 2, 60.0)
+                    continue
+                logger.log(log_ctx, f"Connected to {self.client!r}")
+                backoff = 1.0
+            try:
+                for message in self.client.poll(self.next_flush - time.monotonic()):
+                    self._command(message)
+                if time.monotonic() >= self.next_flush:
+                    self.flush()
+            except OSError as e:
+                logger.log(log_ctx, f"Lost the connection to {self.client!r}", "WARNING", e)
+                self._requeue(self.client.unacknowledged())
+                self.client.close()
+
+        if self.client.connected:
+            try:
+                self.flush()
+                self.client.publish([Message(self.status_topic, "offline", 1, True)])
+            except OSError:
+                pass
+            self.client.disconnect()
+
+    def stop(self):
+        """
+        Makes run send the last batch, disconnect and return.
+        """
+        self.stopping.set()
+
+    def _connect(self):
+        self.client.connect()
+        try:
+            self.client.subscribe([f"{self.prefix}/+/{field}/set" for field in COMMANDS], self.qos)
+            self.client.publish(self._discovery() + [Message(self.status_topic, "online", 1, True)])
+        except OSError:
+            self.client.close()
+            raise
+        with self.lock:
+            self.counters["connects"] += 1
+            # All of it, as the broker may have lost its retained messages
+            for topic, payload in self.latest.items():
+                self.pending.setdefault(topic, payload)
+        self.next_flush = 0.0
+
+    def flush(self):
+        """
+        Sends the queued state and events in one write.
+
+        Raises:
+            OSError: If the connection is lost; the events are then queued again.
+        """
+        with self.lock:
+            batch = [Message(topic, payload, self.qos, True) for topic, payload in self.pending.items()]
+            batch += self.events
+            self.pending.clear()
+            self.events.clear()
+        self.next_flush = time.monotonic() + self.interval
+        if not batch:
+            return
+        try:
+            self.client.publish(batch)
+        except OSError:
+            self._requeue(batch)
+            raise
+        with self.lock:
+            self.counters["sent"] += len(batch)
+            self.counters["batches"] += 1
+
+    def _requeue(self, messages):
+        # Only the events; the state is republished on the next connect anyway
+        with self.lock:
+            for message in reversed(messages):
+                if message.retain:
+                    continue
+                if len(self.events) < self.events.maxlen:
+                    self.events.appendleft(message)
+                else:
+                    self.counters["dropped"] += 1
+
+    def _command(self, message):
+        log_ctx = "Telemetry Publisher:"
+        levels = message.topic[len(self.prefix) + 1:].split("/")
+        device, field = levels[:2] if len(levels) == 3 and levels[2] == "set" else (None, None)
+        payload = message.payload.decode("utf-8", "replace").strip()
+        on = SWITCH_PAYLOADS.get(payload.upper())
+        if message.retain:
+            logger.log(log_ctx, f"Ignoring retained command '{payload}' on {message.topic}, publish commands unretained", "WARNING")
+            return
+        if device not in self.devices or field not in COMMANDS or on is None:
+            logger.log(log_ctx, f"Ignoring command '{payload}' on {message.topic}", "WARNING")
+            return
+        try:
+            with db.Session() as session:
+                if field == "power":
+                    db.get_system_data(session, device).sys_power = on
+                else:
+                    override = db.get_override_settings(session, device)
+                    override.toggled_on = on
+                    if on:
+                        override.start_time = self.clock.now()
+                        override.end_time = override.start_time + timedelta(minutes=OVERRIDE_MINUTES)
+                session.commit()  # Publishes the change, so the tank's controller picks it up
+        except Exception as e:
+            logger.log(log_ctx, f"Error applying {field} command for {device}", "ERROR", e)
+            return
+        with self.lock:
+            self.counters["commands"] += 1
+        logger.log(log_ctx, f"{field} of {device} turned {'on' if on else 'off'} over MQTT")
+        # Confirmed right away, rather than with the controller's next tick and the next batch
+        self.update(device, **{field: on})
+        self.next_flush = 0.0
+
+    def _discovery(self):
+        if not self.discovery_prefix:
+            return []
+        messages = []
+        for device in self.devices:
+            object_id = "ecotank_" + re.sub(r"[^A-Za-z0-9_-]", "_", device)
+            for field, (component, name, settings) in FIELDS.items():
+                config = {
+                    "name": name,
+                    "unique_id": f"{object_id}_{field}",
+                    "state_topic": self._topic(device, field),
+                    "availability_topic": self.status_topic,
+                    "device": {"identifiers": [object_id], "name": f"EcoTank {device}", "manufacturer": "EcoTank"},
+                    **settings,
+                }
+                if field in COMMANDS:
+                    config["command_topic"] = f"{self._topic(device, field)}/set"
+                topic = f"{self.discovery_prefix}/{component}/{object_id}/{field}/config"
+                messages.append(Message(topic, json.dumps(config), 1, True))
+        return messages
+
+
+def telemetry_publisher(devices, clock=None):
+    """
+    The publisher configured by the environment, or None if ECOTANK_MQTT_HOST isn't set.
+
+    Environment variables:
+        ECOTANK_MQTT_HOST / ECOTANK_MQTT_PORT: The broker (port 1883 by default).
+        ECOTANK_MQTT_USER / ECOTANK_MQTT_PASSWORD: Login, if the broker requires one.
+        ECOTANK_MQTT_CLIENT_ID: Defaults to "ecotank-<hostname>".
+        ECOTANK_MQTT_PREFIX: First level(s) of the topics (default "ecotank").
+        ECOTANK_MQTT_QOS: 0 (default) or 1.
+        ECOTANK_MQTT_INTERVAL: Seconds between batches (default 2).
+        ECOTANK_MQTT_BUFFER: Events kept while the broker is unreachable (default 1000).
+        ECOTANK_MQTT_DISCOVERY: Home Assistant's discovery prefix (default "homeassistant"), empty to disable.
+
+    Args:
+        devices (list): Names of the tanks.
+        clock (SystemClock, optional): See TelemetryPublisher.
+    """
+    log_ctx = "Telemetry Publisher:"
+    host = environ.get("ECOTANK_MQTT_HOST")
+    if not host:
+        return None
+    try:
+        port = int(environ.get("ECOTANK_MQTT_PORT", "1883"))
+    except ValueError:
+        port = 1883
+    try:
+        qos = int(environ.get("ECOTANK_MQTT_QOS", "0"))
+    except ValueError:
+        qos = 0
+    if qos not in (0, 1):
+        logger.log(log_ctx, f"QoS {qos} isn't supported, using {min(max(qos, 0), 1)}", "WARNING")
+        qos = min(max(qos, 0), 1)
+    try:
+        interval = float(environ.get("ECOTANK_MQTT_INTERVAL", "2"))
+    except ValueError:
+        interval = 2.0
+    try:
+        buffer_size = int(environ.get("ECOTANK_MQTT_BUFFER", "1000"))
+    except ValueError:
+        buffer_size = 1000
+    client = MqttClient(
+        host,
+        port,
+        client_id=environ.get("ECOTANK_MQTT_CLIENT_ID", f"ecotank-{socket.gethostname()}"),
+        username=environ.get("ECOTANK_MQTT_USER"),
+        password=environ.get("ECOTANK_MQTT_PASSWORD"),
+    )
+    return TelemetryPublisher(
+        client,
+        devices,
+        prefix=environ.get("ECOTANK_MQTT_PREFIX", "ecotank").strip("/"),
+        qos=qos,
+        interval=interval,
+        buffer_size=buffer_size,
+        discovery_prefix=environ.get("ECOTANK_MQTT_DISCOVERY", "homeassistant").strip("/"),
+        clock=clock,
+    )
@@ -0,0 +1,92 @@
+from datetime import timedelta
+import numpy as np
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from .thermal_model import ThermalModel
+import shared_db as db
+
+
+class ThermalCalibrator(object):
+    """
+    Keeps a ThermalModel (see thermal_model.py) calibrated on the recorded readings and stores every accepted
+    fit as ThermalCalibration, where the webserver picks it up.
+
+    Each refit only queries the readings recorded since the previous one; the model drops the readings that
+    left the window itself. The stored fit is loaded at startup, so predictions are available before the
+    first refit.
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+        window_days (float): Days of readings the model is fitted on.
+        refit_interval (float): Seconds between refits.
+        device (str, optional): The tank to calibrate, defaults to shared_db.DEFAULT_DEVICE.
+    """
+
+    def __init__(self, clock=None, window_days=7, refit_interval=3600.0, device=None):
+        self.clock = clock if clock is not None else system_clock
+        self.device = device if device is not None else db.DEFAULT_DEVICE
+        self.model = ThermalModel(window=window_days * 24 * 3600.0)
+        self.refit_interval = refit_interval
+        self.loaded_until = None  # Time of the newest reading added to the model
+        self.next_fit = None
+
+        log_ctx = "Thermal Calibrator:"
+        try:
+            with db.Session() as session:
+                calibration = db.get_thermal_calibration(session, self.device)
+                if calibration is not None:
+                    self.model.set_coefficients(calibration.heating_rate, calibration.loss_rate, calibration.ambient_temp)
+        except Exception as e:
+            logger.log(log_ctx, "Error loading the stored calibration", "ERROR", e)
+
+    def update(self):
+        """
+        Refits the model if refit_interval has passed since the last refit. Cheap to call every loop iteration.
+        """
+        log_ctx = "Thermal Calibrator:"
+        now = self.clock.now()
+        if self.next_fit is not None and now < self.next_fit:
+            return
+        self.next_fit = now + timedelta(seconds=self.refit_interval)
+
+        since = now - timedelta(seconds=self.model.window)
+        if self.loaded_until is not None:
+            since = max(since, self.loaded_until)
+        try:
+            with db.Session() as session:
+                rows = db.get_sensor_history(session, since, until=now, device=self.device)
+        except Exception as e:
+            logger.log(log_ctx, "Error reading sensor history from database", "ERROR", e)
+            return
+        if rows:
+            times, temps, levels, setpoints, powered = zip(*rows)
+            self.model.add_readings(
+                np.array([time.timestamp() for time in times]), temps, levels, setpoints, powered
+            )
+            self.loaded_until = times[-1]
+
+        if not self.model.fit():
+            logger.log(log_ctx, "Not enough usable readings for a calibration yet", "DEBUG")
+            return
+
+        model = self.model
+        logger.log(
+            log_ctx,
+            f"Calibrated {self.device} on {model.samples} intervals: heating {model.heating_rate * 3600:.2f} K/h, "
+            f"loss {model.loss_rate * 3600:.4f} 1/h, ambient {model.ambient_temp:.1f} °C, "
+            f"RMSE {model.rmse:.2f} K/h",
+        )
+        with db.Session() as session:
+            try:
+                db.save_thermal_calibration(
+                    session,
+                    self.device,
+                    fitted_at=now,
+                    heating_rate=model.heating_rate,
+                    loss_rate=model.loss_rate,
+                    ambient_temp=model.ambient_temp,
+                    samples=model.samples,
+                    rmse=model.rmse,
+                )
+            except Exception as e:
+                logger.log(log_ctx, "Error saving calibration to database", "ERROR", e)
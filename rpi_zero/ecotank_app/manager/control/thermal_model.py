@@ -0,0 +1,212 @@
+import math
+import numpy as np
+
+
+class ThermalModel(object):
+    """
+    First-order thermal model of the tank, calibrated from the recorded readings (SensorReading).
+
+    The model is dT/dt = (heating_rate * u - loss_rate * (T - ambient_temp)) * 100 / level:
+        - u is 1 while the heater is on. As on the Arduino (RegulateTemp), it is on while the system is
+          powered and the water is below the setpoint.
+        - heating_rate (K/s) and loss_rate (1/s) are the rates for a full tank. The heat capacity is
+          proportional to the water volume, so both scale with 100 / level (level in percent).
+        - ambient_temp is the temperature the tank cools towards.
+
+    Multiplying by level / 100 makes the model linear in (heating_rate, loss_rate, loss_rate * ambient_temp),
+    so a fit is one weighted NumPy least squares:
+    level / 100 * dT/dt = heating_rate * u - loss_rate * T + loss_rate * ambient_temp.
+    Only intervals between two readings with the heater on all the time or off all the time are used, which
+    leaves out intervals that span a gap, cross the setpoint or are within hold_band of it, where the filtered
+    reading lags the heater. The readings are rounded and the tank cools by a fraction of a degree an hour, so
+    consecutive usable intervals in the same state are merged into segments of up to segment_length seconds,
+    and dT/dt is taken per segment. Segments shorter than min_segment_length or whose level varies by more than
+    level_tolerance (draw-off and refill) are dropped. A refill can also cool the water by a degree while the
+    level hardly changes, so the fit is repeated without segments whose residual is an outlier (more than
+    outlier_limit robust standard deviations from the median of its heater state) until the set is stable.
+
+    Readings are added incrementally and dropped when they leave the rolling window, and every fit replaces the
+    previous one only if it is physically plausible. Predictions use the closed-form solution of the model,
+    so a query takes microseconds.
+
+    Args:
+        window (float): Length of the rolling window in seconds.
+    """
+
+    min_samples = 30  # Segments needed for a fit
+    min_samples_per_state = 5  # ...of which this many with the heater on, and as many with it off
+    max_gap = 2 * 3600.0  # Longer intervals between readings are not used
+    segment_length = 3600.0
+    min_segment_length = 600.0
+    level_tolerance = 3.0  # Max level variation in percent within a segment
+    min_level = 10.0  # Readings below this level are not used, the heater may be dry
+    hold_band = 0.5  # Readings this close to the setpoint may be holding it, with the heater switching
+    outlier_limit = 3.0
+    min_residual_scale = 0.1 / 3600  # Robust standard deviations are at least 0.1 K/h, the rounding over a segment
+    max_iterations = 5
+
+    def __init__(self, window=7 * 24 * 3600.0):
+        self.window = window
+        self.times = np.empty(0)  # Seconds since the epoch
+        self.temps = np.empty(0)
+        self.levels = np.empty(0)
+        self.setpoints = np.empty(0)
+        self.powered = np.empty(0, dtype=bool)
+        self.heating_rate = None
+        self.loss_rate = None
+        self.ambient_temp = None
+        self.samples = 0  # Segments used by the last fit
+        self.rmse = None  # Root mean square error of the last fit in K/h, for a full tank
+
+    @property
+    def is_calibrated(self):
+        return self.heating_rate is not None
+
+    def add_readings(self, times, temps, levels, setpoints, powered):
+        """
+        Appends readings, which must be newer than the ones already added, and drops readings older than the window.
+
+        Args:
+            times (array-like): Seconds since the epoch.
+            temps (array-like): Water temperatures.
+            levels (array-like): Water levels in percent.
+            setpoints (array-like): Setpoints at the time of the readings.
+            powered (array-like): System power at the time of the readings.
+        """
+        self.times = np.concatenate([self.times, np.asarray(times, dtype=float)])
+        self.temps = np.concatenate([self.temps, np.asarray(temps, dtype=float)])
+        self.levels = np.concatenate([self.levels, np.asarray(levels, dtype=float)])
+        self.setpoints = np.concatenate([self.setpoints, np.asarray(setpoints, dtype=float)])
+        self.powered = np.concatenate([self.powered, np.asarray(powered, dtype=bool)])
+        if len(self.times):
+            first = np.searchsorted(self.times, self.times[-1] - self.window)
+            for name in ("times", "temps", "levels", "setpoints", "powered"):
+                setattr(self, name, getattr(self, name)[first:])
+
+    def fit(self):
+        """
+        Refits the coefficients on the readings in the window.
+
+        Returns:
+            bool: True if the fit was plausible and replaced the coefficients.
+        """
+        dt = np.diff(self.times)
+        start, end = self.temps[:-1], self.temps[1:]
+        setpoint, powered = self.setpoints[:-1], self.powered[:-1]
+        level = (self.levels[:-1] + self.levels[1:]) / 2
+
+        heating = powered & (np.maximum(start, end) < setpoint - self.hold_band)
+        off = ~powered | (np.minimum(start, end) > setpoint + self.hold_band)
+        usable = (heating | off) & (dt > 0) & (dt <= self.max_gap) & (level >= self.min_level)
+        if not usable.any():
+            return False
+
+        # A segment ends at every unusable interval, change of heater state and segment_length boundary
+        bins = self.times[:-1] // self.segment_length
+        boundary = np.ones(len(dt), dtype=bool)
+        boundary[1:] = ~usable[:-1] | (heating[1:] != heating[:-1]) | (bins[1:] != bins[:-1])
+        segment = np.cumsum(boundary)[usable] - 1
+        count = segment[-1] + 1
+        dt, start, end, level = dt[usable], start[usable], end[usable], level[usable]
+        level_low, level_high = np.full(count, np.inf), np.full(count, -np.inf)
+        np.minimum.at(level_low, segment, np.minimum(self.levels[:-1][usable], self.levels[1:][usable]))
+        np.maximum.at(level_high, segment, np.maximum(self.levels[:-1][usable], self.levels[1:][usable]))
+        segment_dt = np.bincount(segment, dt, minlength=count)
+        # Also drops the segment numbers left unused after an unusable interval, which have no time
+        selected = (segment_dt >= self.min_segment_length) & (level_high - level_low <= self.level_tolerance)
+        segment_dt = segment_dt[selected]
+        rise = np.bincount(segment, end - start, minlength=count)[selected]
+        temp = np.bincount(segment, dt * (start + end) / 2, minlength=count)[selected] / segment_dt
+        level = np.bincount(segment, dt * level, minlength=count)[selected] / segment_dt
+        u = np.bincount(segment, heating[usable], minlength=count)[selected] > 0
+
+        X = np.column_stack([u.astype(float), -temp, np.ones(len(segment_dt))])
+        y = level / 100 * rise / segment_dt
+        # The rate of a longer segment is less affected by the sensor resolution
+        weights = np.sqrt(segment_dt)
+
+        keep = np.ones(len(y), dtype=bool)
+        for _ in range(self.max_iterations):
+            on_count = int((keep & u).sum())
+            off_count = int((keep & ~u).sum())
+            if on_count + off_count < self.min_samples or min(on_count, off_count) < self.min_samples_per_state:
+                return False
+            coefficients, _, rank, _ = np.linalg.lstsq(X[keep] * weights[keep, None], y[keep] * weights[keep], rcond=None)
+            if rank < 3:
+                return False
+            residuals = X @ coefficients - y
+            # Heating and cooling rates are spread very differently, so outliers are judged per state, around
+            # the median residual, which tolerates a first fit that was pulled off by the outliers
+            inliers = np.zeros(len(y), dtype=bool)
+            for state in (u, ~u):
+                state_residuals = residuals[keep & state]
+                center = np.median(state_residuals)
+                scale = max(1.4826 * np.median(np.abs(state_residuals - center)), self.min_residual_scale)
+                inliers |= state & (np.abs(residuals - center) <= self.outlier_limit * scale)
+            if (inliers == keep).all():
+                break
+            keep = inliers
+
+        heating_rate, loss_rate, offset = coefficients
+        if heating_rate <= 0 or loss_rate <= 0:
+            return False
+        self.heating_rate = float(heating_rate)
+        self.loss_rate = float(loss_rate)
+        self.ambient_temp = float(offset / loss_rate)
+        self.samples = int(keep.sum())
+        self.rmse = float(np.sqrt(np.mean(residuals[keep] ** 2)) * 3600)
+        return True
+
+    def set_coefficients(self, heating_rate, loss_rate, ambient_temp):
+        """
+        Sets the coefficients of an earlier fit, e.g. one stored in the database.
+        """
+        self.heating_rate = heating_rate
+        self.loss_rate = loss_rate
+        self.ambient_temp = ambient_temp
+
+    def _rates(self, level):
+        scale = 100.0 / max(level, self.min_level)
+        return self.heating_rate * scale, self.loss_rate * scale
+
+    def equilibrium(self, heating):
+        """
+        The temperature the water settles at with the heater always on (or always off).
+        """
+        return self.ambient_temp + (self.heating_rate / self.loss_rate if heating else 0.0)
+
+    def time_to_reach(self, target, temp, level=100.0):
+        """
+        Seconds until the water reaches target with the heater on, 0 if it is already there, or None if it never
+        gets there (the heat loss at target is as large as the heater).
+        """
+        if temp >= target:
+            return 0.0
+        final = self.equilibrium(True)
+        if target >= final:
+            return None
+        _, loss_rate = self._rates(level)
+        return math.log((final - temp) / (final - target)) / loss_rate
+
+    def predict(self, temp, seconds, level=100.0, setpoint=None):
+        """
+        The temperature after seconds, starting at temp with the water level and setpoint kept constant.
+        With a setpoint, the heater heats up to it and then holds it; without one, the heater stays off.
+        """
+        _, loss_rate = self._rates(level)
+        if setpoint is not None and temp < setpoint:
+            reach = self.time_to_reach(setpoint, temp, level)
+            if reach is not None and seconds >= reach:
+                return float(setpoint)
+            final = self.equilibrium(True)
+            return final + (temp - final) * math.exp(-loss_rate * seconds)
+        final = self.equilibrium(False)
+        temp = final + (temp - final) * math.exp(-loss_rate * seconds)
+        # Cooling stops at the setpoint, where the heater starts holding it
+        return max(temp, setpoint) if setpoint is not None else temp
+
+    def temperature_at(self, moment, now, temp, level=100.0, setpoint=None):
+        """
+        predict for a point in time, e.g. the temperature at 07:00 tomorrow.
+        """
+        return self.predict(temp, max((moment - now).total_seconds(), 0.0), level, setpoint)
@@ -0,0 +1,123 @@
+from bisect import bisect_right
+from datetime import timedelta
+
+MINUTES_PER_DAY = 1440
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+ALL_WEEKDAYS = 0b1111111  # Bit 0 = Monday, like datetime.weekday()
+WEEKDAY_NAMES = ["Man", "Tir", "Ons", "Tor", "Fre", "Lør", "Søn"]
+
+
+class TimeIntervalIndex(object):
+    """
+    Compiled form of the user's time intervals, for answering "is this moment inside an interval" in O(1).
+
+    The intervals are rasterized into a bitmap with one bit per minute of the week, and the merged result is kept
+    as a sorted array of boundaries (minute-of-week values where the state flips), used for next_change and for
+    showing the effective windows in the UI.
+
+    Interval semantics:
+        - The start minute is included and the end minute is excluded, so 06:00-08:00 covers 06:00 to 07:59.
+        - start > end wraps past midnight: 22:00-06:00 covers 22:00 on the weekday to 06:00 the next day.
+        - start == end is an empty interval.
+        - weekdays is a bitmask of the days the interval starts on (bit 0 = Monday).
+
+    Args:
+        intervals (list): (start_time, end_time) or (start_time, end_time, weekdays) tuples.
+    """
+
+    def __init__(self, intervals=()):
+        bitmap = bytearray(MINUTES_PER_WEEK)
+        for interval in intervals:
+            start_time, end_time = interval[0], interval[1]
+            weekdays = interval[2] if len(interval) > 2 and interval[2] is not None else ALL_WEEKDAYS
+            start = start_time.hour * 60 + start_time.minute
+            end = end_time.hour * 60 + end_time.minute
+            if start == end:
+                continue
+            length = end - start if end > start else MINUTES_PER_DAY - start + end
+            for day in range(7):
+                if weekdays & (1 << day):
+                    first = day * MINUTES_PER_DAY + start
+                    self._fill(bitmap, first, length)
+
+        self.bitmap = bytes(bitmap)
+        self.boundaries = [
+            minute for minute in range(MINUTES_PER_WEEK) if bitmap[minute] != bitmap[minute - 1]
+        ]  # bitmap[-1] is the last minute of Sunday, so wrap-around is handled
+
+    @staticmethod
+    def _fill(bitmap, first, length):
+        end = first + length
+        if end <= MINUTES_PER_WEEK:
+            bitmap[first:end] = b"\x01" * length
+        else:
+            # Sunday night interval continuing into Monday morning
+            bitmap[first:] = b"\x01" * (MINUTES_PER_WEEK - first)
+            bitmap[:end - MINUTES_PER_WEEK] = b"\x01" * (end - MINUTES_PER_WEEK)
+
+    @staticmethod
+    def minute_of_week(moment):
+        return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+    def contains(self, moment):
+        """
+        Returns True if the moment (datetime) is inside any interval.
+        """
+        return bool(self.bitmap[self.minute_of_week(moment)])
+
+    def next_change(self, moment):
+        """
+        Returns the datetime of the next time the state flips after moment, or None if it never changes.
+        """
+        if not self.boundaries:
+            return None
+        minute = self.minute_of_week(moment)
+        i = bisect_right(self.boundaries, minute)
+        next_minute = self.boundaries[i] if i < len(self.boundaries) else self.boundaries[0] + MINUTES_PER_WEEK
+        start_of_minute = moment.replace(second=0, microsecond=0)
+        return start_of_minute + timedelta(minutes=next_minute - minute)
+
+    def windows(self):
+        """
+        The merged windows, for display.
+
+        Returns:
+            list: (weekday, "HH:MM", "HH:MM") tuples in week order. A window running past midnight
+            is listed on the day it starts, with its end time on the following day.
+        """
+        if not self.boundaries:
+            return [(day, "00:00", "24:00") for day in range(7)] if self.bitmap[0] else []
+
+        # Pair up boundaries into (start, end), starting from the first "off -> on" flip
+        starts = [b for b in self.boundaries if self.bitmap[b]]
+        ends = [b for b in self.boundaries if not self.bitmap[b]]
+        if ends[0] < starts[0]:
+            ends = ends[1:] + [ends[0] + MINUTES_PER_WEEK]
+
+        result = []
+        for start, end in zip(starts, ends):
+            result.append((start // MINUTES_PER_DAY, self._format(start), self._format(end)))
+        return result
+
+    @staticmethod
+    def _format(minute):
+        minute %= MINUTES_PER_DAY
+        return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+def format_weekdays(weekdays):
+    """
+    Returns a short Danish description of a weekday bitmask, e.g. "Man, Ons" or "Alle dage".
+    """
+    if weekdays is None or weekdays & ALL_WEEKDAYS == ALL_WEEKDAYS:
+        return "Alle dage"
+    return ", ".join(WEEKDAY_NAMES[day] for day in weekday_values(weekdays))
+
+
+def weekday_values(weekdays):
+    """
+    Returns the weekday numbers (0 = Monday) set in a weekday bitmask.
+    """
+    if weekdays is None:
+        weekdays = ALL_WEEKDAYS
+    return [day for day in range(7) if weekdays & (1 << day)]
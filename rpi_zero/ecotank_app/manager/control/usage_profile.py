@@ -0,0 +1,107 @@
+"""
+When a household uses hot water, as litres per hour for each of the 7 * 24 hours of the week.
+
+Each weekday-hour keeps the litres drawn and the hours it was observed, i.e. the detector was running (see
+draw_off_detector.py), and its usage is their ratio. Both decay exponentially with the time observed, so a cell
+forgets with a half-life of half_life_weeks of its own hours: habits that change are picked up within a few weeks,
+and a week without readings doesn't erase what was learned. Every update and query touches one cell, so the
+setpoint rules and the web pages never scan the draw-off history.
+"""
+from array import array
+from datetime import timedelta
+
+CELLS = 7 * 24
+
+
+def cell_of(moment):
+    """
+    The weekday-hour of moment, Monday 0-1 being 0.
+    """
+    return moment.weekday() * 24 + moment.hour
+
+
+class UsageProfile(object):
+    """
+    Decaying hot water usage per weekday-hour.
+
+    Args:
+        half_life_weeks (float): Weeks after which a draw-off counts half.
+    """
+
+    def __init__(self, half_life_weeks=4.0):
+        self.half_life_hours = half_life_weeks  # A cell is observed for one hour per week
+        self.litres = array("d", [0.0]) * CELLS
+        self.draws = array("d", [0.0]) * CELLS
+        self.hours = array("d", [0.0]) * CELLS
+        self.dirty = set()  # Cells changed since the last clear_dirty, see UsageTracker.flush
+
+    def observe(self, moment, seconds):
+        """
+        Counts seconds of observation ending at moment, all in the cell of moment.
+        """
+        cell = cell_of(moment)
+        hours = seconds / 3600.0
+        decay = 0.5 ** (hours / self.half_life_hours)
+        self.litres[cell] *= decay
+        self.draws[cell] *= decay
+        self.hours[cell] = self.hours[cell] * decay + hours
+        self.dirty.add(cell)
+
+    def add_draw(self, moment, litres):
+        """
+        Adds a draw-off of litres that started at moment.
+        """
+        cell = cell_of(moment)
+        self.litres[cell] += litres
+        self.draws[cell] += 1.0
+        self.dirty.add(cell)
+
+    def litres_per_hour(self, weekday, hour):
+        """
+        Usual litres drawn in an hour of a weekday, 0 if the hour hasn't been observed yet.
+        """
+        cell = weekday * 24 + hour
+        return self.litres[cell] / self.hours[cell] if self.hours[cell] else 0.0
+
+    def draws_per_hour(self, weekday, hour):
+        """
+        Usual number of draw-offs in an hour of a weekday, 0 if the hour hasn't been observed yet.
+        """
+        cell = weekday * 24 + hour
+        return self.draws[cell] / self.hours[cell] if self.hours[cell] else 0.0
+
+    def expected_litres(self, start, hours=1.0):
+        """
+        Litres usually drawn in the hours from start, counting partly covered hours pro rata.
+        """
+        total = 0.0
+        moment, end = start, start + timedelta(hours=hours)
+        while moment < end:
+            next_hour = moment.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            covered = (min(next_hour, end) - moment).total_seconds() / 3600.0
+            total += covered * self.litres_per_hour(moment.weekday(), moment.hour)
+            moment = next_hour
+        return total
+
+    def matrix(self):
+        """
+        Litres per hour as 7 lists of 24, Monday first.
+        """
+        return [[self.litres_per_hour(weekday, hour) for hour in range(24)] for weekday in range(7)]
+
+    def load(self, rows):
+        """
+        Restores stored cells from (weekday, hour, litres, draws, observed hours) tuples.
+        """
+        for weekday, hour, litres, draws, hours in rows:
+            cell = weekday * 24 + hour
+            self.litres[cell], self.draws[cell], self.hours[cell] = litres, draws, hours
+        self.dirty.clear()
+
+    def dirty_rows(self):
+        """
+        (weekday, hour, litres, draws, observed hours) of the cells changed since the last call, which clears them.
+        """
+        rows = [(cell // 24, cell % 24, self.litres[cell], self.draws[cell], self.hours[cell]) for cell in sorted(self.dirty)]
+        self.dirty.clear()
+        return rows
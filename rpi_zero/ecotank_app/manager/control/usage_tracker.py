@@ -0,0 +1,93 @@
+from datetime import timedelta
+from os import environ
+from ..boundary.logger import logger
+from ..boundary.clock import system_clock
+from .draw_off_detector import DrawOffDetector
+from .usage_profile import UsageProfile
+import shared_db as db
+
+
+class UsageTracker(object):
+    """
+    Runs a DrawOffDetector (see draw_off_detector.py) on the filtered readings of every control tick, and keeps
+    the tank's UsageProfile (see usage_profile.py) up to date with the draw-offs it finds and the hours observed.
+
+    Draw-offs are written as DrawOffEvent right away, together with the profile hours that changed; the profile
+    is also written every flush_interval seconds, so the observed hours survive a restart. Either publishes a
+    USAGE change, see change_bus.py. The stored profile is loaded at startup.
+
+    Args:
+        clock (SystemClock, optional): Time source, defaults to the wall clock. See clock.py.
+        capacity_l (float, optional): Litres at 100 % water level, defaults to ECOTANK_TANK_LITRES or 200 l.
+        flush_interval (float): Seconds between writes of the profile.
+        device (str, optional): The tank, defaults to shared_db.DEFAULT_DEVICE.
+    """
+
+    def __init__(self, clock=None, capacity_l=None, flush_interval=300.0, device=None):
+        self.clock = clock if clock is not None else system_clock
+        self.device = device if device is not None else db.DEFAULT_DEVICE
+        if capacity_l is None:
+            try:
+                capacity_l = float(environ.get("ECOTANK_TANK_LITRES", "200"))
+            except ValueError:
+                capacity_l = 200.0
+        self.detector = DrawOffDetector(capacity_l=capacity_l)
+        self.profile = UsageProfile()
+        self.flush_interval = flush_interval
+        self.previous = None  # Time of the last reading
+        self.pending = []  # Draw-offs not written yet
+        self.next_flush = None
+
+        log_ctx = "Usage Tracker:"
+        try:
+            with db.Session() as session:
+                self.profile.load(db.get_usage_profile(session, self.device))
+        except Exception as e:
+            logger.log(log_ctx, "Error loading the stored usage profile", "ERROR", e)
+
+    def update(self, water_temp, water_level):
+        """
+        Adds the filtered reading of a tick. Cheap to call every loop iteration.
+
+        Returns:
+            DrawOff or None: The draw-off the reading ended, if any.
+        """
+        log_ctx = "Usage Tracker:"
+        now = self.clock.now()
+        previous, self.previous = self.previous, now
+        if previous is not None and 0 < (now - previous).total_seconds() <= self.detector.max_gap:
+            self.profile.observe(now, (now - previous).total_seconds())
+        if self.next_flush is None:
+            self.next_flush = now + timedelta(seconds=self.flush_interval)
+
+        draw_off = self.detector.update(now, water_level, water_temp)
+        if draw_off is not None:
+            logger.log(
+                log_ctx,
+                f"{self.device}: {draw_off.litres:.0f} l drawn from {draw_off.start:%H:%M:%S} to {draw_off.end:%H:%M:%S}",
+                "DEBUG",
+            )
+            self.profile.add_draw(draw_off.start, draw_off.litres)
+            self.pending.append(draw_off)
+        if draw_off is not None or now >= self.next_flush:
+            self.flush()
+        return draw_off
+
+    def flush(self):
+        """
+        Writes the new draw-offs and the changed profile hours.
+        """
+        log_ctx = "Usage Tracker:"
+        self.next_flush = self.clock.now() + timedelta(seconds=self.flush_interval)
+        rows = self.profile.dirty_rows()
+        if not rows and not self.pending:
+            return
+        with db.Session() as session:
+            try:
+                db.save_usage(session, rows, self.pending, device=self.device)
+            except Exception as e:
+                logger.log(log_ctx, "Error saving usage to database", "ERROR", e)
+                # The rows are rewritten at the next flush, with the values they have then
+                self.profile.dirty.update(weekday * 24 + hour for weekday, hour, *_ in rows)
+                return
+        self.pending = []
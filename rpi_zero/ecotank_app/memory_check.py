@@ -0,0 +1,193 @@
+"""
+Memory regression check: seeds a temporary database with years of prices and telemetry, runs the memory-heavy
+paths of both processes and compares the tracemalloc peak of each against a budget. Exits with status 1 if a
+budget is exceeded, so it can gate a release the same way startup_bench.py does.
+
+Examples:
+    python rpi_zero/ecotank_app/memory_check.py
+    python rpi_zero/ecotank_app/memory_check.py --low-memory --days 1825
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Peak traced KiB per scenario with the default seed size (3 years of prices for two regions, 100k readings).
+# Roughly 1.5x what was measured when the budgets were set; loading the dashboard prices as ORM objects alone took 40 MB.
+BUDGETS_KIB = {
+    "dashboard": 12_000,
+    "export": 1_000,
+    "forecast training": 8_000,
+    "manager loop": 500,
+}
+
+
+def seed_prices(db, session, first_hour, hours, regions=("DK1",)):
+    """
+    Bulk inserts synthetic hourly prices, dearer in the morning and evening peaks and at weekends. Shared with
+    job_bench.py and state_bench.py. Not committed.
+
+    Args:
+        db (module): shared_db, imported by the caller once the database is chosen.
+        session (Session): Session to insert with.
+        first_hour (datetime): Start of the first price.
+        hours (int): Number of prices per region.
+        regions (tuple): Price regions.
+    """
+    from sqlalchemy import insert
+
+    for region in regions:
+        rows = []
+        for i in range(hours):
+            time_start = first_hour + timedelta(hours=i)
+            price = 0.8 + 0.6 * ((i % 24) in (7, 8, 17, 18, 19)) + 0.2 * ((i // 24) % 7 > 4)
+            rows.append(
+                {
+                    "DKK_per_kWh": price,
+                    "EUR_per_kWh": price / 7.46,
+                    "EXR": 7.46,
+                    "region": region,
+                    "time_start": time_start,
+                    "time_end": time_start + timedelta(hours=1),
+                }
+            )
+        session.execute(insert(db.ElectricityPrice), rows)
+
+
+def seed_database(db, days, readings):
+    """
+    Bulk inserts hourly prices for DK1 and DK2 and a reading every 30 s, ending today.
+    """
+    from sqlalchemy import insert
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    with db.Session() as session:
+        seed_prices(db, session, today - timedelta(days=days), days * 24, regions=("DK1", "DK2"))
+        first_reading = today - timedelta(seconds=30 * readings)
+        session.execute(
+            insert(db.SensorReading),
+            [
+                {
+                    "time": first_reading + timedelta(seconds=30 * i),
+                    "water_temp": 40.0 + (i % 100) / 10,
+                    "water_level": 50 + i % 40,
+                    "setpoint": 40,
+                    "sys_power": True,
+                }
+                for i in range(readings)
+            ],
+        )
+        session.commit()
+
+
+def measure(name, function):
+    """
+    Runs function and returns its tracemalloc peak in KiB, above what was allocated before it started.
+    Garbage left by the previous scenario is collected first, or freeing it would lower this scenario's peak.
+    """
+    gc.collect()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    function()
+    return (tracemalloc.get_traced_memory()[1] - before) // 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check peak memory of the heavy paths on a seeded large database.")
+    parser.add_argument("--days", type=int, default=1095, help="Days of hourly prices per region")
+    parser.add_argument("--readings", type=int, default=100_000, help="Telemetry rows")
+    parser.add_argument("--low-memory", action="store_true", help="Run with ECOTANK_LOW_MEMORY=1")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if args.low_memory:
+        os.environ["ECOTANK_LOW_MEMORY"] = "1"  # Read when shared_db is imported
+    # Jobs run in the request thread, so the dashboard's chart is traced too. See job_queue.py
+    os.environ["ECOTANK_JOB_WORKERS"] = "0"
+
+    import shared_db as db
+    from manager.boundary.logger import logger
+    from manager.boundary.memory_report import rss_kib
+    from manager.boundary.clock import SimulatedClock
+    from manager.boundary.tank_simulator import TankSimulator
+    from manager.boundary.transport import SimulatedTransport
+    from manager.boundary.arduino_interface import ArduinoIF
+    from manager.boundary.elpris_api import ReplayElprisAPI
+    from manager.control.elpris_data_manager import ElprisDataManager
+    from system_manager import SystemManager
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db.use_database(os.path.join(workdir, "memory_check.db"))
+        db.create_database()
+        seed_database(db, args.days, args.readings)
+
+        from webserver import create_app
+
+        app = create_app(background_warm_up=False)
+        client = app.test_client()
+        client.get("/")  # First request setup isn't part of any scenario
+        # Neither is importing Bokeh, which the first chart would do; the webserver no longer does it at startup
+        try:
+            import bokeh.plotting, bokeh.embed, bokeh.models  # noqa: F401
+        except ImportError:
+            pass
+
+        def dashboard():
+            response = client.get("/dashboard")
+            assert response.status_code == 200, response.status_code
+
+        def export():
+            response = client.get("/export/telemetry.csv", buffered=False)
+            for _ in response.response:
+                pass
+            response.close()
+
+        def forecast_training():
+            ElprisDataManager(api=ReplayElprisAPI({})).update_forecast("DK1")
+
+        # The first iterations train the forecaster and fill the statement caches, so only the steady state
+        # after them is measured; growth there means something is accumulating per tick
+        clock = SimulatedClock(datetime.now())
+        arduino = ArduinoIF(SimulatedTransport(TankSimulator(clock)), clock=clock)
+        manager = SystemManager(arduino_interface=arduino, elpris_api=ReplayElprisAPI({}, clock), clock=clock)
+        for _ in range(20):
+            manager.run_once()
+            clock.sleep(1.0)
+
+        def manager_loop():
+            for _ in range(1000):
+                manager.run_once()
+                clock.sleep(1.0)
+
+        scenarios = {
+            "dashboard": dashboard,
+            "export": export,
+            "forecast training": forecast_training,
+            "manager loop": manager_loop,
+        }
+
+        tracemalloc.start()
+        failed = False
+        print(f"{'scenario':<20}{'peak KiB':>10}{'budget':>10}")
+        for name, function in scenarios.items():
+            peak = measure(name, function)
+            over = peak > BUDGETS_KIB[name]
+            failed = failed or over
+            print(f"{name:<20}{peak:>10}{BUDGETS_KIB[name]:>10}{'  OVER BUDGET' if over else ''}")
+        tracemalloc.stop()
+
+        current, peak = rss_kib()
+        print(f"RSS {current} KiB, peak RSS {peak} KiB{' (low-memory mode)' if db.LOW_MEMORY else ''}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Run the MQTT telemetry publisher (see manager/control/telemetry_publisher.py) against the in-process stand-in broker
+(see manager/boundary/mqtt_broker.py), with the manager driving simulated tanks on the wall clock.
+
+Three phases are measured:
+    - Telemetry: how many state changes the tanks handed to the publisher, how many of them were coalesced, the
+      messages and batches sent, and the time update takes in the tank's loop.
+    - Commands: the time from publishing "OFF" and "ON" on ecotank/tank1/power/set until the simulated Arduino
+      receives the new power and the state topic confirms it.
+    - Outage: the broker is stopped for --outage seconds while --events draw-off events are queued, then started
+      again. Reported are the time until the publisher is back and the events delivered and dropped.
+
+Examples:
+    python rpi_zero/ecotank_app/mqtt_bench.py
+    python rpi_zero/ecotank_app/mqtt_bench.py --devices 4 --rate 5 --qos 1 --events 1500
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from manager.boundary.logger import logger
+from manager.boundary.clock import system_clock
+from manager.boundary.transport import SimulatedTransport
+from manager.boundary.tank_simulator import TankSimulator
+from manager.boundary.arduino_interface import ArduinoIF
+from manager.boundary.elpris_api import ReplayElprisAPI
+from manager.boundary.mqtt_broker import LocalBroker, topic_matches
+from manager.boundary.mqtt_client import Message, MqttClient
+import shared_db as db
+
+
+class Subscriber(object):
+    """
+    Records every message on topic_filter, reconnecting after the broker went away.
+    """
+
+    def __init__(self, port, topic_filter):
+        self.client = MqttClient("127.0.0.1", port, client_id="bench-subscriber", keepalive=10)
+        self.topic_filter = topic_filter
+        self.messages = []  # (time received, Message)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="subscriber", daemon=True)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                if not self.client.connected:
+                    self.client.connect()
+                    self.client.subscribe([self.topic_filter], qos=1)
+                received = self.client.poll(0.05)
+            except OSError:
+                self.client.close()
+                self.stopping.wait(0.05)
+                continue
+            now = time.perf_counter()
+            with self.lock:
+                self.messages += [(now, message) for message in received]
+
+    def count(self, topic_filter, since=0.0):
+        with self.lock:
+            return sum(1 for at, message in self.messages if at >= since and topic_matches(topic_filter, message.topic))
+
+    def wait_for(self, topic, payload, since, timeout=10.0):
+        """
+        Seconds from since until topic had payload, or None.
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self.lock:
+                for at, message in self.messages:
+                    if at >= since and message.topic == topic and message.payload == payload:
+                        return at - since
+            time.sleep(0.005)
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if condition():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def run(args):
+    from system_manager import SystemManager
+
+    broker = LocalBroker().start()
+    os.environ.update(
+        ECOTANK_MQTT_HOST="127.0.0.1",
+        ECOTANK_MQTT_PORT=str(broker.port),
+        ECOTANK_MQTT_QOS=str(args.qos),
+        ECOTANK_MQTT_INTERVAL=str(args.interval),
+        ECOTANK_MQTT_BUFFER=str(args.buffer),
+    )
+    simulators = [TankSimulator(system_clock, start_temp=40.0 + i, level_noise_cm=3.0) for i in range(args.devices)]
+    interfaces = [(f"tank{i + 1}", ArduinoIF(SimulatedTransport(simulator))) for i, simulator in enumerate(simulators)]
+    manager = SystemManager(elpris_api=ReplayElprisAPI({}), devices=interfaces)
+    manager.loop_interval = 1.0 / args.rate
+    publisher = manager.telemetry
+    with db.Session() as session:
+        for name, _ in interfaces:
+            db.get_system_data(session, name).sys_power = True
+        session.commit()
+
+    # Every update from the tank loops is timed by wrapping the bound method
+    update_times = []
+    update = publisher.update
+
+    def timed_update(*args, **kwargs):
+        start = time.perf_counter()
+        update(*args, **kwargs)
+        update_times.append(time.perf_counter() - start)
+
+    publisher.update = timed_update
+
+    subscriber = Subscriber(broker.port, "ecotank/#")
+    subscriber.thread.start()
+    thread = threading.Thread(target=manager.run, name="manager", daemon=True)
+    thread.start()
+    time.sleep(args.duration)
+
+    status = publisher.status()
+    print(f"Telemetry, {args.devices} tanks at {args.rate:g} Hz for {args.duration:g} s, QoS {args.qos}, batches every {args.interval:g} s:")
+    print(
+        f"  {len(update_times)} updates from the tank loops, {status['updates']} changed values, "
+        f"{status['coalesced']} coalesced"
+    )
+    print(
+        f"  {status['sent']} messages in {status['batches']} batches, "
+        f"{subscriber.count('ecotank/+/+')} state messages received"
+    )
+    print(
+        f"  update: p50 {percentile(update_times, 0.5) * 1e6:.1f} us, p99 {percentile(update_times, 0.99) * 1e6:.1f} us"
+    )
+
+    print("Commands on ecotank/tank1/power/set:")
+    commander = MqttClient("127.0.0.1", broker.port, client_id="bench-commander")
+    commander.connect()
+    for payload, power in (("OFF", False), ("ON", True)):
+        start = time.perf_counter()
+        commander.publish([Message("ecotank/tank1/power/set", payload, args.qos, False)])
+        applied = wait_until(lambda: simulators[0].system_power == power) and time.perf_counter() - start
+        confirmed = subscriber.wait_for("ecotank/tank1/power", payload.encode(), start)
+        print(
+            f"  {payload:<3}: Arduino after {applied * 1000:.0f} ms, confirmed after {confirmed * 1000:.0f} ms"
+            if applied and confirmed is not None
+            else f"  {payload:<3}: not applied within 10 s"
+        )
+    commander.disconnect()
+
+    print(f"Outage of {args.outage:g} s with {args.events} draw-off events queued, buffer {args.buffer}:")
+    broker.stop()
+    for i in range(args.events):
+        publisher.event("tank1", "draw_off", {"litres": 10.0, "sequence": i})
+    time.sleep(args.outage)
+    dropped = publisher.status()["dropped"]
+    # Counted on the broker, as the subscriber may reconnect after the publisher
+    first = len(broker.published)
+
+    def events_delivered():
+        return sum(1 for message in broker.published[first:] if topic_matches("ecotank/+/draw_off", message.topic))
+
+    start = time.perf_counter()
+    broker.start()
+    delivered = wait_until(lambda: events_delivered() >= min(args.events, args.buffer), timeout=90.0)
+    print(
+        f"  back after {time.perf_counter() - start:.1f} s, {events_delivered()} events delivered, {dropped} dropped"
+        + ("" if delivered else " (incomplete)")
+    )
+
+    manager.stop()
+    thread.join()
+    subscriber.stopping.set()
+    subscriber.thread.join()
+    broker.stop()
+    return delivered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the MQTT telemetry publisher against the stand-in broker.")
+    parser.add_argument("--devices", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=5.0, help="Loop rate per tank in Hz")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of telemetry")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between batches")
+    parser.add_argument("--buffer", type=int, default=1000, help="Events kept while the broker is down")
+    parser.add_argument("--events", type=int, default=1200, help="Events queued during the outage")
+    parser.add_argument("--outage", type=float, default=3.0, help="Seconds the broker is down")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db.use_database(os.path.join(workdir, "mqtt_bench.db"))
+        delivered = run(args)
+        db.Session.remove()
+    sys.exit(0 if delivered else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Benchmark the manager driving several tanks: each tank is a TankSimulator behind its own SimulatedTransport, and
+SystemManager.run gives each one its own loop thread (see tank_controller.py), on the wall clock.
+
+Two scenarios are run: all links answering immediately, and the first link taking --slow-latency seconds per
+exchange, like a Arduino on a bad USB cable. Per tank the achieved loop rate and the exchange and tick latencies
+are reported, with the CPU time of the whole process. Exits with status 1 if any tank other than the slow one
+runs below 95 % of the target rate.
+
+The CPU use per tick measured on a development machine can be scaled to estimate the load on a Pi; on the Pi
+itself, the benchmark measures it directly.
+
+Examples:
+    python rpi_zero/ecotank_app/multi_tank_bench.py
+    python rpi_zero/ecotank_app/multi_tank_bench.py --devices 16 --rate 5 --duration 30 --slow-latency 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from manager.boundary.logger import logger
+from manager.boundary.clock import system_clock
+from manager.boundary.transport import Transport, SimulatedTransport
+from manager.boundary.tank_simulator import TankSimulator
+from manager.boundary.arduino_interface import ArduinoIF
+from manager.boundary.elpris_api import ReplayElprisAPI
+import shared_db as db
+from system_manager import SystemManager
+
+
+class SlowTransport(Transport):
+    """
+    Wraps a transport and delays every write by latency seconds.
+    """
+
+    name = "slow"
+
+    def __init__(self, inner, latency):
+        self.inner = inner
+        self.latency = latency
+
+    def open(self):
+        self.inner.open()
+
+    def close(self):
+        self.inner.close()
+
+    @property
+    def is_open(self):
+        return self.inner.is_open
+
+    def write(self, data):
+        time.sleep(self.latency)
+        self.inner.write(data)
+
+    def wait_readable(self, timeout):
+        return self.inner.wait_readable(timeout)
+
+    def read_available(self):
+        return self.inner.read_available()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_scenario(devices, rate, duration, slow_latency):
+    """
+    Runs the manager with devices simulated tanks for duration seconds.
+
+    Returns:
+        tuple: ({device: dict of ticks, rate and latencies}, CPU seconds, wall seconds)
+    """
+    interfaces = []
+    for i in range(devices):
+        transport = SimulatedTransport(TankSimulator(system_clock, start_temp=40.0 + i))
+        if slow_latency and i == 0:
+            transport = SlowTransport(transport, slow_latency)
+        interfaces.append((f"tank{i + 1}", ArduinoIF(transport)))
+    manager = SystemManager(elpris_api=ReplayElprisAPI({}), devices=interfaces)
+    manager.loop_interval = 1.0 / rate
+
+    with db.Session() as session:
+        for name, _ in interfaces:
+            db.get_system_data(session, name).sys_power = True
+        session.commit()
+
+    # Every tick and exchange is timed by wrapping the bound methods of the controller and its interface
+    stats = {controller.device: {"ticks": [], "exchanges": []} for controller in manager.controllers}
+    for controller in manager.controllers:
+        def timed(method, samples):
+            def wrapper(*args):
+                start = time.perf_counter()
+                result = method(*args)
+                samples.append((start, time.perf_counter() - start))
+                return result
+
+            return wrapper
+
+        device_stats = stats[controller.device]
+        controller.run_once = timed(controller.run_once, device_stats["ticks"])
+        interface = controller.arduino_interface
+        interface.exchange_data = timed(interface.exchange_data, device_stats["exchanges"])
+
+    thread = threading.Thread(target=manager.run, name="manager", daemon=True)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    thread.start()
+    time.sleep(duration)
+    manager.stop()
+    thread.join()
+    cpu_time, wall_time = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+    results = {}
+    for device, device_stats in stats.items():
+        ticks = device_stats["ticks"]
+        # The rate is taken between the first and last tick, so thread startup isn't counted. The first tick
+        # loads the stored state and runs the first calibration, so it is left out of the latencies too
+        span = ticks[-1][0] - ticks[0][0] if len(ticks) > 1 else 0.0
+        exchanges = [d for _, d in device_stats["exchanges"][1:]]
+        results[device] = {
+            "ticks": len(ticks),
+            "rate": (len(ticks) - 1) / span if span else 0.0,
+            "exchange_p50": percentile(exchanges, 0.5),
+            "exchange_p99": percentile(exchanges, 0.99),
+            "tick_p50": percentile([d for _, d in ticks[1:]], 0.5),
+            "tick_p99": percentile([d for _, d in ticks[1:]], 0.99),
+        }
+    return results, cpu_time, wall_time
+
+
+def report(title, results, cpu_time, wall_time):
+    ticks = sum(result["ticks"] for result in results.values())
+    print(title)
+    print(f"{'device':<8} {'ticks':>6} {'Hz':>6} {'exch p50':>9} {'exch p99':>9} {'tick p50':>9} {'tick p99':>9}")
+    for device, result in results.items():
+        print(
+            f"{device:<8} {result['ticks']:>6} {result['rate']:>6.2f} "
+            f"{result['exchange_p50'] * 1000:>7.2f}ms {result['exchange_p99'] * 1000:>7.2f}ms "
+            f"{result['tick_p50'] * 1000:>7.2f}ms {result['tick_p99'] * 1000:>7.2f}ms"
+        )
+    print(
+        f"CPU: {cpu_time / wall_time:.1%} of one core, {cpu_time / ticks * 1000:.2f} ms per tick "
+        f"({ticks} ticks in {wall_time:.1f} s)"
+    )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the manager driving several simulated tanks.")
+    parser.add_argument("--devices", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=5.0, help="Target loop rate per tank in Hz")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="Exchange delay of the slow link in seconds")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        scenarios = [("all links fast", 0.0)]
+        if args.slow_latency:
+            scenarios.append((f"tank1 link taking {args.slow_latency:g} s per exchange", args.slow_latency))
+        for i, (title, slow_latency) in enumerate(scenarios):
+            db.use_database(os.path.join(workdir, f"scenario{i}.db"))
+            results, cpu_time, wall_time = run_scenario(args.devices, args.rate, args.duration, slow_latency)
+            db.Session.remove()
+            report(f"{args.devices} tanks at {args.rate:g} Hz, {title}:", results, cpu_time, wall_time)
+            for device, result in results.items():
+                if slow_latency and device == "tank1":
+                    continue
+                if result["rate"] < 0.95 * args.rate:
+                    print(f"{device} missed the target rate: {result['rate']:.2f} Hz")
+                    failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from sqlalchemy import (
     Column,
     Integer,
     String,
+    Date,
     DateTime,
     Float,
     ForeignKey,
@@ -9,35 +10,142 @@ from sqlalchemy import (
     UniqueConstraint,
     Boolean,
     create_engine,
+    event,
+    inspect,
+    text,
+    func,
 )
-from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.orm import Session as OrmSession, sessionmaker, scoped_session, relationship
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from datetime import datetime
+from sqlalchemy.engine import Engine
+from datetime import datetime, timedelta
 from manager.boundary.logger import logger
-from os import path
+from manager.boundary.price_archive import PriceArchive
+from manager.boundary.price_cache import PriceCache
+from manager.boundary.db_backup import DatabaseBackup
+from manager.boundary import change_bus as changes
+from os import path, environ
+from types import SimpleNamespace
 
 Base = declarative_base()
 
 DB_NAME = "database.db"
-engine = create_engine("sqlite:///" + path.join(path.dirname(__file__), "instance", DB_NAME))
+db_path = path.join(path.dirname(__file__), "instance", DB_NAME)
+
+# Every tank has its own system data, settings, readings, energy totals and calibration, keyed by device name.
+# Databases from before multi-tank support get this name for their rows. See SystemManager for the configuration.
+DEFAULT_DEVICE = "tank1"
+
+# Low-memory mode for 512 MB hardware: smaller SQLAlchemy statement cache and SQLite page cache in both processes
+LOW_MEMORY = environ.get("ECOTANK_LOW_MEMORY", "0") == "1"
+ENGINE_OPTIONS = {"query_cache_size": 50} if LOW_MEMORY else {}
+SQLITE_CACHE_KIB = 256 if LOW_MEMORY else None
+# Region-days of prices kept in memory by price_cache, about 0.5 kB each
+try:
+    PRICE_CACHE_DAYS = int(environ.get("ECOTANK_PRICE_CACHE_DAYS", "200" if LOW_MEMORY else "1000"))
+except ValueError:
+    PRICE_CACHE_DAYS = 200 if LOW_MEMORY else 1000
+
+
+@event.listens_for(Engine, "connect")
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # Applies to every engine, including the one Flask-SQLAlchemy creates for the webserver
+    if SQLITE_CACHE_KIB is not None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KIB}")
+        cursor.close()
+
+
+engine = create_engine("sqlite:///" + db_path, **ENGINE_OPTIONS)
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
+# Old electricity prices are moved here by archive_prices, see price_archive.py
+price_archive = PriceArchive(path.join(path.dirname(db_path), "price_archive"))
+# Committed changes are published here for both processes, see change_bus.py and _collect_changes
+change_bus = changes.ChangeBus(path.join(path.dirname(db_path), "changes"))
+
+
+def _load_price_rows(region, first, last):
+    # Loader of price_cache, defined before it. Uses its own session, so it can be called from any thread
+    start = datetime.combine(first, datetime.min.time()) if first is not None else None
+    end = datetime.combine(last + timedelta(days=1), datetime.min.time()) if last is not None else None
+    with session_factory() as session:
+        return get_price_history(session, region, start, end)
+
+
+# Electricity prices as one array per region and day, shared by all readers in the process. See price_cache.py
+price_cache = PriceCache(change_bus, _load_price_rows, max_days=PRICE_CACHE_DAYS)
+
+
+def use_database(new_db_path):
+    """
+    Points the engine and Session of this module at another SQLite file, and the price archive at a directory next to it.
+    Used by the simulator so replays never touch the live database. Must be called before any session is opened.
+
+    Parameters:
+        new_db_path (str): Path to the SQLite database file to use.
+    """
+    global engine, db_path
+    Session.remove()
+    engine.dispose()
+    db_path = new_db_path
+    engine = create_engine("sqlite:///" + db_path, **ENGINE_OPTIONS)
+    session_factory.configure(bind=engine)
+    price_archive.directory = path.join(path.dirname(db_path), "price_archive")
+    change_bus.reopen(path.join(path.dirname(db_path), "changes"))
+
+
+def profile_directory():
+    """
+    Directory where both processes exchange sampling profiles, next to the database. See sampling_profiler.py.
+    """
+    return path.join(path.dirname(db_path), "profiles")
+
+
+def database_backup(clock=None):
+    """
+    A DatabaseBackup of the current database (see db_backup.py), configured through the environment:
+        ECOTANK_BACKUP_DIR (default "backups" next to the database), ECOTANK_BACKUP_KEEP (snapshots, default 7),
+        ECOTANK_BACKUP_INTERVAL_HOURS (default 24, 0 disables the scheduled backups).
+    """
+    try:
+        keep = int(environ.get("ECOTANK_BACKUP_KEEP", "7"))
+        interval_hours = float(environ.get("ECOTANK_BACKUP_INTERVAL_HOURS", "24"))
+    except ValueError:
+        keep, interval_hours = 7, 24.0
+    directory = environ.get("ECOTANK_BACKUP_DIR") or path.join(path.dirname(db_path), "backups")
+    return DatabaseBackup(db_path, directory, keep=keep, interval_hours=interval_hours, clock=clock)
+
+
+def _device_column(unique=False):
+    # Tables with a single row per tank are unique on the device, which guards the create-if-missing getters
+    return Column(
+        String(32),
+        nullable=False,
+        default=DEFAULT_DEVICE,
+        server_default=text(f"'{DEFAULT_DEVICE}'"),
+        index=True,
+        unique=unique,
+    )
 
 
 class UserSettings(Base):
     """
-    Represents the user settings for the application. Only a single instance of this class should exist in the database.
+    Represents the user settings for the application. Only a single instance per device should exist in the database.
     To ensure this, use the `get_user_settings` function to get the user settings object.
 
     Attributes:
         id (int): The unique identifier for the user settings.
+        device (str): The tank the settings are for.
         min_temp (float): The minimum temperature set by the user.
         std_temp (float): The standard temperature set by the user.
         high_temp (float): The high temperature set by the user.
         price_treshold (float): The electricity price threshold set by the user.
         price_region (str): The electricity price region set by the user.
         time_intervals (list): The list of time intervals associated with the user settings.
+        settings_version (int): Incremented on every settings change, so readers can cheaply detect changes.
     """
 
     __tablename__ = "user_settings"
@@ -48,6 +156,8 @@ class UserSettings(Base):
     price_threshold = Column(Float, nullable=False, default=1.0)
     price_region = Column(String(6), nullable=False, default="DK1")
     days_to_fetch = Column(Integer, nullable=False, default=2)  # Add to settings page
+    settings_version = Column(Integer, nullable=False, default=0, server_default="0")
+    device = _device_column(unique=True)
     time_intervals = relationship("TimeInterval", cascade="all, delete-orphan")
 
 
@@ -59,7 +169,8 @@ class TimeInterval(Base):
     Attributes:
         id (int): The unique identifier for the time interval.
         start_time (datetime.time): The start time of the interval.
-        end_time (datetime.time): The end time of the interval.
+        end_time (datetime.time): The end time of the interval. If earlier than start_time, the interval runs past midnight.
+        weekdays (int): Bitmask of the weekdays the interval starts on (bit 0 = Monday, 127 = every day).
         user_settings_id (int): The foreign key referencing the associated user settings.
     """
 
@@ -67,16 +178,19 @@ class TimeInterval(Base):
     id = Column(Integer, primary_key=True)
     start_time = Column(Time, nullable=False)
     end_time = Column(Time, nullable=False)
+    weekdays = Column(Integer, nullable=False, default=127, server_default="127")
     user_settings_id = Column(Integer, ForeignKey("user_settings.id"))
 
 
 class SystemData(Base):
     """
-    Represents the system data table in the database. Only a single instance of this class should exist in the database.
+    Represents the system data table in the database. Only a single instance per device should exist in the database.
     To ensure this, use the `get_system_data` function to get the system data object.
+    The manager creates the row of every configured device at startup, so the rows are also the list of devices.
 
     Attributes:
         id (int): The primary key of the table.
+        device (str): The tank the data is for.
         sys_power (bool): The status of the system power.
         setpoint (float): The set point temperature for the system.
         water_temp (float): The current temperature of the water.
@@ -90,6 +204,7 @@ class SystemData(Base):
     setpoint = Column(Integer, nullable=False, default=30.0)
     water_temp = Column(Float, nullable=False, default=0.0)
     water_level = Column(Integer, nullable=False, default=0)
+    device = _device_column(unique=True)
 
 
 class OverrideSettings(Base):
@@ -99,6 +214,7 @@ class OverrideSettings(Base):
 
     Attributes:
         id (int): The unique identifier for the table.
+        device (str): The tank the override is for.
         start_time (datetime): The start time for the override period.
         end_time (datetime): The end time for the override period.
         toggled_on (bool): Indicates whether manuel opvarmning is toggled on or off.
@@ -111,6 +227,7 @@ class OverrideSettings(Base):
     end_time = Column(DateTime(timezone=True)) # Create button to add 20 minutes to end time, show on dashboard
     toggled_on = Column(Boolean, nullable=False, default=False) # Show on dashboard with button to toggle
     allow_high_temp = Column(Boolean, nullable=False, default=False) # Add to settings page
+    device = _device_column(unique=True)
 
 
 class ElectricityPrice(Base):
@@ -140,46 +257,411 @@ class ElectricityPrice(Base):
     __table_args__ = (UniqueConstraint("region", "time_start", "time_end", name="unique_region_datetime"),)
 
 
+class SensorReading(Base):
+    """
+    Represents a persisted sensor reading. A row is appended every time the sensor conditioner decides a reading
+    is worth persisting (see sensor_conditioner.py), so this is the recorded telemetry history.
+
+    Attributes:
+        id (int): The unique identifier for the reading.
+        time (datetime): When the reading was persisted.
+        water_temp (float): The filtered water temperature.
+        water_level (int): The filtered water level in percent.
+        setpoint (int): The setpoint at the time of the reading.
+        sys_power (bool): The system power at the time of the reading.
+        device (str): The tank the reading is from.
+    """
+
+    __tablename__ = "sensor_reading"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, nullable=False, index=True)
+    water_temp = Column(Float, nullable=False)
+    water_level = Column(Integer, nullable=False)
+    setpoint = Column(Integer, nullable=False)
+    sys_power = Column(Boolean, nullable=False)
+    device = _device_column()
+
+
+class PriceForecast(Base):
+    """
+    Represents a provisional electricity price for an hour that has not been published yet, see price_forecaster.py.
+    Kept apart from ElectricityPrice so a forecast can never be mistaken for a real price.
+    Forecasts are replaced on every retrain and deleted as soon as the real price for the hour is stored.
+
+    Attributes:
+        id (int): The unique identifier for the forecast entry.
+        region (str): The region the forecast is for.
+        time_start (datetime): The start time of the forecasted hour.
+        DKK_per_kWh (float): The forecasted price in Danish Kroner per kilowatt-hour.
+        DKK_lower (float): Lower bound of the confidence band.
+        DKK_upper (float): Upper bound of the confidence band.
+        created_at (datetime): When the forecast was made.
+    """
+
+    __tablename__ = "price_forecast"
+    id = Column(Integer, primary_key=True)
+    region = Column(String(5), nullable=False)
+    time_start = Column(DateTime, nullable=False)
+    DKK_per_kWh = Column(Float, nullable=False)
+    DKK_lower = Column(Float, nullable=False)
+    DKK_upper = Column(Float, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (UniqueConstraint("region", "time_start", name="unique_forecast_region_datetime"),)
+
+
+class EnergyHour(Base):
+    """
+    Estimated heater energy and cost for one hour, maintained by the energy accountant (see energy_accountant.py).
+
+    Attributes:
+        id (int): The unique identifier for the entry.
+        hour_start (datetime): Start of the hour.
+        heating_seconds (float): Seconds the heater was on.
+        energy_wh (float): Estimated heater energy in Wh.
+        priced_wh (float): The part of energy_wh used while the hour's price was known.
+        cost_dkk (float): Cost of priced_wh at the hour's price.
+        price_dkk (float): The hour's price in DKK per kWh, None if it was not known.
+        device (str): The tank the entry is for.
+    """
+
+    __tablename__ = "energy_hour"
+    id = Column(Integer, primary_key=True)
+    hour_start = Column(DateTime, nullable=False)
+    heating_seconds = Column(Float, nullable=False, default=0.0)
+    energy_wh = Column(Float, nullable=False, default=0.0)
+    priced_wh = Column(Float, nullable=False, default=0.0)
+    cost_dkk = Column(Float, nullable=False, default=0.0)
+    price_dkk = Column(Float)
+    device = _device_column()
+
+    __table_args__ = (UniqueConstraint("device", "hour_start", name="unique_device_hour"),)
+
+
+class EnergyDay(Base):
+    """
+    Daily totals of EnergyHour, plus the sum of the day's hourly prices for the flat-price comparison.
+
+    Attributes:
+        id (int): The unique identifier for the entry.
+        day (date): The day.
+        heating_seconds (float): Seconds the heater was on.
+        energy_wh (float): Estimated heater energy in Wh.
+        priced_wh (float): The part of energy_wh used in hours with a known price.
+        cost_dkk (float): Cost of priced_wh at the hourly prices.
+        price_sum (float): Sum of the known hourly prices of the day.
+        price_hours (int): Number of hours in price_sum.
+        device (str): The tank the entry is for.
+    """
+
+    __tablename__ = "energy_day"
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    heating_seconds = Column(Float, nullable=False, default=0.0)
+    energy_wh = Column(Float, nullable=False, default=0.0)
+    priced_wh = Column(Float, nullable=False, default=0.0)
+    cost_dkk = Column(Float, nullable=False, default=0.0)
+    price_sum = Column(Float, nullable=False, default=0.0)
+    price_hours = Column(Integer, nullable=False, default=0)
+    device = _device_column()
+
+    __table_args__ = (UniqueConstraint("device", "day", name="unique_device_day"),)
+
+    @property
+    def flat_cost_dkk(self):
+        """
+        What priced_wh would have cost at the day's average hourly price, or None without prices.
+        """
+        if not self.price_hours:
+            return None
+        return self.priced_wh / 1000.0 * self.price_sum / self.price_hours
+
+
+class ThermalCalibration(Base):
+    """
+    The last thermal model fit of a tank (see thermal_model.py). Only a single instance per device should exist
+    in the database, written by the manager with `save_thermal_calibration`.
+
+    Attributes:
+        id (int): The primary key of the table.
+        fitted_at (datetime): When the fit was made.
+        heating_rate (float): Temperature rise from the heater in K/s, for a full tank.
+        loss_rate (float): Heat loss coefficient in 1/s, for a full tank.
+        ambient_temp (float): The temperature the tank cools towards.
+        samples (int): Intervals between readings used by the fit.
+        rmse (float): Root mean square error of the fit in K/h.
+        device (str): The tank the fit is for.
+    """
+
+    __tablename__ = "thermal_calibration"
+    id = Column(Integer, primary_key=True)
+    fitted_at = Column(DateTime, nullable=False)
+    heating_rate = Column(Float, nullable=False)
+    loss_rate = Column(Float, nullable=False)
+    ambient_temp = Column(Float, nullable=False)
+    samples = Column(Integer, nullable=False)
+    rmse = Column(Float, nullable=False)
+    device = _device_column(unique=True)
+
+
+class DrawOffEvent(Base):
+    """
+    A hot water draw-off found in the water level readings by the manager (see draw_off_detector.py).
+
+    Attributes:
+        id (int): The unique identifier for the entry.
+        start (datetime): When the level started to fall.
+        end (datetime): When the level reached its lowest point.
+        litres (float): Water drawn, from the fall of the level.
+        water_temp (float): Water temperature when the draw-off started.
+        device (str): The tank the draw-off was from.
+    """
+
+    __tablename__ = "draw_off_event"
+    id = Column(Integer, primary_key=True)
+    start = Column(DateTime, nullable=False)
+    end = Column(DateTime, nullable=False)
+    litres = Column(Float, nullable=False)
+    water_temp = Column(Float)
+    device = _device_column()
+
+
+class UsageProfileHour(Base):
+    """
+    Hot water usage of one hour of the week, a cell of the UsageProfile maintained by the manager
+    (see usage_profile.py). The usual litres per hour are litres / observed_hours.
+
+    Attributes:
+        id (int): The unique identifier for the entry.
+        weekday (int): Day of the week, Monday is 0.
+        hour (int): Hour of the day.
+        litres (float): Decayed litres drawn in this hour.
+        draws (float): Decayed number of draw-offs started in this hour.
+        observed_hours (float): Decayed hours this hour was observed.
+        device (str): The tank the entry is for.
+    """
+
+    __tablename__ = "usage_profile_hour"
+    id = Column(Integer, primary_key=True)
+    weekday = Column(Integer, nullable=False)
+    hour = Column(Integer, nullable=False)
+    litres = Column(Float, nullable=False, default=0.0)
+    draws = Column(Float, nullable=False, default=0.0)
+    observed_hours = Column(Float, nullable=False, default=0.0)
+    device = _device_column()
+
+    __table_args__ = (UniqueConstraint("device", "weekday", "hour", name="unique_device_weekday_hour"),)
+
+
+# Kinds of change published when a model is inserted, updated or deleted. For SystemData it depends on the column.
+CHANGE_KINDS = {
+    UserSettings: changes.SETTINGS,
+    TimeInterval: changes.SETTINGS,
+    OverrideSettings: changes.OVERRIDE,
+    ElectricityPrice: changes.PRICES,
+    PriceForecast: changes.FORECASTS,
+    SensorReading: changes.READINGS,
+    EnergyHour: changes.ENERGY,
+    EnergyDay: changes.ENERGY,
+    ThermalCalibration: changes.THERMAL,
+    DrawOffEvent: changes.USAGE,
+    UsageProfileHour: changes.USAGE,
+}
+SYSTEM_DATA_CHANGE_KINDS = {
+    "sys_power": changes.POWER,
+    "setpoint": changes.SETPOINT,
+    "water_temp": changes.READINGS,
+    "water_level": changes.READINGS,
+}
+
+
+def _pending_changes(session):
+    return session.info.setdefault("pending_changes", set())
+
+
+@event.listens_for(OrmSession, "after_flush")
+def _collect_changes(session, flush_context):
+    # Applies to every session, including Flask-SQLAlchemy's. Attribute history is still available here.
+    pending = _pending_changes(session)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, SystemData):
+            state = inspect(obj)
+            for column, kind in SYSTEM_DATA_CHANGE_KINDS.items():
+                if obj in session.new or state.attrs[column].history.has_changes():
+                    pending.add(kind)
+        elif type(obj) in CHANGE_KINDS:
+            pending.add(CHANGE_KINDS[type(obj)])
+
+
+@event.listens_for(OrmSession, "do_orm_execute")
+def _collect_bulk_changes(orm_execute_state):
+    # Bulk statements like query(...).delete() bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        for mapper in orm_execute_state.all_mappers:
+            if mapper.class_ is SystemData:
+                _pending_changes(orm_execute_state.session).update(SYSTEM_DATA_CHANGE_KINDS.values())
+            elif mapper.class_ in CHANGE_KINDS:
+                _pending_changes(orm_execute_state.session).add(CHANGE_KINDS[mapper.class_])
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _publish_changes(session):
+    pending = session.info.pop("pending_changes", None)
+    if pending:
+        change_bus.publish(*sorted(pending))
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("pending_changes", None)
+
+
+def snapshot(obj):
+    """
+    Copies the column values of a model object, for caching beyond the life of its session.
+
+    Parameters:
+        obj (Base): The model object.
+
+    Returns:
+        SimpleNamespace: The column values as attributes.
+    """
+    return SimpleNamespace(**{column.key: getattr(obj, column.key) for column in inspect(obj).mapper.column_attrs})
+
+
 def create_database():
     """
     Creates the database if it doesn't already exist.
 
     This function checks if the database file exists in the 'instance' directory.
     If the file doesn't exist, it creates the database by calling the `create_all` method
-    of the `Base.metadata` object.
+    of the `Base.metadata` object. If it does exist, it is upgraded with `upgrade_database`.
+    Either way, a database in SQLite's default journal mode is switched to WAL, see `enable_wal`.
 
-    Note: The `engine` and `DB_NAME` variables should be defined before calling this function.
+    Note: The `engine` and `db_path` variables should be defined before calling this function.
     """
-    basedir = path.abspath(path.dirname(__file__))
-    if not path.exists(path.join(basedir, "instance", DB_NAME)):
+    if not path.exists(db_path):
         logger.log("Database:", "Creating database..")
         try:
             Base.metadata.create_all(engine)
             logger.log("Database:", "Database created successfully.")
         except Exception as e:
             logger.log("Database:", "Failed to create database.", "ERROR", e)
+    else:
+        upgrade_database()
+    enable_wal()
 
 
-def get_system_data(session):
+def enable_wal():
+    """
+    Switches the database from SQLite's default rollback journal to WAL. The mode is stored in the file, so this
+    only has an effect once. In WAL mode readers (the webserver, exports, backups) and the writer don't block each
+    other, which is what lets db_backup.py copy the database online without holding up commits.
+    A database set to another mode on purpose, like the simulator's, is left alone.
+    """
+    try:
+        with engine.connect() as connection:
+            if connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "delete":
+                mode = connection.exec_driver_sql("PRAGMA journal_mode=WAL").scalar()
+                logger.log("Database:", f"Journal mode set to {mode}")
+    except Exception as e:
+        logger.log("Database:", "Failed to switch to WAL journal mode.", "WARNING", e)
+
+
+# Derived tables that are rebuilt when their unique constraints changed. Before multi-tank support, energy_hour and
+# energy_day were unique on hour_start and day alone, which a second tank's rows violate.
+REBUILT_TABLES = ("energy_hour", "energy_day")
+
+
+def _unique_columns(inspector, table_name):
+    constraints = inspector.get_unique_constraints(table_name)
+    indexes = [index for index in inspector.get_indexes(table_name) if index["unique"]]
+    return {tuple(sorted(item["column_names"])) for item in constraints + indexes}
+
+
+def _rebuild_table(connection, inspector, table):
+    """
+    Recreates a table from its model and copies the rows of the columns both have, since SQLite can't drop a
+    constraint in place. The old constraints were stricter, so the rows fit the new ones.
+    """
+    old_name = f"{table.name}_old"
+    columns = ", ".join(column["name"] for column in inspector.get_columns(table.name) if column["name"] in table.columns)
+    connection.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    for index in inspector.get_indexes(table.name):
+        connection.execute(text(f"DROP INDEX IF EXISTS {index['name']}"))  # The names are reused by the new table
+    table.create(connection)
+    connection.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}"))
+    connection.execute(text(f"DROP TABLE {old_name}"))
+    logger.log("Database:", f"Rebuilt table {table.name} with its current unique constraints")
+
+
+def upgrade_database():
+    """
+    Brings an existing database up to date with the models: creates missing tables and adds missing columns,
+    with their indexes. Added columns must be nullable or have a server_default. Otherwise only the tables in
+    REBUILT_TABLES are changed, when their unique constraints differ from the model.
+    """
+    try:
+        Base.metadata.create_all(engine)  # Only creates tables that don't exist
+        inspector = inspect(engine)
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    if column.server_default is not None:
+                        ddl += f" NOT NULL DEFAULT {column.server_default.arg}"
+                    connection.execute(text(ddl))
+                    for index in table.indexes:
+                        if column.name in index.columns:
+                            index.create(connection)
+                    logger.log("Database:", f"Added column {table.name}.{column.name}")
+        inspector = inspect(engine)  # Sees the added columns
+        with engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                if table.name not in REBUILT_TABLES:
+                    continue
+                unique = [c for c in table.constraints if isinstance(c, UniqueConstraint)]
+                unique += [index for index in table.indexes if index.unique]
+                expected = {tuple(sorted(column.name for column in item.columns)) for item in unique}
+                if _unique_columns(inspector, table.name) != expected:
+                    _rebuild_table(connection, inspector, table)
+    except Exception as e:
+        logger.log("Database:", "Failed to upgrade database.", "ERROR", e)
+
+
+def _get_or_create(session, model, device):
+    try:
+        return session.query(model).filter(model.device == device).one()
+    except NoResultFound:
+        entry = model(device=device)
+        session.add(entry)
+        try:
+            session.commit()
+        except IntegrityError:  # Created by another thread or process meanwhile
+            session.rollback()
+            return session.query(model).filter(model.device == device).one()
+        return entry
+
+
+def get_system_data(session, device=DEFAULT_DEVICE):
     """
     Get the entire system data object. If no system data object exists, a new one is created.
     Use this function for all queries to the system data table, even if only a single attribute is needed or changed.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
         SystemData: The system data object.
     """
-    try:
-        return session.query(SystemData).one()
-    except NoResultFound:
-        new_system_data = SystemData()
-        session.add(new_system_data)
-        session.commit()
-        return new_system_data
+    return _get_or_create(session, SystemData, device)
 
-def get_user_settings(session):
+def get_user_settings(session, device=DEFAULT_DEVICE):
 
     """
     Get the entire user settings object. If no user settings object exists, a new one is created.
@@ -187,40 +669,117 @@ def get_user_settings(session):
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
         UserSettings: The user settings object.
     """
-    try:
-        return session.query(UserSettings).one()
-    except NoResultFound:
-        new_user_settings = UserSettings()
-        session.add(new_user_settings)
-        session.commit()
-        return new_user_settings
+    return _get_or_create(session, UserSettings, device)
 
 
-def get_override_settings(session):
+def get_override_settings(session, device=DEFAULT_DEVICE):
     """
     Retrieves the override settings from the database. If no override settings are found, a new object is created.
     Use this function for all queries to the override settings table, even if only a single attribute is needed or changed.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
         OverrideSettings: The override settings object.
     """
+    return _get_or_create(session, OverrideSettings, device)
+
+
+def get_settings_version(session, device=DEFAULT_DEVICE):
+    """
+    Get the current settings version. A single-column query, cheap enough to call every loop iteration
+    to decide whether cached settings must be reloaded.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        int: The settings version, or 0 if no user settings exist yet.
+    """
+    return session.query(UserSettings.settings_version).filter(UserSettings.device == device).scalar() or 0
+
+
+def get_devices(session):
+    """
+    Names of the tanks that have system data, sorted. Just DEFAULT_DEVICE until the manager has created any.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+
+    Returns:
+        list: Device names.
+    """
+    devices = [row[0] for row in session.query(SystemData.device).distinct().order_by(SystemData.device)]
+    return devices or [DEFAULT_DEVICE]
+
+
+def update_user_settings(session, time_intervals=None, device=DEFAULT_DEVICE, **values):
+    """
+    Atomically updates the user settings and their time intervals in a single transaction.
+    The submitted time intervals are diffed against the stored ones, so only removed intervals are deleted
+    and only new intervals are inserted. The settings version is bumped if anything changed.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        time_intervals (list, optional): List of (start_time, end_time) or (start_time, end_time, weekdays) tuples.
+            None leaves the intervals untouched.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+        **values: UserSettings attributes to set, e.g. min_temp=20.
+
+    Returns:
+        bool: True if anything changed.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
     try:
-        return session.query(OverrideSettings).one()
-    except NoResultFound:
-        new_override_settings = OverrideSettings()
-        session.add(new_override_settings)
+        user_settings = get_user_settings(session, device)
+        changed = False
+
+        for name, value in values.items():
+            if getattr(user_settings, name) != value:
+                setattr(user_settings, name, value)
+                changed = True
+
+        if time_intervals is not None:
+            # Match submitted intervals against stored ones; leftovers on either side are deleted/inserted
+            unmatched = {}
+            for interval in user_settings.time_intervals:
+                unmatched.setdefault((interval.start_time, interval.end_time, interval.weekdays), []).append(interval)
+            to_insert = []
+            for time_interval in time_intervals:
+                start_time, end_time = time_interval[0], time_interval[1]
+                weekdays = time_interval[2] if len(time_interval) > 2 else 127
+                existing = unmatched.get((start_time, end_time, weekdays))
+                if existing:
+                    existing.pop()
+                else:
+                    to_insert.append(TimeInterval(start_time=start_time, end_time=end_time, weekdays=weekdays))
+            to_delete = [interval for intervals in unmatched.values() for interval in intervals]
+
+            for interval in to_delete:
+                user_settings.time_intervals.remove(interval)  # delete-orphan cascade deletes the row
+            user_settings.time_intervals.extend(to_insert)
+            changed = changed or bool(to_delete or to_insert)
+
+        if changed:
+            user_settings.settings_version = (user_settings.settings_version or 0) + 1
         session.commit()
-        return new_override_settings
+        return changed
+    except Exception:
+        session.rollback()
+        raise
 
 
-def add_time_interval(session, start_time, end_time):
+def add_time_interval(session, start_time, end_time, weekdays=127, device=DEFAULT_DEVICE):
     """
     Add a new time interval to the user settings object.
 
@@ -228,60 +787,72 @@ def add_time_interval(session, start_time, end_time):
         session (Session): The SQLAlchemy session to use for the query.
         start_time (time): The start time of the time interval.
         end_time (time): THe end time of the time interval.
+        weekdays (int, optional): Bitmask of the weekdays the interval starts on (bit 0 = Monday).
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
         None
     """
-    user_settings = get_user_settings(session)
-    new_time_interval = TimeInterval(start_time=start_time, end_time=end_time)
+    user_settings = get_user_settings(session, device)
+    new_time_interval = TimeInterval(start_time=start_time, end_time=end_time, weekdays=weekdays)
     user_settings.time_intervals.append(new_time_interval)
+    user_settings.settings_version = (user_settings.settings_version or 0) + 1
     session.commit()
 
 
-def delete_time_interval(session, time_interval_id):
+def delete_time_interval(session, time_interval_id, device=DEFAULT_DEVICE):
     """
     Deletes a time interval from the database.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
         time_interval_id (int): The ID of the time interval to delete.
+        device (str, optional): The tank the interval belongs to, defaults to DEFAULT_DEVICE.
 
     Returns:
         None
+
+    Raises:
+        NoResultFound: If the device has no interval with that ID.
     """
-    time_interval = session.query(TimeInterval).filter_by(id=time_interval_id).one()
+    user_settings = get_user_settings(session, device)
+    time_interval = session.query(TimeInterval).filter_by(id=time_interval_id, user_settings_id=user_settings.id).one()
     session.delete(time_interval)
+    user_settings.settings_version = (user_settings.settings_version or 0) + 1
     session.commit()
 
 
-def clear_all_time_intervals(session):
+def clear_all_time_intervals(session, device=DEFAULT_DEVICE):
     """
-    Deletes all time intervals for the current user.
+    Deletes all time intervals of a tank.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
         None
     """
-    user_settings = get_user_settings(session)
+    user_settings = get_user_settings(session, device)
     for time_interval in user_settings.time_intervals:
         session.delete(time_interval)
     user_settings.time_intervals = []  # Clear the list of time intervals
+    user_settings.settings_version = (user_settings.settings_version or 0) + 1
     session.commit()
 
 
-def get_time_intervals(session):
+def get_time_intervals(session, device=DEFAULT_DEVICE):
     """
-    Retrieve all time intervals from the database.
+    Retrieve the time intervals of a tank.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
 
     Returns:
-        A list of all time intervals in the database.
+        A list of the tank's time intervals.
     """
-    return session.query(TimeInterval).all()
+    return list(get_user_settings(session, device).time_intervals)
 
 
 def get_electricity_price(session, year, month, day, hour, region):
@@ -298,30 +869,40 @@ def get_electricity_price(session, year, month, day, hour, region):
 
     Returns:
         ElectricityPrice or None: The electricity price object for the specified date and time, or None if not found.
+            Archived prices are returned as objects that are not attached to the session.
     """
     date_time = datetime(year, month, day, hour)
 
     try:
-        return (
+        price = (
             session.query(ElectricityPrice)
             .filter(ElectricityPrice.time_start == date_time, ElectricityPrice.region == region)
             .one_or_none()
         )
     except NoResultFound:
-        return None
+        price = None
+    if price is None:
+        for row in price_archive.read_day(region, date_time.date()):
+            if row[0] == date_time:
+                return _archived_price(region, row)
+    return price
 
 
-def get_current_price(session, region):
+def get_current_price(session, region, now=None):
     """
     Retrieves the electricty price object corresponding to the current hour from the database.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region for which to fetch the price.
+        now (datetime, optional): The moment to look up, defaults to datetime.now().
 
     Returns:
         The electricity price object corresponding to the current hour, or None if no object is found.
     """
-    current_hour: datetime = datetime.now().replace(minute=0, second=0, microsecond=0)
+    if now is None:
+        now = datetime.now()
+    current_hour: datetime = now.replace(minute=0, second=0, microsecond=0)
     try:
         return (
             session.query(ElectricityPrice)
@@ -335,12 +916,442 @@ def get_current_price(session, region):
 def get_electricity_prices(session, region):
     """
     Retrieves all electricity price objects for a specified region from the database.
+    Loads every row as an ORM object; read paths that only need the prices should use get_price_history.
 
     Parameters:
         session (Session): The SQLAlchemy session to use for the query.
         region (str): The region for which to retrieve electricity prices.
 
     Returns:
-        A list of all electricity price objects in the database for the specified region.
+        A list of all electricity price objects for the specified region, oldest first.
+        Archived prices are included as objects that are not attached to the session.
+    """
+    archived_days = set(price_archive.days(region))
+    prices = [_archived_price(region, row) for row in price_archive.read_range(region)]
+    live = session.query(ElectricityPrice).filter(ElectricityPrice.region == region).order_by(ElectricityPrice.time_start)
+    prices.extend(price for price in live if price.time_start.date() not in archived_days)
+    return prices
+
+
+
+def get_price_history(session, region, since=None, until=None):
+    """
+    Retrieves (time_start, DKK_per_kWh) tuples for a region, oldest first, without loading full ORM objects.
+    Archived prices are included. Readers of single days or hours should use price_cache instead.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region for which to retrieve prices.
+        since (datetime, optional): Only return prices starting at or after this moment.
+        until (datetime, optional): Only return prices starting before this moment.
+
+    Returns:
+        list: (datetime, float) tuples.
+    """
+    archived_days = set(price_archive.days(region))
+    history = [(row[0], row[2]) for row in price_archive.read_range(region, since, until)]
+    query = session.query(ElectricityPrice.time_start, ElectricityPrice.DKK_per_kWh).filter(
+        ElectricityPrice.region == region
+    )
+    if since is not None:
+        query = query.filter(ElectricityPrice.time_start >= since)
+    if until is not None:
+        query = query.filter(ElectricityPrice.time_start < until)
+    history.extend(tuple(row) for row in query.order_by(ElectricityPrice.time_start) if row[0].date() not in archived_days)
+    return history
+
+
+def get_last_price_time(session, region):
+    """
+    Returns the start time of the latest stored price for a region, or None if there are no prices.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region to look up.
+    """
+    return session.query(func.max(ElectricityPrice.time_start)).filter(ElectricityPrice.region == region).scalar()
+
+
+def get_price_forecast(session, region, now=None):
+    """
+    Retrieves the price forecast for the current hour.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region for which to fetch the forecast.
+        now (datetime, optional): The moment to look up, defaults to datetime.now().
+
+    Returns:
+        PriceForecast or None: The forecast for the hour, or None if there is no forecast.
+    """
+    if now is None:
+        now = datetime.now()
+    current_hour: datetime = now.replace(minute=0, second=0, microsecond=0)
+    return (
+        session.query(PriceForecast)
+        .filter(PriceForecast.time_start == current_hour, PriceForecast.region == region)
+        .one_or_none()
+    )
+
+
+def get_price_forecasts(session, region):
+    """
+    Retrieves all price forecasts for a region, oldest first.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region for which to retrieve forecasts.
+    """
+    return session.query(PriceForecast).filter(PriceForecast.region == region).order_by(PriceForecast.time_start).all()
+
+
+def replace_price_forecasts(session, region, forecasts):
+    """
+    Replaces all forecasts for a region in a single transaction.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region the forecasts are for.
+        forecasts (list): PriceForecast objects to store.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
+    try:
+        session.query(PriceForecast).filter(PriceForecast.region == region).delete(synchronize_session=False)
+        session.add_all(forecasts)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def delete_price_forecasts(session, region, until):
+    """
+    Deletes the forecasts for a region up to and including the hour starting at until, e.g. because real prices
+    for those hours have been stored. Does not commit, so it can share a transaction with the real prices.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        region (str): The region the forecasts are for.
+        until (datetime): The last hour to delete.
+    """
+    session.query(PriceForecast).filter(
+        PriceForecast.region == region, PriceForecast.time_start <= until
+    ).delete(synchronize_session=False)
+
+
+def _archived_price(region, row):
+    time_start, time_end, dkk, eur, exr = row
+    return ElectricityPrice(
+        DKK_per_kWh=dkk, EUR_per_kWh=eur, EXR=exr, region=region, time_start=time_start, time_end=time_end
+    )
+
+
+def archive_prices(session, before):
+    """
+    Moves electricity prices starting before a cutoff from the database to the price archive, one file per region and day.
+    Once a day is archived, the archive is authoritative for it: readers ignore any rows of that day left in the table.
+    Files are written before the rows are deleted, so a failure never loses prices.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        before (datetime): Prices with an earlier time_start are archived.
+
+    Returns:
+        int: The number of rows moved.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
+    query = (
+        session.query(
+            ElectricityPrice.region,
+            ElectricityPrice.time_start,
+            ElectricityPrice.time_end,
+            ElectricityPrice.DKK_per_kWh,
+            ElectricityPrice.EUR_per_kWh,
+            ElectricityPrice.EXR,
+        )
+        .filter(ElectricityPrice.time_start < before)
+        .order_by(ElectricityPrice.region, ElectricityPrice.time_start)
+        .yield_per(1000)
+    )
+    moved = 0
+    current_key = None
+    rows = []
+    try:
+        for region, *row in query:
+            key = (region, row[0].date())
+            if key != current_key:
+                if rows:
+                    price_archive.write_day(current_key[0], current_key[1], rows)
+                current_key, rows = key, []
+            rows.append(tuple(row))
+            moved += 1
+        if rows:
+            price_archive.write_day(current_key[0], current_key[1], rows)
+
+        session.query(ElectricityPrice).filter(ElectricityPrice.time_start < before).delete(synchronize_session=False)
+        session.commit()
+        return moved
+    except Exception:
+        session.rollback()
+        raise
+
+
+def prune_history(session, before, batch_size=10000):
     """
-    return session.query(ElectricityPrice).filter(ElectricityPrice.region == region).all()
+    Deletes the sensor readings and draw-off events of every tank from before a cutoff. Rows are deleted and committed
+    batch_size at a time, so the tank loops appending readings never wait for more than one batch. SQLite reuses the
+    freed pages, so the database file stops growing rather than shrinking.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use.
+        before (datetime): Readings and draw-offs that started earlier are deleted.
+        batch_size (int): Rows per transaction.
+
+    Returns:
+        tuple: The number of (readings, draw-offs) deleted.
+
+    Raises:
+        Exception: If a transaction fails. The session is rolled back before re-raising; batches already
+            committed stay deleted.
+    """
+    counts = []
+    try:
+        for model, time_column in ((SensorReading, SensorReading.time), (DrawOffEvent, DrawOffEvent.start)):
+            deleted = 0
+            while True:
+                batch = session.query(model.id).filter(time_column < before).limit(batch_size).scalar_subquery()
+                count = session.query(model).filter(model.id.in_(batch)).delete(synchronize_session=False)
+                session.commit()
+                deleted += count
+                if count < batch_size:
+                    break
+            counts.append(deleted)
+        return tuple(counts)
+    except Exception:
+        session.rollback()
+        raise
+
+
+def get_energy_hour(session, hour_start, device=DEFAULT_DEVICE):
+    """
+    Retrieves the energy entry for an hour.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        hour_start (datetime): Start of the hour.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        EnergyHour or None: The entry, or None if nothing was recorded for the hour.
+    """
+    return session.query(EnergyHour).filter(EnergyHour.device == device, EnergyHour.hour_start == hour_start).one_or_none()
+
+
+def get_energy_day(session, day, device=DEFAULT_DEVICE):
+    """
+    Retrieves the energy entry for a day.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        day (date): The day.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        EnergyDay or None: The entry, or None if nothing was recorded for the day.
+    """
+    return session.query(EnergyDay).filter(EnergyDay.device == device, EnergyDay.day == day).one_or_none()
+
+
+def get_energy_days(session, since=None, device=DEFAULT_DEVICE):
+    """
+    Retrieves the daily energy entries of a tank, oldest first.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        since (date, optional): Only return days from this day on.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        list: EnergyDay objects.
+    """
+    query = session.query(EnergyDay).filter(EnergyDay.device == device)
+    if since is not None:
+        query = query.filter(EnergyDay.day >= since)
+    return query.order_by(EnergyDay.day).all()
+
+
+def save_energy(session, hour_values, day_values):
+    """
+    Stores the running totals of an hour and its day in a single transaction, creating the entries if needed.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        hour_values (dict): EnergyHour attributes, including hour_start and device.
+        day_values (dict): EnergyDay attributes, including day and device.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
+    try:
+        for model, key, values in ((EnergyHour, "hour_start", hour_values), (EnergyDay, "day", day_values)):
+            entry = (
+                session.query(model)
+                .filter(model.device == values["device"], getattr(model, key) == values[key])
+                .one_or_none()
+            )
+            if entry is None:
+                entry = model()
+                session.add(entry)
+            for name, value in values.items():
+                setattr(entry, name, value)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def get_sensor_history(session, since, until=None, device=DEFAULT_DEVICE):
+    """
+    Retrieves (time, water_temp, water_level, setpoint, sys_power) tuples of the recorded readings, oldest first,
+    without loading full ORM objects.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        since (datetime): Only return readings after this moment.
+        until (datetime, optional): Only return readings up to and including this moment.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        list: (datetime, float, int, int, bool) tuples.
+    """
+    query = session.query(
+        SensorReading.time,
+        SensorReading.water_temp,
+        SensorReading.water_level,
+        SensorReading.setpoint,
+        SensorReading.sys_power,
+    ).filter(SensorReading.device == device, SensorReading.time > since)
+    if until is not None:
+        query = query.filter(SensorReading.time <= until)
+    return [tuple(row) for row in query.order_by(SensorReading.time)]
+
+
+def get_thermal_calibration(session, device=DEFAULT_DEVICE):
+    """
+    Retrieves the last thermal model fit of a tank.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        ThermalCalibration or None: The fit, or None if the tank hasn't been calibrated yet.
+    """
+    return session.query(ThermalCalibration).filter(ThermalCalibration.device == device).one_or_none()
+
+
+def save_thermal_calibration(session, device=DEFAULT_DEVICE, **values):
+    """
+    Replaces the stored thermal model fit of a tank, see ThermalCalibration for the values.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
+    try:
+        calibration = get_thermal_calibration(session, device)
+        if calibration is None:
+            calibration = ThermalCalibration(device=device)
+            session.add(calibration)
+        for name, value in values.items():
+            setattr(calibration, name, value)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def get_draw_offs(session, since=None, device=DEFAULT_DEVICE):
+    """
+    Retrieves the draw-offs of a tank, oldest first.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        since (datetime, optional): Only return draw-offs that started from this moment on.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        list: DrawOffEvent objects.
+    """
+    query = session.query(DrawOffEvent).filter(DrawOffEvent.device == device)
+    if since is not None:
+        query = query.filter(DrawOffEvent.start >= since)
+    return query.order_by(DrawOffEvent.start).all()
+
+
+def get_usage_profile(session, device=DEFAULT_DEVICE):
+    """
+    Retrieves the stored hot water usage profile of a tank, without loading full ORM objects.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Returns:
+        list: (weekday, hour, litres, draws, observed_hours) tuples of the hours observed so far.
+    """
+    query = session.query(
+        UsageProfileHour.weekday,
+        UsageProfileHour.hour,
+        UsageProfileHour.litres,
+        UsageProfileHour.draws,
+        UsageProfileHour.observed_hours,
+    ).filter(UsageProfileHour.device == device)
+    return [tuple(row) for row in query]
+
+
+def save_usage(session, rows, draw_offs=(), device=DEFAULT_DEVICE):
+    """
+    Stores changed hours of a usage profile and new draw-offs in a single transaction.
+
+    Parameters:
+        session (Session): The SQLAlchemy session to use for the query.
+        rows (list): (weekday, hour, litres, draws, observed_hours) tuples, see get_usage_profile.
+        draw_offs (iterable, optional): DrawOff tuples to add, see draw_off_detector.py.
+        device (str, optional): The tank, defaults to DEFAULT_DEVICE.
+
+    Raises:
+        Exception: If the transaction fails. The session is rolled back before re-raising.
+    """
+    try:
+        stored = {
+            (entry.weekday, entry.hour): entry
+            for entry in session.query(UsageProfileHour).filter(UsageProfileHour.device == device)
+        }
+        for weekday, hour, litres, draws, observed_hours in rows:
+            entry = stored.get((weekday, hour))
+            if entry is None:
+                entry = UsageProfileHour(device=device, weekday=weekday, hour=hour)
+                session.add(entry)
+            entry.litres, entry.draws, entry.observed_hours = litres, draws, observed_hours
+        for draw_off in draw_offs:
+            session.add(
+                DrawOffEvent(
+                    device=device,
+                    start=draw_off.start,
+                    end=draw_off.end,
+                    litres=draw_off.litres,
+                    water_temp=draw_off.water_temp,
+                )
+            )
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
@@ -0,0 +1,278 @@
+"""
+Accelerated-time replay of the EcoTank control stack against the tank simulator.
+
+Runs the real SystemManager (ElprisDataManager, SetpointManager, ArduinoIF) on a SimulatedClock,
+with a TankSimulator behind a SimulatedTransport and historical prices served by ReplayElprisAPI.
+Every run uses its own throw-away database, so the live database is only ever read.
+
+Example:
+    python rpi_zero/ecotank_app/simulate.py --start 2024-03-01 --days 14 --threshold 0.5 --threshold 1.0
+"""
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, date, time as dtime, timedelta
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import shared_db as db
+from manager.boundary.logger import logger
+from manager.boundary.clock import SimulatedClock
+from manager.boundary.transport import SimulatedTransport
+from manager.boundary.tank_simulator import TankSimulator, random_draw_events
+from manager.boundary.elpris_api import ReplayElprisAPI
+from manager.boundary.arduino_interface import ArduinoIF
+from system_manager import SystemManager
+
+
+def load_price_history(db_file, region):
+    """
+    Loads all stored prices for a region from a database file (normally the live database).
+
+    Returns:
+        dict: Maps (region, date) to a list of price dicts in the API's JSON format.
+    """
+    engine = create_engine("sqlite:///" + db_file)
+    session = sessionmaker(bind=engine)()
+    history = {}
+    try:
+        rows = session.query(db.ElectricityPrice).filter(db.ElectricityPrice.region == region).all()
+        for row in rows:
+            history.setdefault((region, row.time_start.date()), []).append(
+                {
+                    "DKK_per_kWh": row.DKK_per_kWh,
+                    "EUR_per_kWh": row.EUR_per_kWh,
+                    "EXR": row.EXR,
+                    "time_start": row.time_start.isoformat(),
+                    "time_end": row.time_end.isoformat(),
+                }
+            )
+    finally:
+        session.close()
+        engine.dispose()
+    return history
+
+
+def synthetic_price_history(region, start, days, seed=None):
+    """
+    Generates a price series with a morning and evening peak, a cheap night and day-to-day variation.
+    Useful on development machines that don't have any recorded prices.
+    """
+    rng = random.Random(seed)
+    exr = 7.46
+    history = {}
+    for day in range(days):
+        current = start + timedelta(days=day)
+        level = rng.uniform(0.6, 1.8)
+        entries = []
+        for hour in range(24):
+            shape = 0.5 * math.exp(-((hour - 8) ** 2) / 4.0) + 0.7 * math.exp(-((hour - 18) ** 2) / 5.0)
+            price = max(-0.2, level * (0.6 + shape) + rng.gauss(0.0, 0.08))
+            time_start = datetime.combine(current, dtime(hour))
+            entries.append(
+                {
+                    "DKK_per_kWh": round(price, 5),
+                    "EUR_per_kWh": round(price / exr, 5),
+                    "EXR": exr,
+                    "time_start": time_start.isoformat(),
+                    "time_end": (time_start + timedelta(hours=1)).isoformat(),
+                }
+            )
+        history[(region, current)] = entries
+    return history
+
+
+def hourly_prices(history):
+    """
+    Flattens a price history to a dict mapping (region, hour start) to DKK per kWh.
+    """
+    prices = {}
+    for (region, _), entries in history.items():
+        for entry in entries:
+            prices[(region, datetime.fromisoformat(entry["time_start"]))] = entry["DKK_per_kWh"]
+    return prices
+
+
+def run_strategy(name, args, history, prices, workdir):
+    """
+    Runs one simulation with the given price threshold (None disables the price rule).
+
+    Returns:
+        dict: Energy, cost and comfort figures for the run.
+    """
+    db.use_database(os.path.join(workdir, name.replace(" ", "_") + ".db"))
+
+    @event.listens_for(db.engine, "connect")
+    def _fast_pragmas(dbapi_connection, connection_record):
+        # The simulation database is disposable, so durability is traded for speed.
+        dbapi_connection.execute("PRAGMA synchronous=OFF")
+        dbapi_connection.execute("PRAGMA journal_mode=MEMORY")
+
+    db.create_database()
+
+    start = datetime.combine(args.start, dtime(0))
+    end = start + timedelta(days=args.days)
+
+    with db.Session() as session:
+        user_settings = db.get_user_settings(session)
+        user_settings.min_temp = args.min_temp
+        user_settings.std_temp = args.std_temp
+        user_settings.high_temp = args.high_temp
+        user_settings.price_region = args.region
+        # A threshold below any real price disables the price rule
+        user_settings.price_threshold = args.thresholds[name] if args.thresholds[name] is not None else -1000.0
+        for interval in args.interval:
+            start_str, end_str = interval.split("-")
+            user_settings.time_intervals.append(
+                db.TimeInterval(
+                    start_time=datetime.strptime(start_str.strip(), "%H:%M").time(),
+                    end_time=datetime.strptime(end_str.strip(), "%H:%M").time(),
+                )
+            )
+        db.get_system_data(session).sys_power = True
+        session.commit()
+
+    clock = SimulatedClock(start)
+    tank = TankSimulator(
+        clock,
+        capacity_l=args.capacity,
+        heater_power_w=args.heater_power,
+        start_temp=args.std_temp,
+        draw_events=random_draw_events(start, args.days, seed=args.seed),
+        seed=args.seed,
+    )
+    manager = SystemManager(
+        arduino_interface=ArduinoIF(SimulatedTransport(tank), clock=clock),
+        elpris_api=ReplayElprisAPI(history, clock=clock),
+        clock=clock,
+    )
+    manager.controllers[0].energy_accountant.heater_power_w = args.heater_power
+    manager.database_backup.interval = timedelta(0)  # The simulation database is disposable
+
+    cost = 0.0
+    flat_energy_wh = 0.0
+    below_min_seconds = 0.0
+    temp_sum = 0.0
+    ticks = 0
+    last_energy_wh = 0.0
+    wall_start = time.perf_counter()
+
+    while clock.now() < end:
+        manager.run_once()
+        clock.sleep(args.tick)
+
+        hour = clock.now().replace(minute=0, second=0, microsecond=0)
+        energy_wh = tank.heater_energy_wh - last_energy_wh
+        last_energy_wh = tank.heater_energy_wh
+        price = prices.get((args.region, hour))
+        if price is not None:
+            cost += energy_wh / 1000.0 * price
+        else:
+            flat_energy_wh += energy_wh
+        if tank.water_temp < args.min_temp:
+            below_min_seconds += args.tick
+        temp_sum += tank.water_temp
+        ticks += 1
+
+    wall_time = time.perf_counter() - wall_start
+
+    # What the accountant inferred from the readings alone, to compare with the simulated heater
+    manager.controllers[0].energy_accountant.flush()
+    with db.Session() as session:
+        energy_days = db.get_energy_days(session)
+        estimated_kwh = sum(energy_day.energy_wh for energy_day in energy_days) / 1000.0
+        estimated_cost = sum(energy_day.cost_dkk for energy_day in energy_days)
+        # What the draw-off detector found in the level readings, to compare with the simulated draw-offs
+        draw_offs = db.get_draw_offs(session)
+        detected_l = sum(draw_off.litres for draw_off in draw_offs)
+    db.Session.remove()
+
+    return {
+        "name": name,
+        "kwh": tank.heater_energy_wh / 1000.0,
+        "cost": cost,
+        "estimated_kwh": estimated_kwh,
+        "estimated_cost": estimated_cost,
+        "unpriced_kwh": flat_energy_wh / 1000.0,
+        "mean_temp": temp_sum / ticks if ticks else float("nan"),
+        "minutes_below_min": below_min_seconds / 60.0,
+        "drawn_l": tank.drawn_l,
+        "draws": len(tank.draw_events),
+        "detected_l": detected_l,
+        "detected_draws": len(draw_offs),
+        "ticks": ticks,
+        "wall_time": wall_time,
+        "speedup": args.days * 86400 / wall_time if wall_time else float("inf"),
+    }
+
+
+def print_report(results):
+    header = (
+        f"{'strategy':<16}{'kWh':>9}{'DKK':>10}{'DKK/kWh':>9}{'est kWh':>9}{'est DKK':>9}"
+        f"{'mean °C':>9}{'min<min':>9}{'ticks':>9}{'wall s':>8}{'speedup':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        per_kwh = r["cost"] / r["kwh"] if r["kwh"] else float("nan")
+        print(
+            f"{r['name']:<16}{r['kwh']:>9.1f}{r['cost']:>10.2f}{per_kwh:>9.3f}"
+            f"{r['estimated_kwh']:>9.1f}{r['estimated_cost']:>9.2f}{r['mean_temp']:>9.1f}"
+            f"{r['minutes_below_min']:>9.0f}{r['ticks']:>9}{r['wall_time']:>8.1f}{r['speedup']:>8.0f}x"
+        )
+        print(
+            f"  draw-offs: {r['draws']} simulated, {r['drawn_l']:.0f} l; "
+            f"{r['detected_draws']} detected, {r['detected_l']:.0f} l"
+        )
+        if r["unpriced_kwh"]:
+            print(f"  note: {r['unpriced_kwh']:.1f} kWh used in hours without a price, not included in DKK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay historical prices against the simulated tank.")
+    parser.add_argument("--start", type=date.fromisoformat, default=date.today() - timedelta(days=14))
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--tick", type=float, default=10.0, help="Simulated seconds per control loop iteration")
+    parser.add_argument("--region", default="DK1")
+    parser.add_argument("--prices-db", default=db.db_path, help="Database to read recorded prices from")
+    parser.add_argument("--synthetic-prices", action="store_true", help="Generate prices instead of reading them")
+    parser.add_argument("--threshold", type=float, action="append", default=[], help="Price threshold to compare")
+    parser.add_argument("--interval", action="append", default=[], help="Standard temperature interval, e.g. 06:00-08:00")
+    parser.add_argument("--min-temp", type=int, default=20)
+    parser.add_argument("--std-temp", type=int, default=45)
+    parser.add_argument("--high-temp", type=int, default=60)
+    parser.add_argument("--capacity", type=float, default=200.0, help="Tank volume in litres")
+    parser.add_argument("--heater-power", type=float, default=3000.0, help="Heater power in watts")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    # Start a few days early, since the managers look back days_to_fetch days
+    history_start = args.start - timedelta(days=3)
+    if args.synthetic_prices:
+        history = synthetic_price_history(args.region, history_start, args.days + 4, seed=args.seed)
+    else:
+        history = load_price_history(args.prices_db, args.region)
+        if not history:
+            parser.error(f"No prices for {args.region} in {args.prices_db}, use --synthetic-prices")
+    prices = hourly_prices(history)
+
+    # The baseline never uses the price rule; every --threshold adds a strategy that does
+    args.thresholds = {"baseline": None}
+    for threshold in args.threshold:
+        args.thresholds[f"threshold {threshold:g}"] = threshold
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="ecotank-sim-") as workdir:
+        for name in args.thresholds:
+            results.append(run_strategy(name, args, history, prices, workdir))
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
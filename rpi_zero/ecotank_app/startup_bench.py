@@ -0,0 +1,168 @@
+"""
+Measure webserver startup: an import-time profile (python -X importtime) of the modules imported before the
+server can bind, and the wall time until a real webserver.py process answers its first request.
+
+The result is compared with the startup target for this machine type in startup_targets.json, and with
+--release it is recorded there, so startup time can be tracked from release to release. Exits with status 1
+if the target is missed.
+
+Examples:
+    python rpi_zero/ecotank_app/startup_bench.py
+    python rpi_zero/ecotank_app/startup_bench.py --top 30
+    python rpi_zero/ecotank_app/startup_bench.py --release 2024.05 --runs 5
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from datetime import date
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGETS_FILE = os.path.join(APP_DIR, "startup_targets.json")
+
+# Imported by create_app before the server binds, and the imports deferred to the warm-up thread
+STARTUP_IMPORTS = "import webserver, webserver.views, webserver.auth"
+DEFERRED_IMPORTS = "import bokeh.plotting, bokeh.embed, bokeh.models"
+
+
+def import_profile(statement):
+    """
+    Runs statement in a fresh interpreter with -X importtime.
+
+    Returns:
+        list: (cumulative µs, self µs, depth, module) tuples in import order.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=APP_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((int(cumulative_us), int(self_us), depth, name.strip()))
+    return entries
+
+
+def print_profile(title, entries, top):
+    total = sum(entry[0] for entry in entries if entry[2] == 0)
+    print(f"{title}: {total / 1e6:.3f} s")
+    for cumulative_us, self_us, depth, name in sorted(entries, reverse=True)[:top]:
+        print(f"  {cumulative_us / 1e3:9.1f} ms  {self_us / 1e3:8.1f} ms self  {'  ' * depth}{name}")
+    return total / 1e6
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_response_time(timeout):
+    """
+    Starts webserver.py and polls / until it answers.
+
+    Returns:
+        tuple: (seconds until the first response, seconds for the first /dashboard request)
+    """
+    port = free_port()
+    env = dict(os.environ, SERVER_HOST="127.0.0.1", SERVER_PORT=str(port))
+    with tempfile.TemporaryDirectory() as workdir:  # log.txt is written to the working directory
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(APP_DIR, "webserver.py")],
+            cwd=workdir,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            first = None
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"webserver.py exited with status {process.returncode}")
+                if _get(f"http://127.0.0.1:{port}/"):
+                    first = time.perf_counter() - start
+                    break
+                time.sleep(0.01)
+            if first is None:
+                raise RuntimeError(f"webserver.py did not answer within {timeout} s")
+            dashboard_start = time.perf_counter()
+            _get(f"http://127.0.0.1:{port}/dashboard")
+            return first, time.perf_counter() - dashboard_start
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+    except urllib.error.HTTPError:
+        pass  # Any response counts, an empty database makes some pages fail
+    except (urllib.error.URLError, ConnectionError):
+        return False
+    return True
+
+
+def load_targets():
+    with open(TARGETS_FILE) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile webserver startup against the per-release target.")
+    parser.add_argument("--top", type=int, default=15, help="Number of modules to list per profile")
+    parser.add_argument("--runs", type=int, default=3, help="Startups to measure; the median is reported")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--release", help="Record the result under this release name in startup_targets.json")
+    args = parser.parse_args()
+
+    startup_imports = print_profile("Imports before binding", import_profile(STARTUP_IMPORTS), args.top)
+    print()
+    deferred_imports = print_profile("Imports deferred to warm-up", import_profile(DEFERRED_IMPORTS), args.top)
+    print()
+
+    measurements = sorted(first_response_time(args.timeout) for _ in range(args.runs))
+    first_response, dashboard = measurements[len(measurements) // 2]
+
+    targets = load_targets()
+    machine = platform.machine()
+    target = targets["targets"].get(machine, targets["targets"]["default"])
+    print(f"first response:   {first_response:.3f} s (target {target:.1f} s on {machine})")
+    print(f"first /dashboard: {dashboard:.3f} s")
+
+    if args.release:
+        targets["releases"].setdefault(args.release, {})[machine] = {
+            "date": date.today().isoformat(),
+            "python": platform.python_version(),
+            "startup_imports_s": round(startup_imports, 3),
+            "deferred_imports_s": round(deferred_imports, 3),
+            "first_response_s": round(first_response, 3),
+            "first_dashboard_s": round(dashboard, 3),
+        }
+        with open(TARGETS_FILE, "w") as f:
+            json.dump(targets, f, indent=2)
+            f.write("\n")
+        print(f"Recorded under release {args.release} in {TARGETS_FILE}")
+
+    if first_response > target:
+        print("Startup target missed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
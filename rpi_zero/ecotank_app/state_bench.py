@@ -0,0 +1,113 @@
+"""
+Measure /api/state (see webserver/api.py): the size of the state in JSON and CBOR, the time to encode it, and
+request latencies next to what the home page used before.
+
+A database is seeded with --days of hourly prices up to tomorrow, some time intervals and a powered tank. Reported:
+    - Size and encoding time of the whole state and of the selection the home page asks for, in JSON and CBOR.
+    - Latency of /api/state when the state has to be read again (a reading was published), when it is cached, and
+      when the client's ETag is current (304), next to /get_system_data and rendering the home page.
+
+Examples:
+    python rpi_zero/ecotank_app/state_bench.py
+    python rpi_zero/ecotank_app/state_bench.py --requests 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, time as day_time, timedelta
+from manager.boundary.logger import logger
+from memory_check import seed_prices
+import shared_db as db
+
+HOME_FIELDS = "system,price,next_setpoint"
+
+
+def seed(days):
+    """
+    Hourly DK1 prices from days ago until the end of tomorrow, two time intervals, and a powered tank.
+    """
+    first_hour = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=days)
+    with db.Session() as session:
+        seed_prices(db, session, first_hour, (days + 2) * 24)
+        db.update_user_settings(
+            session,
+            time_intervals=[(day_time(6), day_time(8)), (day_time(17), day_time(21))],
+            price_threshold=1.0,
+        )
+        system_data = db.get_system_data(session)
+        system_data.sys_power = True
+        system_data.water_temp = 41.5
+        system_data.water_level = 87
+        session.commit()
+
+
+def timed(function, count):
+    """
+    Seconds per call of function, the median of count calls.
+    """
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def run(args):
+    from webserver import create_app
+    from webserver.api import FORMATS, current_state, parse_fields, select
+
+    app = create_app(background_warm_up=False)
+    client = app.test_client()
+    client.get("/api/state")  # Loads the prices into the cache
+
+    with app.test_request_context():
+        state = current_state(db.DEFAULT_DEVICE)
+    print("Size and encoding time of the state:")
+    for label, fields in (("whole state", None), (HOME_FIELDS, parse_fields(HOME_FIELDS))):
+        for fmt, (_, encode) in FORMATS.items():
+            selected = select(state.state, fields)
+            body = encode(selected)
+            seconds = timed(lambda: encode(selected), args.requests)
+            print(f"  {label:<28} {fmt:<4} {len(body):>5} bytes {seconds * 1e6:>8.1f} us")
+
+    def cold():
+        db.change_bus.publish("readings")
+        assert client.get("/api/state").status_code == 200
+
+    etag = client.get(f"/api/state?fields={HOME_FIELDS}").headers["ETag"]
+    requests = (
+        ("/api/state, read again", cold),
+        ("/api/state, cached", lambda: client.get("/api/state")),
+        ("/api/state CBOR, cached", lambda: client.get("/api/state?format=cbor")),
+        ("/api/state home fields, 304", lambda: client.get(f"/api/state?fields={HOME_FIELDS}", headers={"If-None-Match": etag})),
+        ("/get_system_data", lambda: client.get("/get_system_data")),
+        ("home page, rendered", lambda: (db.change_bus.publish("readings"), client.get("/"))),
+    )
+    print("Request latency, median:")
+    for label, request in requests:
+        print(f"  {label:<34} {timed(request, args.requests) * 1000:>7.2f} ms")
+    app.extensions["jobs"].shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the size and latency of /api/state.")
+    parser.add_argument("--days", type=int, default=30, help="Days of hourly prices")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per measurement")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db.use_database(os.path.join(workdir, "state_bench.db"))
+        db.create_database()
+        seed(args.days)
+        run(args)
+        db.Session.remove()
+
+
+if __name__ == "__main__":
+    main()
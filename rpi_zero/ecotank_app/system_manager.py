@@ -1,106 +1,143 @@
 import shared_db as db
-import time
+import threading
+from os import environ
 from manager.control.elpris_data_manager import ElprisDataManager
+from manager.control.history_pruner import HistoryPruner
 from manager.boundary.logger import logger
-from manager.control.setpoint_manager import SetpointManager
+from manager.control.tank_controller import TankController
+from manager.control.telemetry_publisher import telemetry_publisher
 from manager.boundary.arduino_interface import ArduinoIF
+from manager.boundary.transport import configured_devices, create_transport
+from manager.boundary.clock import system_clock
+from manager.boundary.memory_report import start_memory_reporter
+from manager.boundary.sampling_profiler import ProfileController
 
 
 class SystemManager:
     """
     SystemManager is responsible for managing the higher-level system and rules logic.
-    The run method contains the main loop.
+    Each tank has a TankController (see tank_controller.py) with its own Arduino link, setpoint, readings and
+    safety cutoff; electricity prices and profiling are shared. run_once is a single iteration over everything;
+    run gives every tank its own loop thread, so a slow or unplugged link only delays its own tank. With
+    ECOTANK_MQTT_HOST set, run also publishes the tanks' state over MQTT from a thread of its own, see
+    telemetry_publisher.py.
+
+    The tanks are configured with ECOTANK_DEVICES, see transport.configured_devices. A single tank is called
+    shared_db.DEFAULT_DEVICE, so keep that name for the tank that existed before to keep its settings and history.
+
+    Args:
+        arduino_interface (ArduinoIF, optional): Link of a single tank named shared_db.DEFAULT_DEVICE.
+        elpris_api (optional): Price source handed to ElprisDataManager, defaults to the live API.
+        clock (SystemClock, optional): Time source shared by all managers, defaults to the wall clock.
+        devices (list, optional): (name, ArduinoIF) tuples, instead of arduino_interface. Defaults to the
+            configured devices.
     """
 
-    def __init__(self):
-        self.arduino_interface = ArduinoIF()
-        self.elpris_manager = ElprisDataManager()
-        self.setpoint_manager = SetpointManager()
-        db.create_database()
+    def __init__(self, arduino_interface=None, elpris_api=None, clock=None, devices=None):
+        self.clock = clock if clock is not None else system_clock
         self.log_ctx = "SystemManager Process:"
-        logger.log(self.log_ctx, "Initialization complete.")
+        if devices is None:
+            if arduino_interface is not None:
+                devices = [(db.DEFAULT_DEVICE, arduino_interface)]
+            else:
+                devices = [
+                    (name, ArduinoIF(create_transport(spec, name), clock=self.clock))
+                    for name, spec in configured_devices(db.DEFAULT_DEVICE)
+                ]
+        self.elpris_manager = ElprisDataManager(api=elpris_api, clock=self.clock)
+        self.history_pruner = HistoryPruner(clock=self.clock)
+        db.create_database()
+        # The system data rows are the list of tanks the webserver shows, so the rows of every tank are created
+        # up front, and not by several loop threads at once
+        with db.Session() as session:
+            for name, _ in devices:
+                db.get_system_data(session, name)
+                db.get_user_settings(session, name)
+                db.get_override_settings(session, name)
+        # MQTT telemetry and commands, if ECOTANK_MQTT_HOST is set. See telemetry_publisher.py under "control"
+        self.telemetry = telemetry_publisher([name for name, _ in devices], clock=self.clock)
+        # The controllers load their stored calibration, so after create_database
+        self.controllers = [
+            TankController(name, interface, clock=self.clock, publisher=self.telemetry) for name, interface in devices
+        ]
+        # Profiling is only started on request, from the debug page or SIGUSR1. See sampling_profiler.py
+        self.profile_controller = ProfileController("manager", db.profile_directory())
+        # Compressed snapshots of the database, taken online. See db_backup.py under "boundary"
+        self.database_backup = db.database_backup(clock=self.clock)
+        self.stopping = threading.Event()
+
+        # Seconds between loop iterations. Can be set to 0 together with ECOTANK_TRANSPORT=sim to run at full speed.
+        try:
+            self.loop_interval = float(environ.get("ECOTANK_LOOP_INTERVAL", "0.2"))
+        except ValueError:
+            self.loop_interval = 0.2
+        logger.log(self.log_ctx, f"Initialization complete, controlling {', '.join(name for name, _ in devices)}.")
 
-    def _get_pwr_and_setpoint(self):
+    def run(self):
         """
-        Get the current power status and setpoint from the database.
-        Redundant function, but used to simplify main loop/not add redundant functions to shared_db.
-
+        Starts a loop thread per tank and runs the shared work in the calling thread, until stop is called.
         """
-        log_ctx = "Get Power and Setpoint:"
-
-        with db.Session() as session:
-            try:
-                system_data = db.get_system_data(session)
-            except Exception as e:
-                logger.log(log_ctx, "Error getting system data from database", "ERROR", e)
-            return system_data.sys_power, system_data.setpoint
-
-    def _set_temp_and_lvl(self, temp, lvl):
+        logger.log(self.log_ctx, "Starting main loop..")
+        threads = [
+            threading.Thread(target=self._run_controller, args=(controller,), name=f"tank-{controller.device}", daemon=True)
+            for controller in self.controllers
+        ]
+        if self.telemetry is not None:
+            # Its own thread, so neither a slow broker nor the price download delays the other
+            threads.append(threading.Thread(target=self.telemetry.run, name="telemetry", daemon=True))
+        for thread in threads:
+            thread.start()
+        while not self.stopping.is_set():
+            self._run_shared()
+            self.clock.sleep(self.loop_interval)
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
         """
-        Set the water temperature and level in the database.
-        Redundant function, but used to simplify main loop/not add redundant functions to shared_db.
-
+        Makes run return after the current iterations, e.g. from another thread.
         """
-        log_ctx = "Set Temp and Lvl:"
-
-        with db.Session() as session:
-            try:
-                system_data = db.get_system_data(session)
-            except Exception as e:
-                logger.log(log_ctx, "Error getting system data from database", "ERROR", e)
-                return
+        self.stopping.set()
 
-            try:
-                system_data.water_temp = temp
-                system_data.water_level = lvl
-                session.commit()
-            except Exception as e:
-                logger.log(log_ctx, "Error setting system data in database", "ERROR", e)
-                return
-
-    def _check_temperature_limit(self):
+    def _run_controller(self, controller):
         """
-        Check if the water temperature has reached the limit of 90 °C.
-        If above the limit, flip the system power to 0 and log the event.
-
+        The loop of one tank. Ticks are scheduled every loop_interval, so the exchange time doesn't lower the rate;
+        a tick that overruns is followed by the next one straight away, without catching up on missed ones.
         """
-        log_ctx = "Check Temperature:"
-
-        with db.Session() as session:
+        next_tick = self.clock.monotonic()
+        while not self.stopping.is_set():
             try:
-                system_data = db.get_system_data(session)
+                controller.run_once()
             except Exception as e:
-                logger.log(log_ctx, "Error querying database", "ERROR", e)
-                return
+                # Only this tank misses the tick; its link and state are kept for the next one
+                logger.log(controller.log_ctx, "Error in control loop", "ERROR", e)
+            next_tick = max(next_tick + self.loop_interval, self.clock.monotonic())
+            self.clock.sleep(max(next_tick - self.clock.monotonic(), 0.0))
 
-            if system_data.water_temp > 90 and system_data.sys_power == 1:
-                logger.log(
-                    log_ctx,
-                    f"Temperature limit reached! Current temperature: {system_data.water_temp} °C. Shutting down system..",
-                    "CRITICAL",
-                )
-                system_data.sys_power = 0
-                session.commit()
+    def _run_shared(self):
+        self.profile_controller.poll()
 
-    def run(self):
-        logger.log(self.log_ctx, "Starting main loop..")
-        while True:
-            # Check for missing electricity price data. See elpris_data_manager.py under "control"
-            self.elpris_manager.fetch_missing_data()
+        # Check for missing electricity price data. See elpris_data_manager.py under "control"
+        self.elpris_manager.fetch_missing_data()
 
-            # Evaluate and set the setpoint temperature. See setpoint_manager.py under "control"
-            self.setpoint_manager.update_setpoint()
+        # Deletes readings and draw-offs past their retention once a day. See history_pruner.py under "control"
+        self.history_pruner.update()
 
-            system_power, setpoint = self._get_pwr_and_setpoint()
-            result = self.arduino_interface.exchange_data(system_power, setpoint)
-            if result is None:
-                logger.log(self.log_ctx, "Failed to exchange data with Arduino interface.","ERROR")
-            else:
-                water_temp, water_level = result
-                self._set_temp_and_lvl(water_temp, water_level)
+        # Runs in this thread, so the tank loops keep going while a snapshot is taken
+        self.database_backup.update()
 
-            self._check_temperature_limit()
-            time.sleep(0.2)
+    def run_once(self):
+        """
+        A single iteration of the shared work and every tank, without the sleep. Used by the simulator.
+        """
+        self._run_shared()
+        for controller in self.controllers:
+            controller.run_once()
 
 if __name__ == "__main__":
-    SystemManager().run()
+    start_memory_reporter("manager")
+    system_manager = SystemManager()
+    system_manager.profile_controller.install_signal_handler()
+    system_manager.run()
@@ -0,0 +1,135 @@
+"""
+Benchmark and fuzz the ArduinoIF frame parser against recorded serial traces.
+
+Traces are recorded in the field by starting the manager with ECOTANK_TRACE_FILE set (see serial_trace.py),
+or generated on a development machine from the tank simulator with --generate.
+
+Examples:
+    python rpi_zero/ecotank_app/trace_bench.py --generate /tmp/sim.trace --exchanges 50000
+    python rpi_zero/ecotank_app/trace_bench.py /tmp/sim.trace
+    python rpi_zero/ecotank_app/trace_bench.py /tmp/field.trace --fuzz 3 --fuzz-rate 0.05
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+from manager.boundary.logger import logger
+from manager.boundary.clock import SimulatedClock
+from manager.boundary.transport import SimulatedTransport
+from manager.boundary.tank_simulator import TankSimulator, random_draw_events
+from manager.boundary.serial_trace import TraceRecorder, RecordingTransport, ReplayTransport, trace_files
+from manager.boundary.arduino_interface import ArduinoIF
+
+
+def generate_trace(path, exchanges, interval, max_bytes, seed):
+    """
+    Records a trace of ArduinoIF talking to the tank simulator on a simulated clock.
+    """
+    clock = SimulatedClock(datetime(2024, 1, 1))
+    tank = TankSimulator(clock, draw_events=random_draw_events(clock.now(), 1 + int(exchanges * interval / 86400)), seed=seed)
+    recorder = TraceRecorder(path, max_bytes=max_bytes, clock=clock)
+    arduino = ArduinoIF(RecordingTransport(SimulatedTransport(tank), recorder), clock=clock)
+    for i in range(exchanges):
+        arduino.exchange_data(1, 50.0)
+        clock.sleep(interval)
+    recorder.close()
+
+
+def fuzz(transport, rate, seed):
+    """
+    Mutates the received chunks of a loaded replay in place: splits chunks and delays the tail past the
+    select timeout, drops bytes, flips bits and duplicates chunks. rate is the probability per chunk.
+    """
+    rng = random.Random(seed)
+    mutated = []
+    for t, data in transport.rx_chunks:
+        if data and rng.random() < rate:
+            kind = rng.randrange(4)
+            if kind == 0 and len(data) > 1:
+                cut = rng.randrange(1, len(data))
+                mutated.append((t, data[:cut]))
+                mutated.append((t + rng.uniform(0.05, 0.5), data[cut:]))
+                continue
+            elif kind == 1:
+                i = rng.randrange(len(data))
+                data = data[:i] + data[i + 1:]
+            elif kind == 2:
+                i = rng.randrange(len(data))
+                data = data[:i] + bytes([data[i] ^ (1 << rng.randrange(8))]) + data[i + 1:]
+            else:
+                mutated.append((t, data))
+        mutated.append((t, data))
+    mutated.sort(key=lambda chunk: chunk[0])
+    transport.rx_chunks = mutated
+
+
+def replay(paths, realtime, fuzz_rate, seed):
+    """
+    Runs every recorded exchange through ArduinoIF.exchange_data.
+
+    Returns:
+        dict: Exchange, frame and drop counts and the wall time used.
+    """
+    transport = ReplayTransport(paths, realtime=realtime)
+    if fuzz_rate:
+        fuzz(transport, fuzz_rate, seed)
+    arduino = ArduinoIF(transport)
+
+    frames = 0
+    dropped = 0
+    start = time.perf_counter()
+    while not transport.exhausted:
+        if arduino.exchange_data(1, 50.0) is None:
+            dropped += 1
+        else:
+            frames += 1
+    wall_time = time.perf_counter() - start
+    return {
+        "exchanges": frames + dropped,
+        "frames": frames,
+        "dropped": dropped,
+        "wall_time": wall_time,
+        "duration": transport.now,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay serial traces through the ArduinoIF frame parser.")
+    parser.add_argument("trace", nargs="?", help="Trace file; rotated backups next to it are included")
+    parser.add_argument("--realtime", action="store_true", help="Replay with the recorded timing instead of max speed")
+    parser.add_argument("--fuzz", type=int, metavar="SEED", help="Mutate received chunks with this seed")
+    parser.add_argument("--fuzz-rate", type=float, default=0.02)
+    parser.add_argument("--generate", metavar="PATH", help="Record a trace from the tank simulator instead")
+    parser.add_argument("--exchanges", type=int, default=10000)
+    parser.add_argument("--interval", type=float, default=0.2, help="Simulated seconds between exchanges")
+    parser.add_argument("--max-bytes", type=int, default=1_000_000, help="Rotation size for --generate")
+    parser.add_argument("--verbose", action="store_true", help="Keep the normal log output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.current_level = logger.LOG_LEVELS["CRITICAL"]
+
+    if args.generate:
+        generate_trace(args.generate, args.exchanges, args.interval, args.max_bytes, seed=1)
+        print(f"Generated {args.exchanges} exchanges in {', '.join(trace_files(args.generate))}")
+        return
+
+    if not args.trace:
+        parser.error("a trace file or --generate is required")
+    paths = trace_files(args.trace)
+    if not paths:
+        parser.error(f"{args.trace} does not exist")
+
+    result = replay(paths, args.realtime, args.fuzz_rate if args.fuzz is not None else 0.0, args.fuzz)
+    drop_rate = result["dropped"] / result["exchanges"] if result["exchanges"] else 0.0
+    fps = result["frames"] / result["wall_time"] if result["wall_time"] else float("inf")
+    print(f"files:      {len(paths)}")
+    print(f"exchanges:  {result['exchanges']} ({result['duration']:.1f} s recorded)")
+    print(f"frames:     {result['frames']}")
+    print(f"dropped:    {result['dropped']} ({drop_rate:.2%})")
+    print(f"wall time:  {result['wall_time']:.3f} s")
+    print(f"frames/s:   {fps:.0f}")
+
+
+if __name__ == "__main__":
+    main()
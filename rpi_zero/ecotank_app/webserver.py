@@ -1,16 +1,23 @@
 from os import environ
-from webserver import create_app
 from manager.boundary.logger import logger
 
-log_ctx = "Webserver Process:"
-logger.log(log_ctx, "Webserver process started..")
-logger.log(log_ctx, "Setting HOST address and port..")
+# Only when run as a script: the job workers (see job_queue.py) are spawned processes that import this module again
+if __name__ == "__main__":
+    from webserver import create_app
+    from manager.boundary.memory_report import start_memory_reporter
 
-HOST = environ.get('SERVER_HOST', '0.0.0.0')
-try:
-    PORT = int(environ.get('SERVER_PORT', '5555')) 
-except ValueError:
-    PORT = 5555
+    log_ctx = "Webserver Process:"
+    logger.log(log_ctx, "Webserver process started..")
+    logger.log(log_ctx, "Setting HOST address and port..")
 
-logger.log(log_ctx, "Starting Flask application..")
-create_app().run(HOST, PORT, debug=False)
+    HOST = environ.get('SERVER_HOST', '0.0.0.0')
+    try:
+        PORT = int(environ.get('SERVER_PORT', '5555')) 
+    except ValueError:
+        PORT = 5555
+
+    start_memory_reporter("webserver")
+    logger.log(log_ctx, "Starting Flask application..")
+    app = create_app()
+    app.extensions["profile_controller"].install_signal_handler()
+    app.run(HOST, PORT, debug=False)
@@ -3,31 +3,161 @@ The flask application package.
 """
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from shared_db import DB_NAME, create_database, get_system_data
-import os
+import shared_db
+from shared_db import create_database, get_devices, get_system_data
+from manager.boundary.logger import logger
+from manager.boundary.sampling_profiler import ProfileController
+from manager.boundary import change_bus as changes
+from manager.boundary.change_bus import CachedValue
+from manager.boundary.job_queue import JobQueue
+from manager.control.thermal_model import ThermalModel
+from manager.control.usage_profile import UsageProfile
+from .etags import current_device, temperature_warning
+from os import environ
+import importlib.util
+import threading
+import time
 
 db = SQLAlchemy()
+CACHED_DEVICES = 8  # Tanks whose per-device values are cached at once
+database_ready = threading.Event()
 
-def create_app():
-    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def warm_up():
+    """
+    Startup work that doesn't have to happen before the server binds: creating/upgrading the database. Requests
+    wait for it, see create_app. The job workers aren't started here but by the first chart, so they take no memory
+    until the dashboard is used.
+    """
+    log_ctx = "Webserver Warm-up:"
+    start = time.perf_counter()
+    try:
+        create_database()
+    finally:
+        database_ready.set()
+    if importlib.util.find_spec("bokeh") is None:
+        logger.log(log_ctx, "Bokeh is not installed, the dashboard will have no price chart", "WARNING")
+    logger.log(log_ctx, f"Warm-up finished in {time.perf_counter() - start:.2f} s")
+
+
+def job_queue():
+    """
+    The JobQueue for the expensive parts of pages (see job_queue.py), configured through the environment:
+        ECOTANK_JOB_WORKERS (worker processes, default 1, or 0 with ECOTANK_LOW_MEMORY=1; 0 runs jobs in the
+            request thread, as a worker takes about as much memory as the webserver)
+        ECOTANK_JOB_IDLE_SECONDS (the workers stop after this long without jobs, default 300).
+    The workers open the same database as the webserver.
+    """
+    default_workers = 0 if shared_db.LOW_MEMORY else 1
+    try:
+        workers = int(environ.get("ECOTANK_JOB_WORKERS", str(default_workers)))
+    except ValueError:
+        workers = default_workers
+    try:
+        idle_timeout = float(environ.get("ECOTANK_JOB_IDLE_SECONDS", "300"))
+    except ValueError:
+        idle_timeout = 300.0
+    return JobQueue(
+        shared_db.change_bus,
+        workers=workers,
+        idle_timeout=idle_timeout,
+        initializer=shared_db.use_database,
+        initargs=(shared_db.db_path,),
+    )
+
+
+def create_app(background_warm_up=True):
+    """
+    Creates the Flask application.
+
+    Args:
+        background_warm_up (bool): Run warm_up in a daemon thread so the server can start listening immediately.
+            If False, it runs before returning.
+    """
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'mysecretkey'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'instance', DB_NAME)
+    # Same file as the manager, including after shared_db.use_database
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + shared_db.db_path
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(shared_db.ENGINE_OPTIONS)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
+    # Started on request from the debug page or SIGUSR1, see sampling_profiler.py
+    app.extensions['profile_controller'] = ProfileController('webserver', shared_db.profile_directory())
+    # Worker processes for the Bokeh chart and other slow work, see job_queue.py
+    app.extensions['jobs'] = job_queue()
 
-    create_database()
+    @app.before_request
+    def wait_for_database():
+        database_ready.wait()
 
     from .views import views
     from .auth import auth
+    from .api import STATE_KINDS, api, load_state
+    from . import assets
+    assets.init_app(app)
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
+    app.register_blueprint(api, url_prefix='/')
+
+    def load_devices():
+        return get_devices(db.session)
+
+    def load_temperature_warning():
+        devices = get_devices(db.session)
+        for device in devices:
+            water_temp = get_system_data(db.session, device).water_temp
+            if water_temp and water_temp > 90:
+                if len(devices) > 1:
+                    return f"Warning: Water temperature in {device} is above 90 degrees!"
+                return "Warning: Water temperature is above 90 degrees!"
+        return None
+
+    # The manager creates a system data row per tank at startup, which publishes a POWER change
+    app.extensions['devices'] = CachedValue(shared_db.change_bus, load_devices, changes.POWER)
+    # Shared by every page render and the ETags, see etags.py
+    app.extensions['temperature_warning'] = CachedValue(shared_db.change_bus, load_temperature_warning, changes.READINGS)
+    def load_thermal_model(device):
+        calibration = shared_db.get_thermal_calibration(db.session, device)
+        if calibration is None:
+            return None
+        model = ThermalModel()
+        model.set_coefficients(calibration.heating_rate, calibration.loss_rate, calibration.ambient_temp)
+        return model
+
+    # Fitted by the manager, see thermal_calibrator.py. Loaded per device: get(device)
+    app.extensions['thermal_model'] = CachedValue(
+        shared_db.change_bus, load_thermal_model, changes.THERMAL, max_keys=CACHED_DEVICES
+    )
+    def load_usage_profile(device):
+        profile = UsageProfile()
+        profile.load(shared_db.get_usage_profile(db.session, device))
+        return profile
+
+    # Learned by the manager, see usage_tracker.py. Loaded per device: get(device)
+    app.extensions['usage_profile'] = CachedValue(
+        shared_db.change_bus, load_usage_profile, changes.USAGE, max_keys=CACHED_DEVICES
+    )
+    # The home page and /api/state, read at one bus sequence. Loaded per device and minute, see api.py; the
+    # previous minute's states are the least recently used, so they go first
+    app.extensions['api_state'] = CachedValue(
+        shared_db.change_bus, load_state, *STATE_KINDS, max_keys=CACHED_DEVICES
+    )
+    # Part of every ETag: templates and asset names only change with a restart
+    app.extensions['etag_salt'] = time.time()
 
     @app.context_processor
     def inject_temperature_warning():
-        water_temp = get_system_data(db.session).water_temp
-        if water_temp and water_temp > 90:
-            return {"temp_warning": "Warning: Water temperature is above 90 degrees!"}
-        return {}
+        warning = temperature_warning()
+        return {"temp_warning": warning} if warning else {}
+
+    @app.context_processor
+    def inject_devices():
+        # For the tank selector in the navigation bar, only shown with more than one tank
+        return {"devices": app.extensions['devices'].get(), "current_device": current_device()}
+
+    if background_warm_up:
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        warm_up()
 
     return app
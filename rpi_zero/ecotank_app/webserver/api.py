@@ -0,0 +1,222 @@
+"""
+/api/state: what the home page shows about a tank in one request, for the page itself and for small clients.
+
+The state is read at a single change bus sequence (see change_bus.py): if a change is published while it is being
+read, it is read again, so the parts never mix data from before and after a change. It is cached until one of the
+kinds of change it depends on is published, or the minute turns, since the current price and the next setpoint
+change follow the clock. Encoded bodies are cached with it per field selection and format, so most requests only
+pick a cached body. The ETag is a hash of the body, so polling clients get 304 while nothing they asked for changed.
+"""
+import hashlib
+import json
+from datetime import datetime
+from flask import Blueprint, Response, current_app, request
+import shared_db
+from . import cbor, db
+from .etags import current_device, current_minute
+from .views import expected_litres, minutes_to_setpoint
+from manager.boundary import change_bus as changes
+from manager.control.setpoint_manager import SetpointManager
+
+api = Blueprint('api', __name__)
+
+# Kinds of change the state depends on
+STATE_KINDS = (
+    changes.POWER,
+    changes.READINGS,
+    changes.SETPOINT,
+    changes.OVERRIDE,
+    changes.SETTINGS,
+    changes.PRICES,
+    changes.FORECASTS,
+    changes.THERMAL,
+    changes.USAGE,
+)
+# The groups of the state and their fields, for the field selector. device is always included, version and time
+# only without a selector, so the ETag of a selection only changes with the fields selected
+STATE_FIELDS = {
+    "system": ("water_temp", "water_level", "sys_power", "setpoint", "minutes_to_setpoint", "expected_litres"),
+    "override": ("toggled_on", "start_time", "end_time", "allow_high_temp"),
+    "settings": ("min_temp", "std_temp", "high_temp", "price_threshold", "price_region"),
+    "price": ("region", "dkk_per_kwh", "estimated", "below_threshold"),
+    "next_setpoint": ("time", "setpoint"),
+}
+FORMATS = {
+    "json": ("application/json", lambda state: json.dumps(state, separators=(",", ":")).encode("utf-8")),
+    "cbor": ("application/cbor", cbor.dumps),
+}
+MAX_ENCODED = 16  # Bodies cached per state; field selections beyond that are encoded per request
+READ_ATTEMPTS = 3
+
+
+def _isoformat(moment):
+    return moment.isoformat(timespec="seconds") if moment is not None else None
+
+
+class StateSnapshot(object):
+    """
+    The state of a tank at one change bus sequence, with its encoded bodies.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.encoded = {}  # (fields, format) -> (body, etag)
+
+    def body(self, fields, fmt):
+        """
+        Returns (body, etag) of the fields (see parse_fields) in fmt.
+        """
+        key = (fields, fmt)
+        cached = self.encoded.get(key)
+        if cached is None:
+            body = FORMATS[fmt][1](select(self.state, fields))
+            cached = (body, hashlib.sha1(body).hexdigest()[:20])
+            if len(self.encoded) < MAX_ENCODED:
+                self.encoded[key] = cached
+        return cached
+
+
+def _read_state(device, sequence):
+    now = datetime.now()
+    system_data = shared_db.get_system_data(db.session, device)
+    user_settings = shared_db.get_user_settings(db.session, device)
+    override = shared_db.get_override_settings(db.session, device)
+    region = user_settings.price_region
+
+    price = shared_db.price_cache.price_at(region, now)
+    estimated = False
+    if price is None:
+        forecast = shared_db.get_price_forecast(db.session, region, now)
+        if forecast is not None:
+            price, estimated = forecast.DKK_per_kWh, True
+
+    # The manager's rules, evaluated ahead without changing anything. See setpoint_manager.py
+    usage_profile = current_app.extensions['usage_profile'].get(device)
+    next_change = SetpointManager(device=device, usage_profile=usage_profile).next_change()
+
+    return {
+        "device": device,
+        "version": sequence,
+        "time": _isoformat(now),
+        "system": {
+            "water_temp": system_data.water_temp,
+            "water_level": system_data.water_level,
+            "sys_power": system_data.sys_power,
+            "setpoint": system_data.setpoint,
+            "minutes_to_setpoint": minutes_to_setpoint(system_data),
+            "expected_litres": expected_litres(device),
+        },
+        "override": {
+            "toggled_on": override.toggled_on,
+            "start_time": _isoformat(override.start_time),
+            "end_time": _isoformat(override.end_time),
+            "allow_high_temp": override.allow_high_temp,
+        },
+        "settings": {
+            "min_temp": user_settings.min_temp,
+            "std_temp": user_settings.std_temp,
+            "high_temp": user_settings.high_temp,
+            "price_threshold": user_settings.price_threshold,
+            "price_region": region,
+        },
+        "price": {
+            "region": region,
+            "dkk_per_kwh": round(price, 4) if price is not None else None,
+            "estimated": estimated,
+            "below_threshold": price is not None and price < user_settings.price_threshold,
+        },
+        "next_setpoint": (
+            {"time": _isoformat(next_change[0]), "setpoint": next_change[1]} if next_change is not None else None
+        ),
+    }
+
+
+def load_state(device, minute):
+    """
+    Reads the state of a device, for the CachedValue in app.extensions['api_state'], keyed by the current minute.
+
+    Returns:
+        StateSnapshot: version is the change bus sequence the state was read at, None if the bus is unavailable.
+    """
+    bus = shared_db.change_bus
+    for _ in range(READ_ATTEMPTS):
+        sequence = bus.sequence()
+        db.session.expire_all()  # Read the rows again, not the objects of the previous attempt
+        state = _read_state(device, sequence)
+        if sequence is None or bus.sequence() == sequence:
+            break
+    # Still changing after READ_ATTEMPTS reads means readings every few milliseconds; the last read is used
+    return StateSnapshot(state)
+
+
+def current_state(device):
+    """
+    The cached StateSnapshot of a device, also used to render the home page.
+    """
+    return current_app.extensions['api_state'].get(device, current_minute())
+
+
+def parse_fields(selector):
+    """
+    Parses a field selector like "system,price.dkk_per_kwh": groups, or fields of a group as group.field.
+
+    Returns:
+        tuple or None: Sorted (group, fields or None for all) pairs, usable as a cache key. None selects everything.
+
+    Raises:
+        ValueError: For unknown groups or fields.
+    """
+    if not selector:
+        return None
+    selected = {}
+    for path in selector.split(","):
+        group, _, field = path.strip().partition(".")
+        if group not in STATE_FIELDS or (field and field not in STATE_FIELDS[group]):
+            raise ValueError(f"Unknown field '{path.strip()}'")
+        if not field:
+            selected[group] = None
+        elif group not in selected or selected[group] is not None:
+            selected.setdefault(group, set()).add(field)
+    return tuple(sorted((group, tuple(sorted(fields)) if fields else None) for group, fields in selected.items()))
+
+
+def select(state, fields):
+    """
+    The part of state selected by fields (see parse_fields).
+    """
+    if fields is None:
+        return state
+    result = {"device": state["device"]}
+    for group, names in fields:
+        value = state[group]
+        result[group] = value if names is None or value is None else {name: value[name] for name in names}
+    return result
+
+
+@api.route('/api/state')
+def state():
+    """
+    The state of the selected tank, e.g. /api/state?fields=system,price.dkk_per_kwh&format=cbor.
+
+    fields selects groups or group.field paths (see STATE_FIELDS), default everything. format is json (default) or
+    cbor; without it, an Accept header preferring application/cbor selects CBOR.
+    """
+    try:
+        fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return f"{e}, use the groups {', '.join(STATE_FIELDS)} or their fields as group.field", 400
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'cbor' if request.accept_mimetypes.best_match(['application/json', 'application/cbor']) == 'application/cbor' else 'json'
+    if fmt not in FORMATS:
+        return f"Unknown format '{fmt}', use json or cbor", 400
+
+    body, etag = current_state(current_device()).body(fields, fmt)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=FORMATS[fmt][0])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    return response
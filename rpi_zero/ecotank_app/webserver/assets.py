@@ -0,0 +1,251 @@
+"""
+Static asset pipeline: bundles the stylesheets and scripts the templates use, minifies them, names each file
+after a hash of its content and precompresses it to .gz, and to .br if the brotli package is installed.
+
+build() writes the result to static/dist together with manifest.json, which maps bundle names to the
+fingerprinted files and records the source modification times. create_app rebuilds when a source is newer than
+the manifest, build_assets.py does the same from the command line. Templates link to bundles with
+asset_url("site.css"), and /assets/<file> serves the fingerprinted files with a one-year immutable
+Cache-Control, choosing the precompressed variant from Accept-Encoding. Repeat page loads therefore don't
+request the assets at all, and nothing is loaded from a CDN.
+"""
+import gzip
+import hashlib
+import importlib.util
+import json
+import mimetypes
+import os
+import re
+from flask import Blueprint, abort, current_app, request, send_from_directory
+from manager.boundary.logger import logger
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+# Bundle name -> sources, relative to static/ or "bokeh:" + path in Bokeh's own static directory.
+# The BokehJS version must match the installed Bokeh package, so it is taken from there and not vendored.
+# Without Bokeh these bundles are left out, see available_bundles().
+BUNDLES = {
+    "site.css": ["content/bootstrap.min.css"],
+    "site.js": ["scripts/bootstrap.bundle.min.js"],
+    "home.js": ["scripts/home.js"],
+    "settings.js": ["scripts/settings.js"],
+    "dashboard.js": ["scripts/dashboard.js"],
+    "bokeh.js": ["bokeh:js/bokeh.min.js"],
+    "favicon.png": ["content/favicon.png"],
+    "EcoTank.svg": ["content/EcoTank.svg"],
+    "helpicon.svg": ["content/helpicon.svg"],
+    "logicon.svg": ["content/logicon.svg"],
+}
+
+# Compressed variants are only kept if they save at least this fraction, so PNGs aren't stored twice
+MIN_COMPRESSION_SAVING = 0.1
+
+assets = Blueprint("assets", __name__)
+
+
+def bokeh_dir():
+    """
+    Directory of the installed Bokeh package, or None if Bokeh isn't installed.
+    """
+    # find_spec locates the package without importing it, which takes seconds on a Pi Zero
+    spec = importlib.util.find_spec("bokeh")
+    return spec.submodule_search_locations[0] if spec is not None else None
+
+
+def available_bundles():
+    """
+    BUNDLES without the bundles taken from Bokeh when it isn't installed.
+    """
+    if bokeh_dir() is not None:
+        return BUNDLES
+    return {
+        name: sources for name, sources in BUNDLES.items()
+        if not any(source.startswith("bokeh:") for source in sources)
+    }
+
+
+def source_path(source):
+    if source.startswith("bokeh:"):
+        directory = bokeh_dir()
+        if directory is None:
+            raise FileNotFoundError(f"{source}: Bokeh is not installed")
+        return os.path.join(directory, "server", "static", source[len("bokeh:"):])
+    return os.path.join(STATIC_DIR, source)
+
+
+def minify_css(text):
+    """
+    Removes comments (except /*! license comments) and the whitespace around CSS punctuation.
+    """
+    text = re.sub(r"/\*(?!!).*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    # Not the space before ":", which is a descendant combinator in ".menu :hover"
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text).replace(": ", ":")
+    return text.replace(";}", "}").strip()
+
+
+def minify_js(text):
+    """
+    Conservative JavaScript minification that can't change behaviour: strips indentation, blank lines and
+    whole-line // comments. Multi-line template literals would lose their indentation, so don't use them
+    in the scripts of this app.
+    """
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def minify(source, data):
+    if ".min." in source or not source.endswith((".css", ".js")):
+        return data
+    text = data.decode("utf-8")
+    text = minify_css(text) if source.endswith(".css") else minify_js(text)
+    return text.encode("utf-8")
+
+
+def fingerprinted_name(name, data):
+    stem, extension = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha1(data).hexdigest()[:12]}{extension}"
+
+
+def compressed_variants(data, brotli_quality):
+    """
+    Returns {encoding: (file extension, bytes)} for the encodings that make data noticeably smaller.
+    """
+    variants = {"gzip": (".gz", gzip.compress(data, compresslevel=9, mtime=0))}
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+    if brotli is not None:
+        variants["br"] = (".br", brotli.compress(data, quality=brotli_quality))
+    return {
+        encoding: (extension, compressed)
+        for encoding, (extension, compressed) in variants.items()
+        if len(compressed) <= len(data) * (1 - MIN_COMPRESSION_SAVING)
+    }
+
+
+def _write(path, data):
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def build(dist_dir=DIST_DIR, brotli_quality=11):
+    """
+    Builds all bundles into dist_dir and writes the manifest. Files of earlier builds are removed. Without Bokeh,
+    bokeh.js is left out of the manifest.
+
+    Args:
+        dist_dir (str): Output directory.
+        brotli_quality (int): 0-11. 11 compresses BokehJS about 10% better than 9 but takes 20 times as long,
+            seconds on a desktop and over a minute on a Pi Zero.
+
+    Returns:
+        dict: The manifest.
+    """
+    log_ctx = "Asset Pipeline:"
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest = {"files": {}, "sources": {}}
+    written = {"manifest.json"}
+    for name, sources in available_bundles().items():
+        parts = []
+        for source in sources:
+            path = source_path(source)
+            with open(path, "rb") as f:
+                parts.append(minify(source, f.read()))
+            manifest["sources"][source] = os.path.getmtime(path)
+        # A newline and, between scripts, a semicolon keep a missing one at the end of a file from joining statements
+        data = (b";\n" if name.endswith(".js") else b"\n").join(parts)
+        filename = fingerprinted_name(name, data)
+        _write(os.path.join(dist_dir, filename), data)
+        written.add(filename)
+        encodings = {}
+        for encoding, (extension, compressed) in compressed_variants(data, brotli_quality).items():
+            _write(os.path.join(dist_dir, filename + extension), compressed)
+            written.add(filename + extension)
+            encodings[encoding] = extension
+        manifest["files"][name] = {"file": filename, "size": len(data), "encodings": encodings}
+        logger.log(
+            log_ctx,
+            f"{name} -> {filename}: {len(data)} bytes"
+            + "".join(f", {encoding} {os.path.getsize(os.path.join(dist_dir, filename + extension))}"
+                      for encoding, extension in encodings.items()),
+            level="DEBUG",
+        )
+
+    _write(os.path.join(dist_dir, "manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+    for filename in os.listdir(dist_dir):
+        if filename not in written:
+            os.remove(os.path.join(dist_dir, filename))
+    logger.log(log_ctx, f"Built {len(manifest['files'])} assets into {dist_dir}")
+    return manifest
+
+
+def load_manifest(dist_dir=DIST_DIR):
+    """
+    Returns the manifest of the last build, rebuilding first if it is missing or older than a source.
+    """
+    log_ctx = "Asset Pipeline:"
+    try:
+        with open(os.path.join(dist_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        expected = {source for sources in available_bundles().values() for source in sources}
+        stale = set(manifest["sources"]) != expected or any(
+            os.path.getmtime(source_path(source)) != mtime for source, mtime in manifest["sources"].items()
+        )
+    except (OSError, ValueError, KeyError):
+        manifest, stale = None, True
+    if stale:
+        # Fast settings, since this delays startup; build_assets.py compresses better
+        logger.log(log_ctx, "Assets missing or out of date, building them")
+        manifest = build(dist_dir, brotli_quality=5)
+    return manifest
+
+
+def init_app(app):
+    """
+    Loads (or builds) the assets and registers asset_url, has_asset and the /assets route with the app.
+    """
+    app.extensions["asset_manifest"] = load_manifest()
+    app.add_template_global(asset_url)
+    app.add_template_global(has_asset)
+    app.register_blueprint(assets, url_prefix="/")
+
+
+def asset_url(name):
+    """
+    URL of the fingerprinted file of a bundle, for use in templates: {{ asset_url("site.css") }}.
+    """
+    return f"/assets/{current_app.extensions['asset_manifest']['files'][name]['file']}"
+
+
+def has_asset(name):
+    """
+    Whether the bundle was built, for bundles that depend on an optional package: {% if has_asset("bokeh.js") %}.
+    """
+    return name in current_app.extensions['asset_manifest']['files']
+
+
+@assets.route("/assets/<path:filename>")
+def asset(filename):
+    files = {entry["file"]: entry for entry in current_app.extensions["asset_manifest"]["files"].values()}
+    if filename not in files:
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    encoding = None
+    for candidate in ("br", "gzip"):
+        if candidate in files[filename]["encodings"] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    stored = filename + files[filename]["encodings"][encoding] if encoding else filename
+    response = send_from_directory(DIST_DIR, stored, mimetype=mimetype, max_age=CACHE_MAX_AGE)
+    del response.headers["Content-Disposition"]  # Would name the .br/.gz file
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    # The name changes with the content, so browsers never need to revalidate
+    response.headers["Cache-Control"] = f"public, max-age={CACHE_MAX_AGE}, immutable"
+    response.vary.add("Accept-Encoding")
+    return response
@@ -1,14 +1,21 @@
 from datetime import datetime, timedelta 
 import json
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, Response, render_template, request, flash, redirect, url_for, jsonify
 import shared_db
 from . import db
 from manager.boundary.logger import logger
+from manager.boundary import change_bus as changes
+from manager.boundary.change_bus import KINDS
+from .etags import conditional, current_device
+from .views import expected_litres, minutes_to_setpoint
+from manager.control.time_interval_index import TimeIntervalIndex, ALL_WEEKDAYS, WEEKDAY_NAMES, format_weekdays, weekday_values
 
 auth = Blueprint('auth', __name__)
 
 @auth.route('/settings', methods=['GET', 'POST'])
+@conditional(changes.SETTINGS)
 def settings():
+    device = current_device()
     if request.method == 'POST':
         new_min_temp = int(request.form.get('minTemp'))
         new_high_temp = int(request.form.get('highTemp'))
@@ -37,31 +44,61 @@ def settings():
         elif new_std_temp > new_high_temp:
             flash('Standardstemperatur kan ikke være højere end høj temperatur', category='error')
         else:
-            user_settings = shared_db.get_user_settings(db.session)
-            user_settings.min_temp = new_min_temp
-            user_settings.high_temp = new_high_temp
-            user_settings.std_temp = new_std_temp
-            user_settings.price_threshold = new_price_threshold
-            user_settings.price_region = new_price_region
-
-            # Clear all time intervals
-            shared_db.clear_all_time_intervals(db.session)
-            # Add new time intervals
-            for time_interval in time_intervals:
-                # Split the time interval string into start and end time strings
-                start_time_str, end_time_str = time_interval.split('-')
-                # Convert the time strings to time objects
-                start_time = datetime.strptime(start_time_str.strip(), '%H:%M').time()
-                end_time = datetime.strptime(end_time_str.strip(), '%H:%M').time()
-
-                shared_db.add_time_interval(db.session, start_time, end_time)
-
-            db.session.commit()
+            try:
+                intervals = []
+                for time_interval in time_intervals:
+                    # The format is "HH:MM - HH:MM", optionally followed by "| 0,1,2" with the weekdays (0 = Monday)
+                    time_part, _, weekday_part = time_interval.partition('|')
+                    # Split the time interval string into start and end time strings
+                    start_time_str, end_time_str = time_part.split('-')
+                    # Convert the time strings to time objects
+                    start_time = datetime.strptime(start_time_str.strip(), '%H:%M').time()
+                    end_time = datetime.strptime(end_time_str.strip(), '%H:%M').time()
+                    weekdays = ALL_WEEKDAYS
+                    if weekday_part.strip():
+                        # As ints, so " 1" and "1" are the same day
+                        days = {int(day) for day in weekday_part.split(',')}
+                        if not days <= set(range(7)):
+                            raise ValueError(f"Invalid weekdays: {weekday_part}")
+                        weekdays = 0
+                        for day in days:
+                            weekdays |= 1 << day
+                    intervals.append((start_time, end_time, weekdays))
+            except ValueError:
+                flash('Ugyldigt tidsinterval', category='error')
+                return redirect(url_for("auth.settings"))
+
+            # Everything is saved in one transaction, so the manager never sees half-applied settings
+            try:
+                shared_db.update_user_settings(
+                    db.session,
+                    time_intervals=intervals,
+                    device=device,
+                    min_temp=new_min_temp,
+                    high_temp=new_high_temp,
+                    std_temp=new_std_temp,
+                    price_threshold=new_price_threshold,
+                    price_region=new_price_region,
+                )
+            except Exception as e:
+                logger.log("Settings:", "Failed to save settings", "ERROR", e)
+                flash('Indstillingerne kunne ikke gemmes', category='error')
+                return redirect(url_for("auth.settings"))
             flash('Indstillingerne er gemt', category='success')
 
-    user_settings = shared_db.get_user_settings(db.session)
-    print(user_settings)
-    return render_template("settings.html", existing_settings=shared_db.get_user_settings(db.session), year=datetime.now().year)
+    existing_settings = shared_db.get_user_settings(db.session, device)
+    effective_windows = TimeIntervalIndex(
+        (interval.start_time, interval.end_time, interval.weekdays) for interval in existing_settings.time_intervals
+    ).windows()
+    return render_template(
+        "settings.html",
+        existing_settings=existing_settings,
+        effective_windows=effective_windows,
+        weekday_names=WEEKDAY_NAMES,
+        format_weekdays=format_weekdays,
+        weekday_values=weekday_values,
+        year=datetime.now().year,
+    )
 
 
 @auth.route('/set-system-power',methods=['POST'])
@@ -69,39 +106,79 @@ def setSystemPower():
     log_ctx = "System Power:"
     state = json.loads(request.data)
     stateToSet = state['state']
-    system_data = shared_db.get_system_data(db.session)
+    device = current_device()
+    system_data = shared_db.get_system_data(db.session, device)
     system_data.sys_power = stateToSet
     db.session.commit()
     
     if stateToSet == True:
         flash(f'System er nu tændt!', category='success')
-        logger.log(log_ctx, "System is now turned on")
+        logger.log(log_ctx, f"System {device} is now turned on")
     else:
         flash(f'System er nu slukket!', category='error')
-        logger.log(log_ctx, "System is now turned off")
+        logger.log(log_ctx, f"System {device} is now turned off")
     return jsonify({})
 
 @auth.route('/get_system_data')
+@conditional(changes.POWER, changes.READINGS, changes.SETPOINT, changes.THERMAL, changes.USAGE)
 def getSystemData():
     # Her skal du hente de opdaterede systemdata
+    device = current_device()
     system_data = {
-        'water_temp': shared_db.get_system_data(db.session).water_temp,
-        'water_level': shared_db.get_system_data(db.session).water_level,
-        'sys_power': shared_db.get_system_data(db.session).sys_power,
+        'device': device,
+        'water_temp': shared_db.get_system_data(db.session, device).water_temp,
+        'water_level': shared_db.get_system_data(db.session, device).water_level,
+        'sys_power': shared_db.get_system_data(db.session, device).sys_power,
+        'setpoint': shared_db.get_system_data(db.session, device).setpoint,
+        'minutes_to_setpoint': minutes_to_setpoint(shared_db.get_system_data(db.session, device)),
+        'expected_litres': expected_litres(device),
     }
     return jsonify(system_data)
 
 
+@auth.route('/events')
+def events():
+    """
+    Server-sent events for changes published on the change bus, e.g. /events?kinds=readings,power.
+    Each event is named after its kind and carries {"kind", "version"}; a comment is sent every 15 s to keep
+    the connection open. Returns 503 if the bus is unavailable, so clients fall back to polling.
+    """
+    bus = shared_db.change_bus
+    kinds = [kind for kind in request.args.get('kinds', ','.join(KINDS)).split(',') if kind in KINDS]
+    if not kinds or bus.sequence() is None:
+        return Response(status=503)
+
+    def stream():
+        sequence = bus.sequence()
+        delivered = bus.versions(kinds)
+        yield 'retry: 2000\n\n'
+        while True:
+            new_sequence = bus.wait(sequence, timeout=15)
+            if new_sequence is None:
+                return
+            if new_sequence == sequence:
+                yield ': keepalive\n\n'
+                continue
+            sequence = new_sequence
+            for kind, version in bus.versions(kinds).items():
+                if version != delivered[kind]:
+                    delivered[kind] = version
+                    yield f'event: {kind}\nid: {version}\ndata: {json.dumps({"kind": kind, "version": version})}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 @auth.route('/manual-heating')
 def manual_heating():
-    manual_heating_state = shared_db.get_override_settings(db.session).toggled_on
+    device = current_device()
+    manual_heating_state = shared_db.get_override_settings(db.session, device).toggled_on
     if manual_heating_state:
-        shared_db.get_override_settings(db.session).toggled_on = False
+        shared_db.get_override_settings(db.session, device).toggled_on = False
         flash('Manuel opvarmning er slukket', category='error')
     else:
-        shared_db.get_override_settings(db.session).toggled_on = True
-        shared_db.get_override_settings(db.session).start_time = datetime.now()
-        shared_db.get_override_settings(db.session).end_time = datetime.now() + timedelta(minutes=20)
+        shared_db.get_override_settings(db.session, device).toggled_on = True
+        shared_db.get_override_settings(db.session, device).start_time = datetime.now()
+        shared_db.get_override_settings(db.session, device).end_time = datetime.now() + timedelta(minutes=20)
 
         flash('Manuel opvarmning er tændt', category='success')
     db.session.commit()
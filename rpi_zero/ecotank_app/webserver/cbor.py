@@ -0,0 +1,148 @@
+"""
+CBOR (RFC 8949), the compact binary alternative to JSON offered by /api/state (see api.py).
+
+Covers what JSON can hold: dicts, lists, strings, integers, floats, booleans and None, plus bytes. Floats are
+written in the shortest of half, single and double precision that holds them exactly, so whole and half degrees
+take 3 bytes. Definite lengths only, and no tags.
+"""
+import struct
+
+_HALF = struct.Struct(">e")
+_SINGLE = struct.Struct(">f")
+_DOUBLE = struct.Struct(">d")
+
+
+def _head(major, value):
+    if value < 24:
+        return bytes([major << 5 | value])
+    if value < 0x100:
+        return bytes([major << 5 | 24, value])
+    if value < 0x10000:
+        return bytes([major << 5 | 25]) + struct.pack(">H", value)
+    if value < 0x100000000:
+        return bytes([major << 5 | 26]) + struct.pack(">I", value)
+    if value < 0x10000000000000000:
+        return bytes([major << 5 | 27]) + struct.pack(">Q", value)
+    raise ValueError("Integers beyond 64 bits can't be encoded")
+
+
+def _float(value):
+    if value != value:  # NaN
+        return b"\xf9\x7e\x00"
+    for marker, packer in ((0xF9, _HALF), (0xFA, _SINGLE)):
+        try:
+            packed = packer.pack(value)
+        except OverflowError:
+            continue
+        if packer.unpack(packed)[0] == value:
+            return bytes([marker]) + packed
+    return b"\xfb" + _DOUBLE.pack(value)
+
+
+def _encode(value, out):
+    if value is None:
+        out.append(b"\xf6")
+    elif value is True:
+        out.append(b"\xf5")
+    elif value is False:
+        out.append(b"\xf4")
+    elif isinstance(value, int):
+        out.append(_head(0, value) if value >= 0 else _head(1, -1 - value))
+    elif isinstance(value, float):
+        out.append(_float(value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        out.append(_head(3, len(data)))
+        out.append(data)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(_head(2, len(value)))
+        out.append(bytes(value))
+    elif isinstance(value, (list, tuple)):
+        out.append(_head(4, len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append(_head(5, len(value)))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError(f"{type(value).__name__} can't be encoded as CBOR")
+
+
+def dumps(value):
+    """
+    Encodes value as CBOR.
+
+    Raises:
+        TypeError: For types other than those listed in the module docstring.
+    """
+    out = []
+    _encode(value, out)
+    return b"".join(out)
+
+
+def loads(data):
+    """
+    Decodes CBOR written by dumps, e.g. to check it or in Python clients.
+
+    Raises:
+        ValueError: If data isn't CBOR, uses features dumps doesn't, or has bytes left over.
+    """
+    value, offset = _decode(memoryview(data), 0)
+    if offset != len(data):
+        raise ValueError("Data left after the CBOR value")
+    return value
+
+
+def _decode(data, offset):
+    try:
+        initial = data[offset]
+    except IndexError:
+        raise ValueError("Truncated CBOR") from None
+    major, info = initial >> 5, initial & 0x1F
+    offset += 1
+    if major == 7:
+        if info == 20:
+            return False, offset
+        if info == 21:
+            return True, offset
+        if info == 22:
+            return None, offset
+        for marker, packer in ((25, _HALF), (26, _SINGLE), (27, _DOUBLE)):
+            if info == marker:
+                return packer.unpack_from(data, offset)[0], offset + packer.size
+        raise ValueError(f"Unsupported CBOR simple value {info}")
+    if info < 24:
+        argument = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        if offset + size > len(data):
+            raise ValueError("Truncated CBOR")
+        argument = int.from_bytes(data[offset:offset + size], "big")
+        offset += size
+    else:
+        raise ValueError("Indefinite lengths aren't supported")
+
+    if major == 0:
+        return argument, offset
+    if major == 1:
+        return -1 - argument, offset
+    if major in (2, 3):
+        if offset + argument > len(data):
+            raise ValueError("Truncated CBOR")
+        chunk = bytes(data[offset:offset + argument])
+        return (chunk if major == 2 else chunk.decode("utf-8")), offset + argument
+    if major == 4:
+        items = []
+        for _ in range(argument):
+            item, offset = _decode(data, offset)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        result = {}
+        for _ in range(argument):
+            key, offset = _decode(data, offset)
+            result[key], offset = _decode(data, offset)
+        return result, offset
+    raise ValueError("CBOR tags aren't supported")
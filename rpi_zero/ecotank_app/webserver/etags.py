@@ -0,0 +1,86 @@
+"""
+Conditional GET for routes whose response only depends on data announced on the change bus (see change_bus.py).
+
+The ETag is computed from the bus versions of the kinds a route depends on, before the view runs, so an
+unchanged request is answered with 304 without querying the database, rendering a template or building a
+Bokeh plot. The tag also covers the temperature warning shown in the layout, the date (the year in the footer,
+the days shown on the dashboard), the selected tank and the list of tanks, and the server start, since templates
+and fingerprinted asset names can only change with a restart.
+"""
+import functools
+import hashlib
+from datetime import datetime
+from flask import Response, current_app, g, make_response, request, session
+import shared_db
+
+
+def temperature_warning():
+    """
+    The warning shown on every page while the water is above 90 °C, or None. Cached until the next reading.
+    """
+    return current_app.extensions["temperature_warning"].get()
+
+
+def current_device():
+    """
+    The tank selected in this browser session (see views.select_device), or the first tank if none is selected
+    or the selected one no longer exists.
+    """
+    devices = current_app.extensions["devices"].get()
+    device = session.get("device")
+    return device if device in devices else devices[0]
+
+
+def current_minute():
+    """
+    The current time truncated to the minute, for views that follow the clock, like the current price.
+    """
+    return datetime.now().replace(second=0, microsecond=0)
+
+
+def conditional(*kinds, clock_key=None):
+    """
+    Decorator for GET routes: answers 304 if If-None-Match matches the current ETag, else runs the view and
+    tags its response. Pages are never short-circuited while flashed messages are waiting to be shown, and
+    nothing is tagged if the change bus is unavailable. A view that answers with outdated parts, like a chart
+    still being rebuilt (see job_queue.py), sets g.provisional so its response isn't tagged either.
+
+    Args:
+        *kinds (str): Kinds of change the response depends on.
+        clock_key (callable): For responses that also change with the clock, returns a value that changes when
+            they do, for example current_minute. It is part of the ETag. None for responses that only change
+            with the date.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = shared_db.change_bus.versions(kinds)
+            if request.method != "GET" or versions is None or "_flashes" in session:
+                return view(*args, **kwargs)
+
+            state = (
+                current_app.extensions["etag_salt"],
+                request.full_path,
+                sorted(versions.items()),
+                temperature_warning(),
+                current_device(),
+                current_app.extensions["devices"].get(),
+                datetime.now().date(),
+                clock_key() if clock_key is not None else None,
+            )
+            etag = hashlib.sha1(repr(state).encode("utf-8")).hexdigest()[:20]
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or g.get("provisional"):
+                    return response
+            response.set_etag(etag)
+            # Cached copies must always be revalidated, which is what makes the 304s possible
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+        return wrapper
+
+    return decorator
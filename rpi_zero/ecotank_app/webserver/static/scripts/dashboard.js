@@ -0,0 +1,23 @@
+
+// Number of the last price window requested; older answers arriving late are ignored
+var priceRequest = 0;
+var priceTimer = null;
+
+// Called by the price chart after every zoom or pan (see views.dashboard). Fetches the visible window,
+// downsampled to the plot's width, so zooming in shows every price instead of the overview's sample.
+function refinePrices(plot, line, band, x0, x1) {
+    clearTimeout(priceTimer);
+    priceTimer = setTimeout(function () {
+        var request = ++priceRequest;
+        var width = Math.round(plot.inner_width || plot.width || 800);
+        fetch(`/dashboard/prices?start=${Math.floor(x0)}&end=${Math.ceil(x1)}&width=${width}`)
+          .then(response => response.ok ? response.json() : null)
+          .then(data => {
+            if (data === null || request !== priceRequest) {
+              return;
+            }
+            line.data = { x: data.x, y: data.y };
+            band.data = { x: data.band_x, lower: data.lower, upper: data.upper };
+          });
+    }, 150);
+}
@@ -12,17 +12,81 @@ function setSystemPower(state) {
 }
 
 
+// ETag of the last state received; the server answers 304 while it is still current
+var stateTag = null;
+
+function formatNextSetpoint(next) {
+    var time = new Date(next.time);
+    var day = time.toDateString() === new Date().toDateString() ? '' : 'i morgen ';
+    return `Næste skift af setpunkt: ${day}kl. ${next.time.substring(11, 16)} til ${next.setpoint}°C`;
+}
+
+function refreshSystemData() {
+    var headers = stateTag === null ? {} : { 'If-None-Match': stateTag };
+    fetch('/api/state?fields=system,price,next_setpoint', { headers: headers, cache: 'no-store' })
+      .then(response => {
+        if (response.status === 304) {
+          return null;
+        }
+        stateTag = response.headers.get('ETag');
+        return response.json();
+      })
+      .then(state => {
+        if (state === null) {
+          return;
+        }
+        var data = state.system;
+        document.querySelector('#waterTemp').textContent = `Vandtemperatur er: ${Math.round(data.water_temp * 10) / 10}°C`;
+        document.querySelector('#waterLevel').textContent = `Vandstand er: ${Math.round(data.water_level)}% (${Math.round((data.water_level*0.02)*100)/100}L)`;
+        var setpointEta = document.querySelector('#setpointEta');
+        if (setpointEta !== null) {
+          setpointEta.textContent = data.minutes_to_setpoint === null ? '' : `Forventet tid til ${data.setpoint}°C: ca. ${data.minutes_to_setpoint} min`;
+        }
+        var usageForecast = document.querySelector('#usageForecast');
+        if (usageForecast !== null) {
+          usageForecast.textContent = data.expected_litres === null ? '' : `Forventet varmtvandsforbrug den næste time: ca. ${data.expected_litres} L`;
+        }
+        var currentPrice = document.querySelector('#currentPrice');
+        if (currentPrice !== null) {
+          var price = state.price;
+          currentPrice.textContent = price.dkk_per_kwh === null ? '' :
+            `Elpris nu: ${price.dkk_per_kwh.toFixed(2)} DKK pr. kWh${price.estimated ? ' (prognose)' : ''}`;
+        }
+        var nextSetpoint = document.querySelector('#nextSetpoint');
+        if (nextSetpoint !== null) {
+          nextSetpoint.textContent = state.next_setpoint === null ? '' : formatNextSetpoint(state.next_setpoint);
+        }
+
+        // Update the system power switch checkbox state
+        var sysPowerCheckbox = document.getElementById('customSwitch1');
+        sysPowerCheckbox.checked = data.sys_power;
+      });
+}
+
+
 window.onload = function() {
-    setInterval(function() {
-      fetch('/get_system_data')
-        .then(response => response.json())
-        .then(data => {
-          document.querySelector('#waterTemp').textContent = `Vandtemperatur er: ${Math.round(data.water_temp * 10) / 10}°C`;
-          document.querySelector('#waterLevel').textContent = `Vandstand er: ${Math.round(data.water_level)}% (${Math.round((data.water_level*0.02)*100)/100}L)`;
-
-          // Update the system power switch checkbox state
-          var sysPowerCheckbox = document.getElementById('customSwitch1');
-          sysPowerCheckbox.checked = data.sys_power;
-        });
-    }, 1000); // Opdaterer hvert sekund
-  }
\ No newline at end of file
+    // Opdateres kun når serveren melder en ændring; ellers hentes data hvert sekund
+    var pollTimer = null;
+    function startPolling() {
+      if (pollTimer === null) {
+        pollTimer = setInterval(refreshSystemData, 1000);
+      }
+    }
+    if (!window.EventSource) {
+      startPolling();
+      return;
+    }
+    // Prisen og næste setpunkt følger uret, så tilstanden hentes også hvert minut (304 hvis intet er ændret)
+    setInterval(refreshSystemData, 60000);
+    var kinds = ['readings', 'power', 'setpoint', 'thermal', 'usage', 'prices', 'forecasts', 'override', 'settings'];
+    var events = new EventSource('/events?kinds=' + kinds.join(','));
+    kinds.forEach(kind => events.addEventListener(kind, refreshSystemData));
+    events.onopen = function() {
+      if (pollTimer !== null) {
+        clearInterval(pollTimer);
+        pollTimer = null;
+      }
+      refreshSystemData(); // Changes while disconnected
+    };
+    events.onerror = startPolling;
+  }
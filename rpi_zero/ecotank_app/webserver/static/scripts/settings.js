@@ -32,14 +32,26 @@ document.getElementById('addInterval').addEventListener('click', function() {
     if (startTime.value === '' || endTime.value === '') {
         return;
     }
+    var checkedDays = document.querySelectorAll('#weekdays input:checked');
+    if (checkedDays.length === 0) {
+        return;
+    }
+    var dayValues = [];
+    var dayNames = [];
+    for (var d = 0; d < checkedDays.length; d++) {
+        dayValues.push(checkedDays[d].value);
+        dayNames.push(checkedDays[d].dataset.name);
+    }
+    var dayText = checkedDays.length === 7 ? 'Alle dage' : dayNames.join(', ');
+
     var intervalList = document.getElementById('intervalList');
     var listItem = document.createElement('li');
     listItem.classList.add('list-group-item');
-    listItem.textContent = startTime.value + ' - ' + endTime.value;
+    listItem.textContent = startTime.value + ' - ' + endTime.value + ' (' + dayText + ')';
   
     // Create a close icon for the list item
     var closeIcon = document.createElement('span');
-    closeIcon.classList.add('badge', 'badge-secondary', 'float-right');
+    closeIcon.classList.add('badge', 'bg-secondary', 'float-end');
     closeIcon.innerHTML = '&times;';
     closeIcon.style.cursor = 'pointer';
     closeIcon.addEventListener('click', function() {
@@ -54,7 +66,7 @@ document.getElementById('addInterval').addEventListener('click', function() {
     var hiddenInput = document.createElement('input');
     hiddenInput.type = 'hidden';
     hiddenInput.name = 'timeIntervals[]';
-    hiddenInput.value = startTime.value + ' - ' + endTime.value;
+    hiddenInput.value = startTime.value + ' - ' + endTime.value + ' | ' + dayValues.join(',');
   
     // Add the hidden input to the form
     document.querySelector('form').appendChild(hiddenInput);
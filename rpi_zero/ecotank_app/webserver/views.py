@@ -3,103 +3,130 @@ Routes and views for the flask application.
 """
 import shared_db
 from . import db
-from flask_login import UserMixin
 from sqlalchemy.sql import func
-from datetime import datetime, time
-from flask import Blueprint, flash, jsonify, render_template, request, redirect, url_for
+from datetime import date, datetime, time, timedelta
+from flask import Blueprint, Response, abort, current_app, flash, g, jsonify, render_template, request, redirect, session, url_for
 import json
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.resources import CDN
-from bokeh.models import (
-    DatetimeTickFormatter,
-    DataRange1d,
-    PanTool,
-    WheelZoomTool,
-    FixedTicker,
-    Range1d,
-    NumeralTickFormatter,
-    DatetimeTicker,
-)
+import math
 from manager.boundary.logger import Logger
-from math import floor, ceil
+from manager.boundary import change_bus as changes
+from .etags import conditional, current_device, current_minute
+from manager.boundary.sampling_profiler import folded_to_speedscope, profile_running, read_profile, request_profile
+from manager.boundary.job_queue import FRESH
+from manager.control.price_chart import PLOT_WIDTH, price_chart, price_chart_data
+from manager.control.data_export import (
+    DATASETS,
+    FORMATS,
+    parse_time,
+    export_version,
+    export_filename,
+    iter_export,
+    slice_chunks,
+)
 
 views = Blueprint('views', __name__, template_folder='templates')
 
+ENERGY_DAYS = 14  # Days in the energy table on the dashboard
+CHEAPEST_HOURS = 4  # Cheapest hours of the day listed on the dashboard
+WEEKDAYS = ["Man", "Tir", "Ons", "Tor", "Fre", "Lør", "Søn"]  # Rows of the usage table on the dashboard
+
+def minutes_to_setpoint(system_data):
+    """
+    Minutes until the water reaches the setpoint according to the thermal model of the tank (see thermal_model.py),
+    or None if it isn't heating or the tank hasn't been calibrated yet.
+    """
+    model = current_app.extensions['thermal_model'].get(system_data.device)
+    if model is None or not system_data.sys_power or system_data.water_temp >= system_data.setpoint:
+        return None
+    seconds = model.time_to_reach(system_data.setpoint, system_data.water_temp, system_data.water_level)
+    return round(seconds / 60) if seconds is not None else None
+
+
+def expected_litres(device):
+    """
+    Litres of hot water usually drawn in the next hour according to the usage profile of the tank
+    (see usage_profile.py), or None if no readings have been observed yet.
+    """
+    profile = current_app.extensions['usage_profile'].get(device)
+    if not any(profile.hours):
+        return None
+    return round(profile.expected_litres(datetime.now()))
+
+
 @views.route('/')
 @views.route('/home')
+@conditional(
+    changes.POWER,
+    changes.READINGS,
+    changes.OVERRIDE,
+    changes.SETTINGS,
+    changes.SETPOINT,
+    changes.PRICES,
+    changes.FORECASTS,
+    changes.THERMAL,
+    changes.USAGE,
+    clock_key=current_minute,  # The current price and the next setpoint follow the clock, like /api/state
+)
 def home():
-    """Renders the home page."""
+    """Renders the home page, from the same snapshot as /api/state, which home.js refreshes it with."""
+    from .api import current_state  # api.py imports the helpers above
+
+    state = current_state(current_device()).state
+    system_data = state["system"]
     return render_template(
         'index.html',
         title='Home Page',
         year=datetime.now().year,
-        system_data=shared_db.get_system_data(db.session),
-        water_volume = shared_db.get_system_data(db.session).water_level*0.02,
-        user_settings=shared_db.get_user_settings(db.session),
-        override_settings=shared_db.get_override_settings(db.session),
+        system_data=system_data,
+        minutes_to_setpoint=system_data["minutes_to_setpoint"],
+        expected_litres=system_data["expected_litres"],
+        water_volume=system_data["water_level"] * 0.02,
+        user_settings=state["settings"],
+        override_settings=state["override"],
+        price=state["price"],
+        next_setpoint=state["next_setpoint"],
+        today=state["time"][:10],
     )
 
 
+@views.route('/select-device', methods=['POST'])
+def select_device():
+    """Selects the tank the pages show and control, for this browser session."""
+    device = request.form.get('device')
+    if device in current_app.extensions['devices'].get():
+        session['device'] = device
+    return redirect(request.referrer or url_for('views.home'))
+
+
 @views.route("/dashboard")
+@conditional(changes.SETTINGS, changes.PRICES, changes.FORECASTS, changes.ENERGY, changes.USAGE)
 def dashboard():
-    region = shared_db.get_user_settings(db.session).price_region
-    price_objects = shared_db.get_electricity_prices(db.session, region)
-    datetimes = [price_object.time_start for price_object in price_objects]
-    prices = [price_object.DKK_per_kWh for price_object in price_objects]
-
-    plot_width = 800  # width in pixels
-    plot_height = 500  # height in pixels
-
-    # Determining the y-axis range with padding
-    min_price = min(prices)
-    max_price = max(prices)
-
-    # Adjust the start and end for ticks
-    tick_start = floor(min_price * 10) / 10
-    tick_end = ceil(max_price * 10) / 10
-
-    # Generating ticks every 0.1 within the range
-    y_ticks = [tick_start + i * 0.1 for i in range(int((tick_end - tick_start) / 0.1) + 1)]
-
-    y_range = Range1d(start=tick_start, end=tick_end)
-
-    # Creating the figure
-    p = figure(
-        title="Elpriser i DKK pr. kWh",
-        x_axis_label="Tidspunkt",
-        y_axis_label="DKK pr. kWh",
-        x_axis_type="datetime",
-        sizing_mode="scale_width",
-        width=plot_width,
-        height=plot_height,
-        y_range=y_range,
-        tools="pan",  # Include basic tools, excluding WheelZoomTool to customize it next
-    )
+    device = current_device()
+    region = shared_db.get_user_settings(db.session, device).price_region
+    # Built in a job worker (see job_queue.py), so a slow build doesn't hold up other requests. While new prices
+    # or forecasts are being drawn, the previous chart is shown
+    chart = current_app.extensions['jobs'].get(price_chart, region, kinds=(changes.PRICES, changes.FORECASTS))
+    if chart.state != FRESH:
+        g.provisional = True  # Not tagged, so the next visit gets the new chart. See etags.py
+    script, div = chart.value if chart.value is not None else ("", "")
+    cheapest_hours = shared_db.price_cache.cheapest_hours(region, date.today(), CHEAPEST_HOURS)
 
-    # Adding line renderer
-    p.line(datetimes, prices, legend_label="DKK per kWh", line_width=2)
-
-    p.xaxis.ticker = DatetimeTicker()
-    # Formatting the datetime ticks on the x-axis
-    p.xaxis.formatter = DatetimeTickFormatter(
-        minutes=["%H:%M"],
-        hours=["%d/%m %H:%M"],
-        days=["%d/%m"],
-        months=["%B %Y"],
-        years=["%Y"],
+    # Heater energy and cost of the last two weeks, see energy_accountant.py
+    energy_days = shared_db.get_energy_days(
+        db.session, since=date.today() - timedelta(days=ENERGY_DAYS - 1), device=device
     )
+    energy_total = {
+        "heating_hours": sum(day.heating_seconds for day in energy_days) / 3600,
+        "kwh": sum(day.energy_wh for day in energy_days) / 1000,
+        "cost_dkk": sum(day.cost_dkk for day in energy_days),
+        "flat_cost_dkk": sum(day.flat_cost_dkk or 0.0 for day in energy_days),
+        "unpriced_kwh": sum(day.energy_wh - day.priced_wh for day in energy_days) / 1000,
+    }
 
-    p.yaxis[0].ticker = FixedTicker(ticks=y_ticks)
-    p.yaxis[0].formatter = NumeralTickFormatter(format="0.0")
-
-    # Add customized WheelZoomTool
-    wheel_zoom = WheelZoomTool(dimensions="width")  # Enable zooming only on x-axis
-    p.add_tools(wheel_zoom)
-    p.toolbar.active_scroll = wheel_zoom  # Set the custom WheelZoomTool as the active scroll tool
-
-    # Components for embedding the plot in the webpage
-    script, div = components(p)
+    # Hot water usage per hour of the week, learned from the draw-offs, see usage_profile.py
+    profile = current_app.extensions['usage_profile'].get(device)
+    usage = profile.matrix() if any(profile.hours) else None
+    usage_max = max(max(row) for row in usage) if usage else 0.0
 
     return render_template(
         "dashboard.html",
@@ -107,10 +134,169 @@ def dashboard():
         year=datetime.now().year,
         script=script,
         div=div,
-        cdn_js=CDN.render_js(),
+        chart_pending=chart.value is None,
+        energy_days=reversed(energy_days),
+        energy_total=energy_total,
+        cheapest_hours=cheapest_hours,
+        usage=usage,
+        usage_max=usage_max,
+        weekdays=WEEKDAYS,
     )
 
 
+@views.route("/dashboard/prices")
+@conditional(changes.SETTINGS, changes.PRICES)
+def dashboard_prices():
+    """
+    The price chart data for a window, e.g. /dashboard/prices?start=1709251200000&end=1709856000000&width=640,
+    with start and end in milliseconds as on the chart's axis. Fetched by dashboard.js when the chart is zoomed.
+    """
+    region = shared_db.get_user_settings(db.session, current_device()).price_region
+    try:
+        start = float(request.args["start"]) if request.args.get("start") else None
+        end = float(request.args["end"]) if request.args.get("end") else None
+        width = min(max(int(request.args.get("width", PLOT_WIDTH)), 100), 4000)
+        if not all(math.isfinite(value) for value in (start, end) if value is not None):
+            raise ValueError("start and end must be finite")
+    except ValueError:
+        return "Invalid start, end or width", 400
+    chart = price_chart_data(region, width, start, end)
+    return jsonify({field: getattr(chart, field).tolist() for field in chart._fields})
+
+
+def _stream_export(params, first=0, stop=None):
+    """
+    Generates an export with its own session, since the response is streamed after the request handler returns.
+    """
+    with shared_db.session_factory() as session:
+        chunks = iter_export(session, *params)
+        if stop is not None:
+            chunks = slice_chunks(chunks, first, stop)
+        yield from chunks
+
+
+@views.route("/export/<dataset>.<fmt>", methods=["GET", "HEAD"])
+def export(dataset, fmt):
+    """
+    Streams a dataset as CSV or JSON lines, e.g. /export/prices.csv?region=DK1&start=2024-01-01&end=2024-02-01&gzip=1.
+    start is inclusive and end exclusive. Byte ranges are supported for resuming downloads, guarded by the ETag.
+    """
+    if dataset not in DATASETS or fmt not in FORMATS:
+        abort(404)
+    region = request.args.get("region") or shared_db.get_user_settings(db.session, current_device()).price_region
+    try:
+        start = parse_time(request.args.get("start"))
+        end = parse_time(request.args.get("end"))
+    except ValueError:
+        return "Invalid date format, use YYYY-MM-DD or YYYY-MM-DDTHH:MM", 400
+    compress = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+    params = (dataset, region, start, end, fmt, compress)
+
+    with shared_db.session_factory() as session:
+        etag = f'"{export_version(session, *params)}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{export_filename(*params)}"',
+    }
+    mimetype = "application/gzip" if compress else FORMATS[fmt]
+
+    byte_range = request.range
+    if byte_range is not None and request.headers.get("If-Range", etag) != etag:
+        byte_range = None  # The data changed since the partial download, so send everything again
+    if byte_range is None and request.method != "HEAD":
+        return Response(_stream_export(params), mimetype=mimetype, headers=headers)
+
+    # Content-Range and Content-Length need the total size, which is only known after generating the export once
+    with shared_db.session_factory() as session:
+        total = sum(len(chunk) for chunk in iter_export(session, *params))
+    if byte_range is None:
+        response = Response(mimetype=mimetype, headers=headers)
+        response.content_length = total
+        return response
+
+    bounds = byte_range.range_for_length(total)
+    if bounds is None:
+        headers["Content-Range"] = f"bytes */{total}"
+        return Response(b"", status=416, headers=headers)
+    first, stop = bounds
+    headers["Content-Range"] = byte_range.to_content_range_header(total)
+    headers["Content-Length"] = str(stop - first)
+    return Response(_stream_export(params, first, stop), status=206, mimetype=mimetype, headers=headers)
+
+
+PROFILED_PROCESSES = ("manager", "webserver")
+
+
+@views.route("/debug/profile")
+def profile():
+    """
+    Debug page for the sampling profiler: start a profile in either process and download the last one.
+    """
+    directory = shared_db.profile_directory()
+    processes = []
+    for process in PROFILED_PROCESSES:
+        last = read_profile(directory, process)
+        if process == "webserver":
+            running = current_app.extensions["profile_controller"].running
+        else:
+            running = profile_running(directory, process)
+        processes.append(
+            {
+                "name": process,
+                "running": running,
+                "metadata": last[1] if last else None,
+                "finished": datetime.fromtimestamp(last[1]["finished"]) if last else None,
+            }
+        )
+    return render_template("profile.html", title="Profilering", year=datetime.now().year, processes=processes)
+
+
+@views.route("/debug/jobs")
+def job_status():
+    """
+    State of the job workers as JSON: running jobs, cached results with their age and whether they are current,
+    and hit, deduplication and failure counters. See job_queue.py.
+    """
+    return jsonify(current_app.extensions["jobs"].status())
+
+
+@views.route("/debug/profile/<process>/start", methods=["POST"])
+def start_profile(process):
+    if process not in PROFILED_PROCESSES:
+        abort(404)
+    try:
+        seconds = min(max(float(request.form.get("seconds", "30")), 1.0), 120.0)
+    except ValueError:
+        flash("Varigheden skal være et tal", category="error")
+        return redirect(url_for("views.profile"))
+    if process == "webserver":
+        current_app.extensions["profile_controller"].start(seconds)
+    else:
+        request_profile(shared_db.profile_directory(), process, seconds)
+    flash(f"Profilering af {process} startet i {seconds:g} sekunder", category="success")
+    return redirect(url_for("views.profile"))
+
+
+@views.route("/debug/profile/<process>.folded", defaults={"fmt": "folded"})
+@views.route("/debug/profile/<process>.speedscope.json", defaults={"fmt": "speedscope.json"})
+def download_profile(process, fmt):
+    """
+    Downloads the last profile of a process as folded stacks (for flamegraph.pl) or as a speedscope file.
+    """
+    if process not in PROFILED_PROCESSES:
+        abort(404)
+    last = read_profile(shared_db.profile_directory(), process)
+    if last is None:
+        abort(404)
+    folded, metadata = last
+    headers = {"Content-Disposition": f'attachment; filename="{process}.{fmt}"'}
+    if fmt == "folded":
+        return Response(folded, mimetype="text/plain", headers=headers)
+    document = folded_to_speedscope(folded, f"EcoTank {process}", metadata.get("duration"))
+    return Response(json.dumps(document), mimetype="application/json", headers=headers)
+
+
 @views.route('/log')
 def log():
     try: